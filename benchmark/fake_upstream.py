@@ -0,0 +1,307 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import argparse
+import hashlib
+import random
+import re
+import socket
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock
+from urlparse import urlparse, parse_qs
+
+# The synthetic packages repeat a block derived from their names, so they need no disk space.
+_BLOCK_SIZE = 64 * 1024
+
+# Bytes written to a connection at a time.
+_WRITE_SIZE = 64 * 1024
+
+_PLATFORM_PACKAGES = ['Linux-x86_64.tgz', 'x64-release.msi', 'darwin-64.tgz']
+_PRODUCTS = ['splunk', 'splunkforwarder']
+_VERSION = '7.0.0'
+_FIRST_BUILD = 100000
+
+# The builds of different branches are numbered apart by this.
+_BRANCH_BUILD_STEP = 10000
+
+_RC_COLOR = '#54C944'
+
+_PACKAGE_PATH = re.compile(r'^/builds/([^/]+)/(\d+)/([^/]+?)(\.md5)?$')
+_DOWNLOAD_PAGE_PATH = re.compile(r'^/dl/(.+)-(\d+)\.html$')
+
+
+def _commit(build):
+    return '{0:012x}'.format(build)
+
+
+def _http_date(timestamp):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(timestamp))
+
+
+class SyntheticPackage(object):
+    def __init__(self, file_name, size):
+        self.file_name = file_name
+        self.size = size
+        # Differs from package to package, so that they are never deduplicated by the content.
+        seed = hashlib.md5(file_name).digest()
+        self.block = ''.join(hashlib.md5(seed + str(i)).digest() for i in xrange(_BLOCK_SIZE / 16))
+        self.etag = '"{0}"'.format(hashlib.md5(file_name + str(size)).hexdigest())
+        self._md5 = None
+
+    def read(self, offset, length):
+        start = offset % _BLOCK_SIZE
+        data = self.block[start:start + length]
+        while len(data) < length:
+            data += self.block[:length - len(data)]
+        return data
+
+    @property
+    def md5(self):
+        if self._md5 is None:
+            md5 = hashlib.md5()
+            for offset in xrange(0, self.size, _BLOCK_SIZE):
+                md5.update(self.read(offset, min(_BLOCK_SIZE, self.size - offset)))
+            self._md5 = md5.hexdigest()
+        return self._md5
+
+
+class FakeUpstream(object):
+    def __init__(self, branches=5, builds=3, size=32 * 1024 * 1024, bandwidth=0, latency=0, failure_rate=0,
+                 aliased=False):
+        """
+        The state of a stand-in for releases.splunk.com.
+        :param branches: Number of branches in the release page, the first one is current.
+        :param builds: Number of builds of each branch in the release page, the oldest one is an RC build.
+        :param size: Bytes of each package.
+        :param bandwidth: Max bytes/s sent by each connection, 0 means unlimited.
+        :param latency: Seconds to wait before answering each request.
+        :param failure_rate: The probability that a package download fails (half of them answer 503, the others are
+        cut in the middle).
+        :param aliased: If True, all the branches publish the same builds (like the aliases of current), otherwise
+        each branch has its own builds.
+        """
+        self.branches = ['current'] + ['bench{0}'.format(i) for i in range(1, branches)]
+        self.builds = builds
+        self.size = size
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._lock = Lock()
+        self._packages = dict()
+        self._latest = dict((branch, _FIRST_BUILD + (0 if aliased else i * _BRANCH_BUILD_STEP) + builds - 1)
+                            for i, branch in enumerate(self.branches))
+        self.modified_at = time.time()
+        self.status_page = self._render_status()
+
+    def advance(self):
+        """
+        Every branch gets a new build, like between two fetch cycles.
+        """
+        with self._lock:
+            for branch in self.branches:
+                self._latest[branch] += 1
+            self.modified_at = time.time()
+            self.status_page = self._render_status()
+
+    def latest_build(self, branch):
+        return self._latest.get(branch)
+
+    def package_name(self, product, build, platform_package):
+        return '{0}-{1}-{2}-{3}'.format(product, _VERSION, _commit(build), platform_package)
+
+    def get_package(self, file_name):
+        with self._lock:
+            package = self._packages.get(file_name)
+            if package is None:
+                package = self._packages[file_name] = SyntheticPackage(file_name, self.size)
+            return package
+
+    def _render_status(self):
+        lines = ['<html><body>']
+        for branch in self.branches:
+            latest = self._latest[branch]
+            lines.append('<center>Branch: {0}</center>'.format(branch))
+            lines.append('<table>')
+            for build in range(latest, latest - self.builds, -1):
+                rc = build == latest - self.builds + 1
+                lines.append('<tr{0}><td>{1}</td><td><a href="dl/{1}-{2}.html">{2}</a></td><td>{3}</td></tr>'.format(
+                    ' bgcolor="{0}"'.format(_RC_COLOR) if rc else '', branch, build,
+                    '{0} RC{1}'.format(_VERSION, build) if rc else 'build {0}'.format(build)))
+            lines.append('</table>')
+        lines.append('</body></html>')
+        return '\n'.join(lines)
+
+    def render_download_page(self, branch, build):
+        links = []
+        for product in _PRODUCTS:
+            for platform_package in _PLATFORM_PACKAGES:
+                href = '/builds/{0}/{1}/{2}'.format(branch, build, self.package_name(product, build, platform_package))
+                links.append('<a href="{0}">package</a> <a href="{0}.md5">md5</a><br>'.format(href))
+        return '<html><body>\n{0}\n</body></html>'.format('\n'.join(links))
+
+    def fetch_url(self, host, query):
+        """
+        Answer the splunk_build_fetcher.py CGI.
+        :return: The package url, or None if there is no such package.
+        """
+        branch = query.get('BRANCH', [None])[-1]
+        platform_package = query.get('PLAT_PKG', [None])[-1]
+        product = 'splunkforwarder' if query.get('UF') else query.get('PRODUCT', ['splunk'])[-1]
+        build = query.get('P4CHANGE', [self.latest_build(branch)])[-1]
+        if branch not in self._latest or platform_package not in _PLATFORM_PACKAGES or product not in _PRODUCTS:
+            return None
+        return 'http://{0}/builds/{1}/{2}/{3}'.format(host, branch, build,
+                                                      self.package_name(product, int(build), platform_package))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def upstream(self):
+        return self.server.upstream
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body='', content_type='text/html', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_POST(self):
+        if self.path == '/_advance':
+            self.upstream.advance()
+            self._send(200, 'ok', 'text/plain')
+        else:
+            self._send(404)
+
+    def do_GET(self):
+        if self.upstream.latency:
+            time.sleep(self.upstream.latency)
+        url = urlparse(self.path)
+        if url.path == '/status.html':
+            return self._send_status()
+        if url.path in ('/cgi-bin/splunk_build_fetcher.py', '/cgi-bin/build_fetcher.py'):
+            package_url = self.upstream.fetch_url(self.headers.get('host'), parse_qs(url.query))
+            if package_url is None:
+                return self._send(404, 'No such package.', 'text/plain')
+            return self._send(200, package_url + '\n', 'text/plain')
+        match = _DOWNLOAD_PAGE_PATH.match(url.path)
+        if match:
+            return self._send(200, self.upstream.render_download_page(match.group(1), int(match.group(2))))
+        match = _PACKAGE_PATH.match(url.path)
+        if match:
+            package = self.upstream.get_package(match.group(3))
+            if match.group(4):
+                return self._send(200, 'MD5 ({0}) = {1}\n'.format(package.file_name, package.md5), 'text/plain')
+            return self._send_package(package)
+        self._send(404)
+
+    def _send_status(self):
+        upstream = self.upstream
+        etag = '"{0}"'.format(hashlib.md5(upstream.status_page).hexdigest())
+        headers = {'ETag': etag, 'Last-Modified': _http_date(upstream.modified_at)}
+        if self.headers.get('if-none-match') == etag:
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self._send(200, upstream.status_page, headers=headers)
+
+    def _get_range(self, package):
+        """
+        :return: The requested (start, end) byte range, or None for the whole package.
+        """
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('range', ''))
+        if not match:
+            return None
+        if_range = self.headers.get('if-range')
+        if if_range and if_range != package.etag:
+            return None
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else package.size - 1
+        return start, min(end, package.size - 1)
+
+    def _send_package(self, package):
+        upstream = self.upstream
+        if self.command == 'GET' and upstream.failure_rate and random.random() < upstream.failure_rate:
+            if random.random() < 0.5:
+                return self._send(503, 'Try again later.', 'text/plain')
+            cut = True
+        else:
+            cut = False
+        byte_range = self._get_range(package) if self.command == 'GET' else None
+        start, end = byte_range if byte_range else (0, package.size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', package.etag)
+        self.send_header('Last-Modified', _http_date(upstream.modified_at))
+        if byte_range:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, package.size))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        if cut:
+            end = start + (end - start) / 2
+        sent_at = time.time()
+        offset = start
+        try:
+            while offset <= end:
+                length = min(_WRITE_SIZE, end - offset + 1)
+                self.wfile.write(package.read(offset, length))
+                offset += length
+                if upstream.bandwidth:
+                    ahead = (offset - start) / float(upstream.bandwidth) - (time.time() - sent_at)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except socket.error:
+            return
+        if cut:
+            self.close_connection = 1
+
+
+class FakeUpstreamServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, upstream):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.upstream = upstream
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A local stand-in for releases.splunk.com.')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--branches', type=int, default=5, help='number of branches')
+    parser.add_argument('--builds', type=int, default=3, help='number of builds of each branch')
+    parser.add_argument('--size', type=int, default=32 * 1024 * 1024, help='bytes of each package')
+    parser.add_argument('--bandwidth', type=int, default=0, help='max bytes/s of each connection, 0 is unlimited')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before answering each request')
+    parser.add_argument('--failure-rate', type=float, default=0, help='probability of a package download failing')
+    parser.add_argument('--aliased', action='store_true', help='all the branches publish the same builds')
+    args = parser.parse_args()
+    upstream = FakeUpstream(args.branches, args.builds, args.size, args.bandwidth, args.latency, args.failure_rate,
+                            args.aliased)
+    server = FakeUpstreamServer(args.port, upstream)
+    print 'Serving {0} branches at http://127.0.0.1:{1}/status.html'.format(len(upstream.branches), args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import argparse
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+_PROJECT_DIR = os.path.dirname(_CURRENT_DIR)
+
+# The stages of a fetch cycle in order, and the methods run by each of them.
+_STAGES = [('scrape', [('scraper', 'ReleaseScraper', 'get_release_page'),
+                       ('scraper', 'ReleaseScraper', 'get_rc_builds')]),
+           ('resolve', [('resolver', 'UrlResolver', 'prefetch')]),
+           ('download', [('manage', 'BuildManager', 'download_latest_builds')]),
+           ('verify', []),
+           ('expire', [('manage', 'BuildManager', 'delete_expire_builds')])]
+
+
+def _read_proc_io():
+    """
+    :return: A dict of the read/write syscall counts (and bytes) of this process, empty if /proc is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return dict((name, int(value)) for name, value in (line.split(':') for line in f))
+    except (IOError, ValueError):
+        return dict()
+
+
+class _Sample(object):
+    def __init__(self, bytes_received):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.time = time.time()
+        self.user = usage.ru_utime
+        self.system = usage.ru_stime
+        self.switches = usage.ru_nvcsw + usage.ru_nivcsw
+        self.io = _read_proc_io()
+        self.bytes_received = bytes_received
+
+
+class StageRecorder(object):
+    def __init__(self, get_bytes_received):
+        """
+        Measure the wall time, cpu time, context switches and syscalls of the stages of the cycles. The stages run one
+        after another, so the counters of the whole process are used (the download threads are counted in).
+        :param get_bytes_received: Returns the bytes received by the downloads so far.
+        """
+        self.get_bytes_received = get_bytes_received
+        self.stages = OrderedDict((name, dict(wall=0.0, user=0.0, system=0.0, switches=0, syscr=0, syscw=0, calls=0,
+                                              bytes_received=0)) for name, _ in _STAGES)
+        self._patches = []
+        self._depth = 0
+
+    @contextmanager
+    def measure(self, name):
+        # A stage called inside another one (e.g. prefetch in the constructor) is only counted once.
+        self._depth += 1
+        before = _Sample(self.get_bytes_received()) if self._depth == 1 else None
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if before:
+                after = _Sample(self.get_bytes_received())
+                stage = self.stages[name]
+                stage['wall'] += after.time - before.time
+                stage['user'] += after.user - before.user
+                stage['system'] += after.system - before.system
+                stage['switches'] += after.switches - before.switches
+                stage['syscr'] += after.io.get('syscr', 0) - before.io.get('syscr', 0)
+                stage['syscw'] += after.io.get('syscw', 0) - before.io.get('syscw', 0)
+                stage['bytes_received'] += after.bytes_received - before.bytes_received
+                stage['calls'] += 1
+
+    def instrument(self):
+        """
+        Measure the methods of the stages whenever they are called by the BuildManager.
+        """
+        for name, methods in _STAGES:
+            for module_name, class_name, method_name in methods:
+                cls = getattr(__import__(module_name), class_name)
+                original = cls.__dict__[method_name]
+                setattr(cls, method_name, self._wrap(name, original))
+                self._patches.append((cls, method_name, original))
+
+    def _wrap(self, name, method):
+        def wrapper(*args, **kwargs):
+            with self.measure(name):
+                return method(*args, **kwargs)
+
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    def restore(self):
+        for cls, method_name, original in reversed(self._patches):
+            setattr(cls, method_name, original)
+        self._patches = []
+
+    def report(self):
+        lines = ['{0:<10}{1:>10}{2:>10}{3:>10}{4:>12}{5:>12}{6:>12}{7:>12}'.format(
+            'stage', 'wall(s)', 'user(s)', 'sys(s)', 'MB/s', 'switches', 'read calls', 'write calls')]
+        for name, stage in self.stages.items():
+            throughput = stage['bytes_received'] / 1024.0 / 1024 / stage['wall'] if stage['wall'] else 0
+            lines.append('{0:<10}{1:>10.3f}{2:>10.3f}{3:>10.3f}{4:>12.2f}{5:>12}{6:>12}{7:>12}'.format(
+                name, stage['wall'], stage['user'], stage['system'], throughput, stage['switches'], stage['syscr'],
+                stage['syscw']))
+        return '\n'.join(lines)
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _start_upstream(args, port):
+    """
+    Run the fake upstream in another process, so that its work is not counted in the stages.
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(_CURRENT_DIR, 'fake_upstream.py'), '--port', str(port),
+                                '--branches', str(args.branches), '--builds', str(args.builds), '--size',
+                                str(args.size), '--bandwidth', str(args.bandwidth), '--latency', str(args.latency),
+                                '--failure-rate', str(args.failure_rate)] + (['--aliased'] if args.aliased else []),
+                               stdout=open(os.devnull, 'w'))
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process
+        except socket.error:
+            time.sleep(0.1)
+    process.kill()
+    raise Exception('The fake upstream did not start.')
+
+
+def run(args):
+    port = _free_port()
+    root_path = args.root if args.root else tempfile.mkdtemp(prefix='splunkbmd-benchmark-')
+    # The settings are read when the modules are imported.
+    os.environ['SPLUNKBMD_RELEASE_SERVER'] = 'http://127.0.0.1:{0}'.format(port)
+    os.environ['SPLUNKBMD_ROOT_DIR'] = root_path
+    sys.path.insert(0, _PROJECT_DIR)
+    from catalog import BuildCatalog
+    from download import BuildDownloader
+    from manage import BuildManager
+    from metrics import DOWNLOAD_BYTES, DOWNLOAD_RETRIES, RESOLVE_SECONDS, MD5_SECONDS
+    from retention import RetentionEngine
+
+    def total(metric):
+        return sum(value for labels, value in metric.collect())
+
+    recorder = StageRecorder(lambda: total(DOWNLOAD_BYTES))
+    upstream = _start_upstream(args, port)
+    cycles = []
+    try:
+        recorder.instrument()
+        catalog = BuildCatalog(root_path)
+        retention = RetentionEngine(catalog, quota=args.quota)
+        started_at = time.time()
+        for i in range(args.cycles):
+            if i:
+                # Every branch gets a new build between two cycles.
+                urllib2.urlopen('http://127.0.0.1:{0}/_advance'.format(port), data='').read()
+            cycle_started_at = time.time()
+            manager = BuildManager(root_path, catalog=catalog)
+            manager.download_latest_builds()
+            with recorder.measure('verify'):
+                records = catalog.find()
+                broken = [record['path'] for record in records if record['md5'] and not BuildDownloader(
+                    root_path, record['platform_package']).check_md5(os.path.join(root_path, record['path']),
+                                                                     record['md5'])]
+            manager.delete_expire_builds(retention)
+            cycles.append({'wall': time.time() - cycle_started_at, 'packages': len(records), 'broken': broken})
+        wall = time.time() - started_at
+    finally:
+        recorder.restore()
+        upstream.kill()
+        upstream.wait()
+        if not args.root and not args.keep:
+            shutil.rmtree(root_path, True)
+
+    received = total(DOWNLOAD_BYTES)
+    result = {'settings': vars(args), 'wall': wall, 'bytes_received': received,
+              'throughput': received / wall if wall else 0, 'retries': total(DOWNLOAD_RETRIES),
+              'resolve': RESOLVE_SECONDS.to_dict()['values'], 'md5': MD5_SECONDS.to_dict()['values'],
+              'stages': recorder.stages, 'cycles': cycles}
+    print recorder.report()
+    print '\n{0} cycles in {1:.3f}s, {2:.1f}MB received at {3:.2f}MB/s, {4} retries.'.format(
+        args.cycles, wall, received / 1024.0 / 1024, result['throughput'] / 1024 / 1024, result['retries'])
+    for i, cycle in enumerate(cycles):
+        print 'Cycle {0}: {1:.3f}s, {2} packages, {3} broken.'.format(i + 1, cycle['wall'], cycle['packages'],
+                                                                    len(cycle['broken']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run full fetch cycles against a fake upstream and measure them.')
+    parser.add_argument('--branches', type=int, default=5, help='number of branches')
+    parser.add_argument('--builds', type=int, default=3, help='number of builds of each branch')
+    parser.add_argument('--size', type=int, default=32 * 1024 * 1024, help='bytes of each package')
+    parser.add_argument('--bandwidth', type=int, default=0, help='max bytes/s of each connection, 0 is unlimited')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before answering each request')
+    parser.add_argument('--failure-rate', type=float, default=0, help='probability of a package download failing')
+    parser.add_argument('--aliased', action='store_true', help='all the branches publish the same builds')
+    parser.add_argument('--cycles', type=int, default=1, help='number of cycles, each branch gets a new build '
+                                                              'between two cycles')
+    parser.add_argument('--quota', type=int, default=0, help='the retention quota (bytes), 0 is unlimited')
+    parser.add_argument('--root', help='the dir to download into (kept), default is a temp dir')
+    parser.add_argument('--keep', action='store_true', help='keep the temp dir')
+    parser.add_argument('--output', help='write the result as json into the file, to compare the runs')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
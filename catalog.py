@@ -0,0 +1,295 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from threading import Lock
+from logging_base import Logging
+from settings import OBJECT_STORE
+from store import ObjectStore
+
+# The catalog database is saved under the root dir, hidden from the web server.
+_DB_FILE_NAME = '.catalog.db'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    branch TEXT,
+    build TEXT,
+    version TEXT,
+    platform_package TEXT,
+    size INTEGER,
+    md5 TEXT,
+    downloaded_at REAL,
+    url TEXT,
+    last_accessed REAL
+);
+CREATE INDEX IF NOT EXISTS builds_folder ON builds (folder);
+CREATE INDEX IF NOT EXISTS builds_branch_platform ON builds (branch, platform_package);
+CREATE INDEX IF NOT EXISTS builds_build ON builds (build);
+CREATE TABLE IF NOT EXISTS manifests (
+    path TEXT PRIMARY KEY,
+    entries BLOB
+);
+'''
+
+_COLUMNS = ('path', 'folder', 'file_name', 'branch', 'build', 'version', 'platform_package', 'size', 'md5',
+            'downloaded_at', 'url', 'last_accessed')
+
+
+def parse_package_name(file_name):
+    """
+    Parse the package file name, e.g. splunk-6.5.0-59c8927def0f-Linux-x86_64.tgz.
+    :return: A tuple of (product, version, build, platform_package), or None if it is not a package name.
+    """
+    parts = file_name.split('-')
+    if file_name.startswith('.') or file_name.endswith('.md5') or len(parts) < 4:
+        return None
+    return parts[0], parts[1], parts[2], '-'.join(parts[3:])
+
+
+class BuildCatalog(Logging):
+    def __init__(self, root_path):
+        """
+        The catalog of all the packages downloaded under the root path.
+        :param root_path: The root dir path to save the downloaded builds.
+        """
+        super(BuildCatalog, self).__init__()
+        self.root_path = os.path.abspath(root_path)
+        if not os.path.isdir(self.root_path):
+            os.makedirs(self.root_path)
+        db_path = os.path.join(self.root_path, _DB_FILE_NAME)
+        is_new = not os.path.isfile(db_path)
+        self._lock = Lock()
+        self._listeners = []
+        # The blobs of the packages, each package is a link to its blob.
+        self.store = ObjectStore(self.root_path) if OBJECT_STORE else None
+        # The access times not written into the database yet, see touch.
+        self._accesses = dict()
+        # The catalog is shared by the download threads and the web server thread, all access is serialized by the lock.
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+            # The catalogs created before the access time was recorded.
+            if 'last_accessed' not in [row[1] for row in self._db.execute('PRAGMA table_info(builds)')]:
+                self._db.execute('ALTER TABLE builds ADD COLUMN last_accessed REAL')
+                self._db.commit()
+        if is_new:
+            self.reconcile()
+
+    def subscribe(self, callback):
+        """
+        :param callback: Called with (event, record) after a package is added to ('add') or removed from ('remove')
+        the catalog, or accessed ('access', the record only has path and last_accessed). Notice it is called in the
+        thread which changes the catalog.
+        """
+        self._listeners.append(callback)
+
+    def replay(self, event, record):
+        """
+        Notify the listeners of a change made by another process, which shares the database (see ControlChannel).
+        """
+        self._notify(event, record)
+
+    def _notify(self, event, record):
+        for callback in self._listeners:
+            try:
+                callback(event, record)
+            except Exception, e:
+                self.logger.error('Catalog listener failed: {0}'.format(e), exc_info=True)
+
+    def relative_path(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root_path)
+
+    def add(self, file_path, branch=None, build=None, platform_package=None, size=None, md5=None, url=None,
+            downloaded_at=None):
+        """
+        Record a package which is just committed under the root path.
+        """
+        path = self.relative_path(file_path)
+        folder, file_name = os.path.split(path)
+        parsed = parse_package_name(file_name)
+        version = None
+        if parsed:
+            version = parsed[1]
+            build = build if build and build != 'latest' else parsed[2]
+            platform_package = platform_package if platform_package else parsed[3]
+        record = {'path': path, 'folder': folder, 'file_name': file_name, 'branch': branch if branch else folder,
+                  'build': build, 'version': version, 'platform_package': platform_package,
+                  'size': size if size is not None else os.path.getsize(file_path), 'md5': md5,
+                  'downloaded_at': downloaded_at if downloaded_at else time.time(), 'url': url, 'last_accessed': None}
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO builds ({0}) VALUES ({1})'.format(
+                ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))), [record[c] for c in _COLUMNS])
+            # The manifest of the package it replaces.
+            self._db.execute('DELETE FROM manifests WHERE path = ?', (path,))
+            self._db.commit()
+        self._notify('add', record)
+        return record
+
+    def remove(self, file_path):
+        """
+        Forget the package, its file should be deleted (or moved) already so that its blob is deleted if it is the
+        last link.
+        """
+        record = self.get(file_path)
+        if not record:
+            return
+        with self._lock:
+            self._db.execute('DELETE FROM builds WHERE path = ?', (record['path'],))
+            self._db.execute('DELETE FROM manifests WHERE path = ?', (record['path'],))
+            self._db.commit()
+        # The blob goes with its last package.
+        if self.store:
+            self.store.release(record['md5'])
+        self._notify('remove', record)
+
+    def touch(self, file_path, accessed_at=None):
+        """
+        Record the package is accessed (e.g. downloaded from the web server). It is only kept in memory until
+        flush_accesses is called, so it is cheap enough to call for every request.
+        """
+        record = {'path': self.relative_path(file_path), 'last_accessed': accessed_at if accessed_at else time.time()}
+        self._accesses[record['path']] = record['last_accessed']
+        self._notify('access', record)
+
+    def flush_accesses(self):
+        """
+        Write the recorded access times into the database.
+        """
+        accesses, self._accesses = self._accesses, dict()
+        if not accesses:
+            return
+        with self._lock:
+            self._db.executemany('UPDATE builds SET last_accessed = ? WHERE path = ?',
+                                 [(accessed_at, path) for path, accessed_at in accesses.items()])
+            self._db.commit()
+
+    def get(self, file_path):
+        """
+        :return: The record dict of the package, or None if it is not in the catalog.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM builds WHERE path = ?', (self.relative_path(file_path),)).fetchone()
+        return dict(row) if row else None
+
+    def set_manifest(self, file_path, entries):
+        """
+        Save the list of the files in the package (see ManifestIndexer), compressed.
+        """
+        data = zlib.compress(json.dumps(entries, separators=(',', ':')))
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO manifests (path, entries) VALUES (?, ?)',
+                             (self.relative_path(file_path), sqlite3.Binary(data)))
+            self._db.commit()
+
+    def get_manifest(self, file_path):
+        """
+        :return: The list of the files in the package, or None if it is not indexed.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT entries FROM manifests WHERE path = ?',
+                                   (self.relative_path(file_path),)).fetchone()
+        return json.loads(zlib.decompress(bytes(row[0]))) if row else None
+
+    def contains(self, file_path):
+        return self.get(file_path) is not None
+
+    def find(self, **conditions):
+        """
+        Find the packages whose columns equal to the given values, e.g. find(branch='ivory', build='59c8927def0f').
+        :return: A list of record dicts, ordered by download time.
+        """
+        for column in conditions:
+            if column not in _COLUMNS:
+                raise ValueError('Unknown column: {0}'.format(column))
+        sql = 'SELECT * FROM builds'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join('{0} = ?'.format(column) for column in conditions)
+        sql += ' ORDER BY downloaded_at'
+        with self._lock:
+            rows = self._db.execute(sql, conditions.values()).fetchall()
+        return [dict(row) for row in rows]
+
+    def query(self, conditions=None, newer_than=None, latest=False, sort='downloaded_at', descending=True, limit=None,
+              offset=0):
+        """
+        Query the packages for the listing api.
+        :param conditions: A dict maps the columns to a list of accepted values.
+        :param newer_than: Only the packages downloaded after this timestamp.
+        :param latest: If True, only the newest package of each branch and platform package.
+        :param sort: The column to sort by.
+        :return: A tuple of (the total number of matched packages, the list of record dicts in the page).
+        """
+        conditions = conditions if conditions else dict()
+        for column in conditions.keys() + [sort]:
+            if column not in _COLUMNS:
+                raise ValueError('Unknown column: {0}'.format(column))
+        where, params = [], []
+        for column, values in conditions.items():
+            where.append('{0} IN ({1})'.format(column, ', '.join('?' * len(values))))
+            params.extend(values)
+        if newer_than is not None:
+            where.append('downloaded_at > ?')
+            params.append(newer_than)
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+        sql = 'SELECT * FROM builds' + where
+        if latest:
+            sql = ('SELECT b.* FROM builds b JOIN (SELECT branch, platform_package, MAX(downloaded_at) AS newest '
+                   'FROM builds{0} GROUP BY branch, platform_package) l ON b.branch = l.branch '
+                   'AND b.platform_package = l.platform_package AND b.downloaded_at = l.newest').format(where)
+        with self._lock:
+            total = self._db.execute('SELECT COUNT(*) FROM ({0})'.format(sql), params).fetchone()[0]
+            sql += ' ORDER BY {0} {1}, path LIMIT ? OFFSET ?'.format(sort, 'DESC' if descending else 'ASC')
+            rows = self._db.execute(sql, params + [limit if limit is not None else -1, offset]).fetchall()
+        return total, [dict(row) for row in rows]
+
+    def list_folder(self, dir_path):
+        """
+        :return: A dict maps the file names to the records of the packages under the given directory.
+        """
+        folder = self.relative_path(dir_path)
+        return dict((record['file_name'], record) for record in self.find(folder='' if folder == '.' else folder))
+
+    def reconcile(self):
+        """
+        Rebuild the catalog from the packages on disk: records of missing files are deleted and files not in the
+        catalog are added (with unknown md5 and url).
+        """
+        self.logger.info('Reconcile the catalog with {0}.'.format(self.root_path))
+        records = dict((record['path'], record) for record in self.find())
+        found = set()
+        for root, dirs, files in os.walk(self.root_path):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for f in files:
+                if not parse_package_name(f):
+                    continue
+                file_path = os.path.join(root, f)
+                path = self.relative_path(file_path)
+                found.add(path)
+                stat = os.stat(file_path)
+                record = records.get(path)
+                if record and record['size'] == stat.st_size:
+                    continue
+                self.add(file_path, size=stat.st_size, downloaded_at=stat.st_ctime)
+                self.logger.info('{0} is added to the catalog.'.format(path))
+        for path in set(records) - found:
+            self.remove(os.path.join(self.root_path, path))
+            self.logger.info('{0} is removed from the catalog.'.format(path))
+        if self.store:
+            self.logger.info('{0} blobs without links are deleted.'.format(self.store.collect_garbage()))
+
+
+if __name__ == '__main__':
+    from settings import ROOT_DIR
+
+    BuildCatalog(sys.argv[1] if len(sys.argv) > 1 else ROOT_DIR).reconcile()
@@ -0,0 +1,203 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import json
+import os
+from itertools import count
+from threading import local
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.protocols.basic import LineReceiver
+from logging_base import Logging
+
+# Max bytes of one message (a json line), e.g. the metrics of the worker.
+_MAX_LINE_LENGTH = 16 * 1024 * 1024
+
+# Max seconds between two tries to connect the worker.
+_MAX_CONNECT_DELAY = 10
+
+
+class ChannelError(Exception):
+    pass
+
+
+class ControlProtocol(LineReceiver):
+    delimiter = '\n'
+    MAX_LENGTH = _MAX_LINE_LENGTH
+
+    def connectionMade(self):
+        self.factory.channel.attach(self)
+
+    def connectionLost(self, reason):
+        self.factory.channel.detach(self)
+
+    def lineReceived(self, line):
+        self.factory.channel.receive(self, line)
+
+    def lineLengthExceeded(self, line):
+        self.factory.channel.logger.error('Message of {0} bytes is too long, drop it.'.format(len(line)))
+
+    def send(self, message):
+        self.sendLine(json.dumps(message, separators=(',', ':')))
+
+
+class _ServerFactory(Factory):
+    protocol = ControlProtocol
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class _ClientFactory(ReconnectingClientFactory):
+    protocol = ControlProtocol
+    maxDelay = _MAX_CONNECT_DELAY
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return ReconnectingClientFactory.buildProtocol(self, addr)
+
+
+class ControlChannel(Logging):
+    def __init__(self, name, catalog=None, methods=None):
+        """
+        A line-delimited json channel between the web server and the worker process over a unix socket. The catalog
+        changes of each side are replayed to the listeners of the other (e.g. the directory listing cache of the web
+        server, the retention index of the worker), and each side can call the methods of the other. The changes made
+        while the other side is not connected are lost, which is fine as it loads the catalog from the database when
+        it (re)starts.
+        :param name: The name of the other side, used in the logs.
+        :param catalog: The BuildCatalog whose changes are exchanged.
+        :param methods: A dict maps the method names to the functions which the other side can call, they return the
+        json result or a Deferred of it.
+        """
+        super(ControlChannel, self).__init__()
+        self.name = name
+        self.catalog = catalog
+        self.methods = methods if methods else dict()
+        self._protocol = None
+        self._ids = count(1)
+        self._calls = dict()
+        # Set while replaying a change of the other side, so that it is not sent back.
+        self._replaying = local()
+        if catalog:
+            catalog.subscribe(self._on_catalog_changed)
+
+    def listen(self, socket_path):
+        # The socket file is left by a process which is killed.
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        reactor.listenUNIX(socket_path, _ServerFactory(self), mode=0600)
+
+    def connect(self, socket_path):
+        reactor.connectUNIX(socket_path, _ClientFactory(self))
+
+    @property
+    def connected(self):
+        return self._protocol is not None
+
+    def attach(self, protocol):
+        if self._protocol:
+            # The newest connection wins, e.g. from the restarted web server.
+            self._protocol.transport.loseConnection()
+        self._protocol = protocol
+        self.logger.info('The {0} is connected.'.format(self.name))
+
+    def detach(self, protocol):
+        if self._protocol is not protocol:
+            return
+        self._protocol = None
+        self.logger.warning('The {0} is disconnected.'.format(self.name))
+        calls, self._calls = self._calls, dict()
+        for d in calls.values():
+            d.errback(ChannelError('The {0} is disconnected.'.format(self.name)))
+
+    def call(self, method, **params):
+        """
+        Call the method of the other side.
+        :return: A Deferred fires with the result.
+        """
+        if not self._protocol:
+            return fail(ChannelError('The {0} is not connected.'.format(self.name)))
+        call_id = next(self._ids)
+        d = self._calls[call_id] = Deferred()
+        self._protocol.send({'type': 'call', 'id': call_id, 'method': method, 'params': params})
+        return d
+
+    def receive(self, protocol, line):
+        try:
+            message = json.loads(line)
+            kind = message['type']
+        except (ValueError, KeyError, TypeError):
+            self.logger.warning('Drop the invalid message: {0}'.format(line[:100]))
+            return
+        if kind == 'event':
+            self._replay(message['event'], message['record'])
+        elif kind == 'call':
+            self._answer(protocol, message)
+        elif kind == 'result':
+            d = self._calls.pop(message.get('id'), None)
+            if d is None:
+                return
+            if 'error' in message:
+                d.errback(ChannelError(message['error']))
+            else:
+                d.callback(message.get('result'))
+
+    def _answer(self, protocol, message):
+        method = self.methods.get(message.get('method'))
+        if method is None:
+            d = fail(ChannelError('Unknown method: {0}'.format(message.get('method'))))
+        else:
+            d = maybeDeferred(method, **dict((str(name), value) for name, value in message.get('params', {}).items()))
+
+        def respond(result):
+            # The answer is useless if the caller is gone.
+            if protocol is self._protocol:
+                protocol.send({'type': 'result', 'id': message.get('id'), 'result': result})
+
+        def respond_error(failure):
+            self.logger.error('Call {0} failed: {1}'.format(message.get('method'), failure.getErrorMessage()))
+            if protocol is self._protocol:
+                protocol.send({'type': 'result', 'id': message.get('id'), 'error': failure.getErrorMessage()})
+
+        d.addCallbacks(respond, respond_error)
+
+    def _on_catalog_changed(self, event, record):
+        if getattr(self._replaying, 'active', False):
+            return
+        # The catalog is changed by the download threads too.
+        reactor.callFromThread(self._send_event, event, record)
+
+    def _send_event(self, event, record):
+        if self._protocol:
+            self._protocol.send({'type': 'event', 'event': event, 'record': record})
+
+    def _replay(self, event, record):
+        if not self.catalog:
+            return
+        self._replaying.active = True
+        try:
+            self.catalog.replay(event, record)
+        finally:
+            self._replaying.active = False
+
+
+class RemoteScheduler(object):
+    def __init__(self, channel):
+        """
+        The CycleScheduler of the worker process seen from the web server, its methods return Deferreds.
+        :param channel: The ControlChannel to the worker.
+        """
+        self.channel = channel
+
+    def status(self):
+        return self.channel.call('status')
+
+    def trigger(self, branches=None):
+        return self.channel.call('trigger', branches=branches)
@@ -0,0 +1,157 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import json
+import os
+import time
+from twisted.internet.defer import succeed
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from logging_base import Logging
+from manage import BuildManager
+from metrics import CYCLE_SECONDS
+from retention import RetentionEngine
+from settings import FETCH_INTERVAL, MIN_FETCH_INTERVAL, MAX_FETCH_INTERVAL
+
+# The state of the branches is saved under the root dir, hidden from the web server.
+_STATE_FILE_NAME = '.cycle_state.json'
+
+# The seconds between two checks of whether any branch is due to poll.
+_TICK_INTERVAL = 60
+
+
+class CycleScheduler(Logging):
+    def __init__(self, root_path, catalog, engine=None, mirror=None):
+        """
+        Run the fetch cycles in the reactor: only the branches due to poll are checked and only their new builds are
+        downloaded, and a cycle never starts before the last one ends.
+        :param root_path: The root dir path to save the downloaded builds, the state is saved there.
+        :param catalog: The BuildCatalog of the root path.
+        :param engine: The FetchEngine to download the builds, if not given will download them in threads.
+        :param mirror: The PeerMirror to download the builds from the peers which have them.
+        """
+        super(CycleScheduler, self).__init__()
+        self.root_path = root_path
+        self.catalog = catalog
+        self.engine = engine
+        self.mirror = mirror
+        # Keeps the in-memory index of the packages (and their access times) across the cycles.
+        self.retention = RetentionEngine(catalog)
+        self.state_path = os.path.join(root_path, _STATE_FILE_NAME)
+        self.running = False
+        self.last_started = None
+        self.last_finished = None
+        # The branches requested while a cycle is running, True means all the branches.
+        self._pending = None
+        self._branches = dict()
+        # When no branch is known (e.g. at the start) or the cycle failed, the next one waits for this interval,
+        # which grows by half each time it happens again, so that a release server in trouble is not hammered.
+        self._retry_interval = 0
+        self._next_retry = 0
+        if os.path.isfile(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    self._branches = json.load(f)
+            except (IOError, ValueError):
+                self.logger.warning('The cycle state is broken, ignore it.')
+
+    def start(self):
+        LoopingCall(self.tick).start(_TICK_INTERVAL)
+
+    def tick(self):
+        now = time.time()
+        if self.running or now < self._next_retry:
+            return
+        # The new branches are found when the release page is checked for the known ones.
+        if self._branches and min(state['next_poll'] for state in self._branches.values()) > now:
+            return
+        self._run_cycle(lambda branch: branch not in self._branches or self._branches[branch]['next_poll'] <= now)
+
+    def trigger(self, branches=None):
+        """
+        Start a cycle now for the branches (default is all), will start after the running one if any.
+        :return: True if the cycle is started, False if it is queued.
+        """
+        if self.running:
+            if not branches or self._pending is True:
+                self._pending = True
+            else:
+                self._pending = set(self._pending if self._pending else ()) | set(branches)
+            return False
+        self._run_cycle(lambda branch: not branches or branch in branches)
+        return True
+
+    def _run_cycle(self, branch_filter):
+        self.running = True
+        self.last_started = time.time()
+        d = deferToThread(BuildManager, self.root_path, catalog=self.catalog, branch_filter=branch_filter,
+                          mirror=self.mirror)
+        d.addCallback(self._download)
+        d.addErrback(self._on_failed)
+        d.addBoth(self._finish)
+        return d
+
+    def _download(self, manager):
+        if not manager.download_branches:
+            d = succeed(None)
+        elif self.engine:
+            d = manager.download_latest_builds_async(self.engine)
+        else:
+            d = deferToThread(manager.download_latest_builds)
+        d.addCallback(lambda _: deferToThread(manager.delete_expire_builds, self.retention))
+        d.addCallback(lambda _: self._update_state(manager))
+        return d
+
+    def _on_failed(self, failure):
+        self._back_off()
+        self.logger.error('Fetch cycle failed, retry in {0:.0f}s: {1}'.format(self._retry_interval,
+                                                                           failure.getErrorMessage()))
+
+    def _back_off(self):
+        self._retry_interval = min(self._retry_interval * 1.5 if self._retry_interval else _TICK_INTERVAL,
+                                   MAX_FETCH_INTERVAL * 3600)
+        self._next_retry = time.time() + self._retry_interval
+
+    def _finish(self, _):
+        self.running = False
+        self.last_finished = time.time()
+        CYCLE_SECONDS.observe(self.last_finished - self.last_started)
+        pending, self._pending = self._pending, None
+        if pending:
+            self.trigger(None if pending is True else pending)
+
+    def _update_state(self, manager):
+        """
+        Record the latest packages of the polled branches, and adjust their intervals: halve it if a branch gets new
+        builds, otherwise grow it by half.
+        """
+        now = time.time()
+        # Forget the branches removed from the release page.
+        for branch in self._branches.keys():
+            if branch not in manager.branch_list:
+                del self._branches[branch]
+        for branch, builds in manager.get_latest_packages().items():
+            state = self._branches.get(branch)
+            if state is None:
+                state = self._branches[branch] = {'builds': builds, 'interval': FETCH_INTERVAL * 3600,
+                                                  'last_change': now}
+            elif builds != state['builds']:
+                self.logger.info('Branch {0} has new builds.'.format(branch))
+                state.update(builds=builds, last_change=now, interval=max(state['interval'] / 2,
+                                                                          MIN_FETCH_INTERVAL * 3600))
+            else:
+                state['interval'] = min(state['interval'] * 1.5, MAX_FETCH_INTERVAL * 3600)
+            state['next_poll'] = now + state['interval']
+        if self._branches:
+            self._retry_interval = self._next_retry = 0
+        else:
+            self._back_off()
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self._branches, f)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def status(self):
+        return {'running': self.running, 'last_started': self.last_started, 'last_finished': self.last_finished,
+                'branches': self._branches}
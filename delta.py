@@ -0,0 +1,274 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import hashlib
+import os
+import time
+import zlib
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The modulus of the Adler-32 check sum.
+_ADLER_BASE = 65521
+
+# Bytes read from the old package at a time while scanning it.
+_SCAN_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Bytes of the windows check summed at a time by numpy, it takes several arrays of 8 bytes per byte.
+_ROLL_BUFFER_SIZE = 1024 * 1024
+
+
+def weak_checksum(data):
+    """
+    The Adler-32 check sum of the block, which can be rolled over a file one byte at a time, see match_blocks.
+    """
+    return zlib.adler32(bytes(data)) & 0xffffffff
+
+
+def strong_checksum(data):
+    return hashlib.md5(bytes(data)).hexdigest()
+
+
+def build_index(file_path, block_size):
+    """
+    Split the package into blocks and check sum each of them, so that another node can find the blocks in its own
+    (older) package and only download the changed ones.
+    :return: A dict of the size, block size, md5 and the list of [weak check sum, strong check sum] of each block.
+    """
+    blocks = []
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            md5.update(block)
+            blocks.append([weak_checksum(block), strong_checksum(block)])
+    return {'file_name': os.path.basename(file_path), 'size': os.path.getsize(file_path), 'block_size': block_size,
+            'md5': md5.hexdigest(), 'blocks': blocks}
+
+
+def _match(blocks, found, numbers, block):
+    """
+    :param numbers: The numbers of the blocks of the index with the same weak check sum as the block.
+    :return: The numbers of them (not found yet) which equal to the block.
+    """
+    strong_sum = strong_checksum(block)
+    return [number for number in numbers if number not in found and blocks[number][1] == strong_sum]
+
+
+def match_blocks(file_path, index, timeout=0):
+    """
+    Find the blocks of the index in the file, at any offset (the rsync algorithm). The blocks at the aligned offsets of
+    the file are check summed first by zlib, which finds the blocks not moved at the speed of the disk. Then a window of
+    the block size is rolled one byte at a time over the missed parts only, a block found there is jumped over, so that
+    a shifted (e.g. by an insertion) run of blocks costs one check sum per block. The windows are check summed by numpy
+    if it is installed, otherwise rolling is slow in python (about 1MB/s), which only pays off if little is changed.
+    The last block of the index is only looked for at the end of the file if it is shorter than the others.
+    :param timeout: Stop looking after these seconds, 0 means never.
+    :return: A dict maps the numbers of the found blocks to their offsets in the file.
+    """
+    block_size = index['block_size']
+    blocks = index['blocks']
+    full_blocks = index['size'] // block_size
+    weak = defaultdict(list)
+    for number, (weak_sum, strong_sum) in enumerate(blocks[:full_blocks]):
+        weak[weak_sum].append(number)
+    found = dict()
+    file_size = os.path.getsize(file_path)
+    tail_size = index['size'] % block_size
+    if tail_size and file_size >= tail_size:
+        with open(file_path, 'rb') as f:
+            f.seek(file_size - tail_size)
+            if strong_checksum(f.read(tail_size)) == blocks[-1][1]:
+                found[len(blocks) - 1] = file_size - tail_size
+    # The number of the full blocks not found yet.
+    remaining = full_blocks
+    deadline = time.time() + timeout if timeout else None
+    # The [start, end) offsets of the runs of the aligned blocks not found.
+    misses = []
+    with open(file_path, 'rb') as f:
+        offset = 0
+        read_size = max(_SCAN_BUFFER_SIZE // block_size, 1) * block_size
+        while remaining and not (deadline and time.time() > deadline):
+            chunk = f.read(read_size)
+            for position in xrange(0, len(chunk) - block_size + 1, block_size):
+                block = buffer(chunk, position, block_size)
+                numbers = weak.get(weak_checksum(block))
+                matched = _match(blocks, found, numbers, block) if numbers else None
+                if matched:
+                    for number in matched:
+                        found[number] = offset + position
+                    remaining -= len(matched)
+                elif misses and misses[-1][1] == offset + position:
+                    misses[-1][1] += block_size
+                else:
+                    misses.append([offset + position, offset + position + block_size])
+            if len(chunk) < read_size:
+                break
+            offset += len(chunk)
+        roll = _roll_numpy if numpy is not None else _roll
+        for start, end in misses:
+            if not remaining or (deadline and time.time() > deadline):
+                break
+            remaining -= roll(f, start, min(end, file_size - block_size + 1), block_size, weak, blocks, found, deadline)
+    return found
+
+
+def _roll(f, start, stop, block_size, weak, blocks, found, deadline):
+    """
+    Roll the window over the offsets [start, stop) of the file.
+    :return: The number of the blocks found.
+    """
+    count = 0
+    # The window could reach a block beyond stop.
+    end = stop + block_size - 1
+    f.seek(start)
+    # The offset of data in the file, and the offset of the window in data.
+    data, base, position = bytearray(), start, 0
+    while base + position < stop:
+        if len(data) - position <= block_size:
+            if deadline and time.time() > deadline:
+                break
+            chunk = f.read(max(min(_SCAN_BUFFER_SIZE, end - base - len(data)), 0))
+            data = data[position:] + bytearray(chunk)
+            base += position
+            position = 0
+        if len(data) - position < block_size:
+            break
+        weak_sum = weak_checksum(data[position:position + block_size])
+        a, b = weak_sum & 0xffff, weak_sum >> 16
+        limit = min(len(data) - block_size, stop - 1 - base)
+        matched = None
+        while True:
+            numbers = weak.get((b << 16) | a)
+            if numbers:
+                matched = _match(blocks, found, numbers, data[position:position + block_size])
+                if matched:
+                    break
+            if position >= limit:
+                break
+            # Roll the window one byte forward.
+            removed, added = data[position], data[position + block_size]
+            a = (a - removed + added) % _ADLER_BASE
+            b = (b - block_size * removed + a - 1) % _ADLER_BASE
+            position += 1
+        if matched:
+            for number in matched:
+                found[number] = base + position
+            count += len(matched)
+            # Jump over the found block.
+            position += block_size
+        else:
+            position += 1
+    return count
+
+
+def _roll_numpy(f, start, stop, block_size, weak, blocks, found, deadline):
+    """
+    The same as _roll, but the weak check sums of all the windows in a buffer are computed at once from the prefix sums
+    of the bytes, only the windows whose check sums are in the index are looked at one by one.
+    """
+    count = 0
+    keys = numpy.array(sorted(weak), dtype=numpy.int64)
+    # Whether any key has the low 16 bits (a), most windows are ruled out by a lookup in it.
+    low_bits = numpy.zeros(1 << 16, dtype=bool)
+    low_bits[keys & 0xffff] = True
+    position = start
+    while position < stop:
+        if deadline and time.time() > deadline:
+            break
+        f.seek(position)
+        # After a shift the following blocks are usually found one after another, check them directly first.
+        block = f.read(block_size)
+        numbers = weak.get(weak_checksum(block))
+        matched = _match(blocks, found, numbers, block) if numbers else None
+        if matched:
+            for number in matched:
+                found[number] = position
+            count += len(matched)
+            position += block_size
+            continue
+        f.seek(position)
+        data = f.read(min(_ROLL_BUFFER_SIZE, stop - position) + block_size - 1)
+        windows = len(data) - block_size + 1
+        if windows <= 0:
+            break
+        values = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+        sum1 = numpy.concatenate(([0], numpy.cumsum(values)))
+        sum2 = numpy.concatenate(([0], numpy.cumsum(values * numpy.arange(len(values), dtype=numpy.int64))))
+        ends = numpy.arange(block_size, windows + block_size, dtype=numpy.int64)
+        sums = sum1[ends] - sum1[:windows]
+        # a = 1 + the sum of the bytes, b = the sum of a after each byte, i.e. each byte weighted by its distance to
+        # the end of the window.
+        a = (1 + sums) % _ADLER_BASE
+        b = (block_size + ends * sums - (sum2[ends] - sum2[:windows])) % _ADLER_BASE
+        candidates = numpy.flatnonzero(low_bits[a])
+        weak_sums = (b[candidates] << 16) | a[candidates]
+        hits = keys[numpy.minimum(numpy.searchsorted(keys, weak_sums), len(keys) - 1)] == weak_sums
+        # The windows after a found block start after it.
+        skip_to = 0
+        for window, weak_sum in zip(candidates[hits], weak_sums[hits]):
+            if window < skip_to:
+                continue
+            matched = _match(blocks, found, weak[int(weak_sum)], buffer(data, window, block_size))
+            if matched:
+                for number in matched:
+                    found[number] = position + window
+                count += len(matched)
+                skip_to = window + block_size
+        position += max(windows, skip_to)
+    return count
+
+
+def missing_ranges(index, found, max_ranges):
+    """
+    :param found: The dict maps the numbers of the found blocks to their offsets, see match_blocks.
+    :param max_ranges: The ranges separated by the smallest gaps are merged until there are no more than this many.
+    :return: The sorted list of the (start, end) byte ranges of the package which are not found.
+    """
+    block_size = index['block_size']
+    ranges = []
+    for number in xrange(len(index['blocks'])):
+        if number in found:
+            continue
+        start, end = number * block_size, min((number + 1) * block_size, index['size']) - 1
+        if ranges and ranges[-1][1] + 1 == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    if len(ranges) > max_ranges:
+        # Fetching a few found blocks again is cheaper than a request for each range.
+        gaps = sorted(xrange(len(ranges) - 1), key=lambda i: ranges[i + 1][0] - ranges[i][1])
+        merged = set(gaps[:len(ranges) - max_ranges])
+        result = []
+        for i, byte_range in enumerate(ranges):
+            if i - 1 in merged:
+                result[-1][1] = byte_range[1]
+            else:
+                result.append(byte_range)
+        ranges = result
+    return [tuple(byte_range) for byte_range in ranges]
+
+
+def copy_blocks(file_path, file_object, index, found):
+    """
+    Copy the found blocks from the old package into their places in the new one.
+    :return: The number of copied bytes.
+    """
+    block_size = index['block_size']
+    copied = 0
+    with open(file_path, 'rb') as f:
+        for number, offset in sorted(found.items(), key=lambda item: item[1]):
+            length = min(block_size, index['size'] - number * block_size)
+            f.seek(offset)
+            file_object.seek(number * block_size)
+            file_object.write(f.read(length))
+            copied += length
+    return copied
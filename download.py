@@ -4,35 +4,170 @@
 @since: 6/14/16
 '''
 import os
+import ctypes
+import ctypes.util
+import json
 import requests
 import hashlib
 import time
+from collections import deque
+from urllib import urlencode
+from threading import Thread, Lock
 from requests.adapters import HTTPAdapter
 from settings import MAX_DOWNLOAD_TRY
+from catalog import parse_package_name
+from delta import match_blocks, missing_ranges, copy_blocks
 from logging_base import Logging
-from settings import MAX_CONCURRENT_THREADS, RECORD_DOWNLOAD_SPEED, RECORD_DOWNLOAD_INTERVAL
+from metrics import TRANSFERS, DOWNLOAD_BYTES, DOWNLOADS, DOWNLOAD_RETRIES, RESOLVE_SECONDS, MD5_SECONDS, \
+    STORE_LINKED_BYTES, DELTA_REUSED_BYTES
+from scheduler import BANDWIDTH, HOSTS
+from settings import MAX_CONCURRENT_THREADS, RECORD_DOWNLOAD_SPEED, RECORD_DOWNLOAD_INTERVAL, DOWNLOAD_SEGMENTS, \
+    MIN_SEGMENT_SIZE, DOWNLOAD_CHUNK_SIZE, WRITE_BUFFER_SIZE, STAGING_DIR, RELEASE_SERVER, DELTA_DOWNLOAD, \
+    DELTA_MAX_RANGES, DELTA_SCAN_TIMEOUT
 
 _SESSION = requests.session()
-_SESSION.mount('http', HTTPAdapter(pool_maxsize=2 * MAX_CONCURRENT_THREADS, pool_connections=MAX_CONCURRENT_THREADS))
+# Every download thread may hold one connection per segment plus one for the probe/md5 request, so size the pool to
+# make sure segments of one package never wait for connections held by another package.
+_SESSION.mount('http', HTTPAdapter(pool_maxsize=MAX_CONCURRENT_THREADS * (max(DOWNLOAD_SEGMENTS, 1) + 1),
+                                   pool_connections=MAX_CONCURRENT_THREADS))
+
+
+# The partial download state is saved at most once per this many seconds while downloading.
+_PARTIAL_SAVE_INTERVAL = 5
+
+
+def _load_fallocate():
+    """
+    :return: The posix_fallocate of the libc (python 2 has no os.posix_fallocate), or None if it is not available, e.g.
+    on Windows or Mac.
+    """
+    library = ctypes.util.find_library('c')
+    if not library:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+    except OSError:
+        return None
+    # The 64 bits version takes the 64 bits offsets on the 32 bits systems too.
+    for name in ('posix_fallocate64', 'posix_fallocate'):
+        fallocate = getattr(libc, name, None)
+        if fallocate is not None:
+            fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            fallocate.restype = ctypes.c_int
+            return fallocate
+    return None
+
+
+_FALLOCATE = _load_fallocate()
+
+
+def preallocate(file_object, size):
+    """
+    Reserve the disk space of the file, so that it will not be fragmented by the concurrent writes. It is only extended
+    as a sparse file if posix_fallocate is not available (or not supported by the file system).
+    """
+    if _FALLOCATE is not None:
+        # It returns the error number instead of setting errno, the failure is not fatal.
+        _FALLOCATE(file_object.fileno(), 0, size)
+    file_object.truncate(size)
+
+
+def parse_remote_info(status_code, headers):
+    """
+    :param headers: The response headers of a HEAD request, as a dict with lower case names.
+    :return: A dict contains the size, range support and validators (ETag/Last-Modified) of the url.
+    """
+    info = {'size': None, 'accept_ranges': False, 'etag': None, 'last_modified': None}
+    if status_code != 200:
+        return info
+    size = headers.get('content-length')
+    info['size'] = int(size) if size and size.isdigit() else None
+    info['accept_ranges'] = headers.get('accept-ranges', '').lower() == 'bytes'
+    info['etag'] = headers.get('etag')
+    info['last_modified'] = headers.get('last-modified')
+    return info
+
+
+class StreamDigest(object):
+    """
+    The md5 digest of the first `offset` bytes of a file, updated in order while the file is being written.
+    """
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self.offset = 0
+
+    def update(self, chunk):
+        self._md5.update(chunk)
+        self.offset += len(chunk)
+
+    def update_from_file(self, file_path, end=None):
+        """
+        Read the bytes after the current offset (until the end offset or EOF) from the file and digest them.
+        """
+        block_size = 2 ** 20
+        with MD5_SECONDS.time(stage='digest'), open(file_path, 'rb') as f:
+            f.seek(self.offset)
+            while end is None or self.offset < end:
+                buf = f.read(block_size if end is None else min(block_size, end - self.offset))
+                if not buf:
+                    break
+                self.update(buf)
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class PartialExpired(Exception):
+    """
+    Raised when the package on the server has changed since the partial file was downloaded.
+    """
+    pass
 
 
 class BuildDownloader(Logging):
-    def __init__(self, dir_path, platform_package, branch=None, build=None, package_type=None):
+    def __init__(self, dir_path, platform_package, branch=None, build=None, package_type=None, staging_path=None,
+                 catalog=None, resolver=None, mirror=None, url=None):
         """
         :param file_path: The target download directory.
         :param branch: default is current branch.
         :param build: default is latest build.
         :param package_type: default is splunk.
+        :param staging_path: The directory to put the package in downloading, default is STAGING_DIR.
+        :param catalog: The BuildCatalog to record the downloaded package, if not given will check the file system.
+        :param resolver: The UrlResolver caches the package url and md5 check sum across cycles.
+        :param mirror: The PeerMirror to download the package from a peer which has it.
+        :param url: The package url if it is known already, e.g. to download a recorded package again.
         """
         self.platform_package = platform_package
         self.branch = branch if branch else 'current'
         self.build = build if build else 'latest'
         self.package_type = package_type if package_type else 'splunk'
         self.dir_path = dir_path
+        self.staging_path = staging_path if staging_path else STAGING_DIR
+        self.catalog = catalog
+        self.resolver = resolver
+        self.mirror = mirror
+        self.url = url
+        # The TransferProgress of the package in downloading.
+        self.progress = None
+        # Download the package as a delta against the previous build, turned off once a delta is found broken.
+        self.delta = DELTA_DOWNLOAD
         self._downloaded_size = 0
-        self._record_time = 0
+        self._record_time = None
+        self._record_lock = Lock()
+        self._partial_lock = Lock()
+        self._partial_save_time = 0
         super(BuildDownloader, self).__init__()
 
+    @property
+    def key(self):
+        return '{0}-{1}-{2}-{3}'.format(self.package_type, self.branch, self.build, self.platform_package)
+
     @property
     def _logger_name(self):
         return self.__class__.__name__ + '({0}-{1}-{2}-{3})'.format(self.package_type, self.branch, self.build,
@@ -43,77 +178,198 @@ class BuildDownloader(Logging):
         Download the package and check its md5 check sum.
         :return: True if download successfully.
         """
-        url = self._get_url_from_splunk_build_fetcher()
-        file_name = url.split('/')[-1]
-        file_path = os.path.join(self.dir_path, file_name)
-        tmp_path = os.path.join('/tmp', file_name)
+        url = self.resolve_url()
+        file_name, file_path, tmp_path = self.get_paths(url)
         # Return if already downloaded.
-        if os.path.isfile(file_path):
+        if self.is_downloaded(file_path):
             self.logger.info('Package exists already, skip downloading.')
             return True
-        # Make dir folder if not exist.
-        if not os.path.isdir(self.dir_path):
-            os.makedirs(self.dir_path)
-        # Must open the destination file in binary mode to ensure python doesn't try and translate newlines for you.
-        with open(tmp_path, mode='wb') as f:
+        self.make_dirs()
+        check_sum = None
+        if self.store:
+            # Check the md5 before the transfer, a package in the store already is linked instead of downloaded.
             try:
-                self.download_from_url(url, f)
+                check_sum = self.get_md5(url)
             except Exception, e:
-                self.logger.error('Exception during download: {0}'.format(e.message))
-                os.remove(tmp_path)
+                self.logger.warning('Get md5 check sum failed, can not look up the store: {0}'.format(e))
+            if check_sum and self._link_or_claim(check_sum, file_path, url):
+                return True
+        try:
+            return self._download_package(url, file_path, tmp_path, check_sum)
+        finally:
+            if check_sum:
+                self.store.unclaim(check_sum)
+
+    def _link_or_claim(self, check_sum, file_path, url):
+        """
+        Link the package from the store, or claim its download if no one else is downloading the same bytes.
+        :return: True if linked, False if claimed.
+        """
+        while True:
+            if self.link_from_store(check_sum, file_path, url):
+                return True
+            waiting = self.store.claim(check_sum)
+            if waiting is None:
                 return False
-        check_sum = self.get_md5(url)
-        if self.check_md5(tmp_path, check_sum):
-            os.rename(tmp_path, file_path)
-            self.logger.info('{0} ==> Download package successfully.'.format(file_name))
+            self.logger.info('Package with the same md5 is in downloading, wait for it.')
+            waiting.wait()
+
+    def _download_package(self, url, file_path, tmp_path, check_sum=None):
+        source_url, peer_check_sum = self.locate(url)
+        check_sum = check_sum if check_sum else peer_check_sum
+        # Fetch the md5 check sum while the package is downloading.
+        get_check_sum = (lambda: check_sum) if check_sum else self._get_md5_async(url)
+        self.progress = TRANSFERS.start(self.key, source_url)
+        try:
+            file_check_sum = self.download_from_url(source_url, tmp_path)
+            check_sum = get_check_sum()
+        except Exception, e:
+            self.logger.error('Exception during download: {0!r}'.format(e))
+            # Keep the partial file to resume from if its state is recorded, otherwise it is useless.
+            if not os.path.isfile(self._partial_path(tmp_path)) and os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return False
+        finally:
+            TRANSFERS.finish(self.progress)
+        self.discard_partial(tmp_path, keep_file=True)
+        if self.verify_md5(file_check_sum, check_sum):
+            self.commit(tmp_path, file_path)
+            self.record(file_path, url, file_check_sum)
             return True
         else:
             os.remove(tmp_path)
+            self.delta = False
             return False
 
-    def _get_url_from_splunk_build_fetcher(self):
+    @property
+    def store(self):
+        return self.catalog.store if self.catalog else None
+
+    def link_from_store(self, check_sum, file_path, url):
+        """
+        Link the package from the store if it has the md5 check sum.
+        :return: True if linked.
+        """
+        if not self.store or not self.store.link(check_sum, file_path):
+            return False
+        self.logger.info('Package with the same md5 is in the store, link it instead of downloading.')
+        STORE_LINKED_BYTES.inc(os.path.getsize(file_path))
+        self.record(file_path, url, check_sum)
+        return True
+
+    def locate(self, url):
+        """
+        :return: A tuple of (the url to download the package from, its md5 check sum if known). The package is
+        downloaded from the nearest mirror peer which has it, otherwise from the url.
+        """
+        found = self.mirror.locate(url.split('/')[-1]) if self.mirror else None
+        if found:
+            self.logger.info('Found the package in the mirror peer: {0}'.format(found[0]))
+            return found
+        return url, None
+
+    def get_paths(self, url):
+        """
+        :return: A tuple of (file name, target file path, staging file path) of the package url.
+        """
+        file_name = url.split('/')[-1]
+        # The same package could be downloaded into several folders at the same time, stage them separately.
+        tmp_name = '{0}--{1}'.format(os.path.basename(os.path.normpath(self.dir_path)), file_name)
+        return file_name, os.path.join(self.dir_path, file_name), os.path.join(self.staging_path, tmp_name)
+
+    def make_dirs(self):
+        # Make dir folder if not exist.
+        for path in (self.dir_path, self.staging_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def record(self, file_path, url, check_sum):
+        """
+        Record the committed package in the catalog, and keep it in the store.
+        """
+        if self.store:
+            self.store.add(file_path, check_sum)
+        if self.catalog:
+            self.catalog.add(file_path, branch=self.branch, build=self.build, platform_package=self.platform_package,
+                             md5=check_sum, url=url)
+        DOWNLOADS.inc(result='success')
+        self.logger.info('{0} ==> Download package successfully.'.format(os.path.basename(file_path)))
+
+    def is_downloaded(self, file_path):
+        """
+        A package recorded by the catalog counts only if it is still on disk, e.g. it may have been deleted by hand.
+        """
+        if self.catalog and not self.catalog.contains(file_path):
+            return False
+        return os.path.isfile(file_path)
+
+    @staticmethod
+    def commit(tmp_path, file_path):
+        """
+        Flush the downloaded package to disk and move it into place atomically.
+        """
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.rename(tmp_path, file_path)
+
+    def get_fetcher_url(self):
         '''
-        Returns the URL for the specified package using splunk_build_fetcher script.
+        Returns the URL of splunk_build_fetcher script to query the specified package.
 
-        @return: The URL.
         @rtype: str
         '''
-        rURL = 'http://releases.splunk.com/'
+        rURL = RELEASE_SERVER + '/'
         tURI = 'cgi-bin/splunk_build_fetcher.py?'
 
         # TODO: temp solution for hunk beta not available on splunk_build_fetcher.
         if self.package_type == 'hunkbeta':
             tURI = 'cgi-bin/build_fetcher.py?'
 
-        pTag = 'PLAT_PKG='
-        dTag = 'DELIVER_AS=url'
-        vTag = 'VERSION='
-        cTag = 'P4CHANGE='
-        bTag = 'BRANCH='
-        productTag = 'PRODUCT='
-        ufTag = 'UF='
-
+        # The values could be given by the web clients (see /pull), they are escaped so that none of them can add or
+        # change the other arguments.
+        params = [('DELIVER_AS', 'url')]
         # handle UNIVERSAL_FORWARDER differently because in splunk_build_fetcher
         # there is no product named UNIVERSAL_FORWARDER.
         if self.package_type == 'universalforwarder':
-            url = ''.join((rURL, tURI, dTag,
-                           '&', pTag, self.platform_package,
-                           '&', bTag, self.branch,
-                           '&', ufTag, '1'))
+            params += [('PLAT_PKG', self.platform_package), ('BRANCH', self.branch), ('UF', '1')]
         else:
-            url = ''.join((rURL, tURI, dTag,
-                           '&', productTag, self.package_type,
-                           '&', pTag, self.platform_package,
-                           '&', bTag, self.branch))
+            params += [('PRODUCT', self.package_type), ('PLAT_PKG', self.platform_package), ('BRANCH', self.branch)]
 
         if self.build != 'latest':
-            url += '&' + cTag + str(self.build)
+            params.append(('P4CHANGE', str(self.build)))
+        return rURL + tURI + urlencode(params)
 
+    def resolve_url(self):
+        """
+        Returns the package url from the resolver cache, ask the build fetcher if it is not cached.
+        """
+        if self.url:
+            return self.url
+        start = time.time()
+        url = self.resolver.get_url(self) if self.resolver else None
+        if url:
+            self.logger.debug('Get url from the resolver cache: {0}'.format(url))
+            RESOLVE_SECONDS.observe(time.time() - start, source='cache')
+            return url
+        url = self._get_url_from_splunk_build_fetcher()
+        RESOLVE_SECONDS.observe(time.time() - start, source='fetcher')
+        if self.resolver:
+            self.resolver.set_url(self, url)
+        return url
+
+    def _get_url_from_splunk_build_fetcher(self):
+        '''
+        Returns the URL for the specified package using splunk_build_fetcher script.
+
+        @return: The URL.
+        @rtype: str
+        '''
+        url = self.get_fetcher_url()
         self.logger.debug("Get url from splunk build fetcher: %s" % url)
 
         for i in range(12):
             try:
-                response = requests.get(url)
+                response = _SESSION.get(url)
                 assert response.status_code == 200
                 return response.content.rstrip()
             except Exception, e:
@@ -122,48 +378,384 @@ class BuildDownloader(Logging):
         else:
             raise Exception("Get url failed after 60s.")
 
-    def download_from_url(self, url, file_object):
-        # NOTE the stream=True parameter
-        response = _SESSION.get(url, stream=True)
-        assert response.status_code == 200
-        self.logger.info('Start downloading from {0}'.format(url))
-        chunk_size = 1024
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            if RECORD_DOWNLOAD_SPEED:
-                self.record_download_speed(chunk_size)
+    def download_from_url(self, url, file_path):
+        """
+        Download the url to the given file path. If the server supports range requests, the package is split into
+        several concurrent segments and the download resumes from the partial file left by a previous try.
+        :return: The md5 check sum of the downloaded file.
+        """
+        remote = self._get_remote_info(url)
+        if remote['size'] is not None and remote['accept_ranges']:
+            state = self.load_partial(file_path, url, remote)
+            if state is None and self.delta:
+                state = self.create_delta_partial(file_path, url, remote)
+            if state is None:
+                segments = DOWNLOAD_SEGMENTS if remote['size'] >= MIN_SEGMENT_SIZE else 1
+                state = self.create_partial(file_path, url, remote, max(segments, 1))
+            self.set_progress(remote['size'], self.partial_received(state))
+            try:
+                return self.download_segments(url, file_path, state)
+            except RangeNotSupported:
+                self.logger.warning('Server does not support range requests, fall back to a single stream.')
+            except PartialExpired:
+                self.logger.warning('Package changed on the server, discard the partial file.')
+                self.discard_partial(file_path)
+                raise
+        self.discard_partial(file_path)
+        self.set_progress(remote['size'])
+        # Must open the destination file in binary mode to ensure python doesn't try and translate newlines for you.
+        digest = StreamDigest()
+        with open(file_path, 'wb', WRITE_BUFFER_SIZE) as f:
+            self.download_stream(url, f, digest)
+        return digest.hexdigest()
+
+    def _get_remote_info(self, url):
+        """
+        :return: A dict contains the size, range support and validators (ETag/Last-Modified) of the url.
+        """
+        response = _SESSION.head(url, allow_redirects=True)
+        return parse_remote_info(response.status_code, response.headers)
+
+    @staticmethod
+    def _partial_path(file_path):
+        return file_path + '.part'
+
+    @staticmethod
+    def partial_received(state):
+        """
+        :return: The bytes of the partial download in place, i.e. downloaded by the previous tries or copied from the
+        previous build.
+        """
+        return state['size'] - sum(segment[1] - segment[0] + 1 - segment[2] for segment in state['segments'])
+
+    def load_partial(self, file_path, url, remote):
+        """
+        Load the recorded state of a partial download.
+        :return: The state dict, or None if no usable partial file exists (an outdated one will be discarded).
+        """
+        partial_path = self._partial_path(file_path)
+        if not os.path.isfile(partial_path) or not os.path.isfile(file_path):
+            self.discard_partial(file_path)
+            return None
+        try:
+            with open(partial_path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            self.discard_partial(file_path)
+            return None
+        if state.get('size') != remote['size'] or os.path.getsize(file_path) != remote['size']:
+            self.logger.info('Size of the partial file does not match the server, discard it.')
+            self.discard_partial(file_path)
+            return None
+        # Only discard the partial file if the server's validator has changed.
+        for validator in ('etag', 'last_modified'):
+            if state.get(validator) or remote[validator]:
+                if state.get(validator) != remote[validator]:
+                    self.logger.info('The {0} of the package has changed, discard the partial file.'.format(validator))
+                    self.discard_partial(file_path)
+                    return None
+                break
+        # The partial file of the same name could be downloaded from another server, e.g. a peer.
+        if state.get('url') != url:
+            self.logger.info('The partial file is downloaded from {0}, discard it.'.format(state.get('url')))
+            self.discard_partial(file_path)
+            return None
+        done = sum(segment[2] for segment in state['segments'])
+        self.logger.info('Resume downloading from {0}/{1} bytes.'.format(done, state['size']))
+        return state
+
+    def create_partial(self, file_path, url, remote, segments):
+        """
+        Preallocate the file and record the state of a new partial download.
+        """
+        size = remote['size']
+        with open(file_path, mode='wb') as f:
+            preallocate(f, size)
+        segment_size = max(-(-size // segments), 1)
+        state = {'url': url, 'size': size, 'etag': remote['etag'], 'last_modified': remote['last_modified'],
+                 'segments': [[start, min(start + segment_size, size) - 1, 0] for start in xrange(0, size, segment_size)]}
+        self.save_partial(file_path, state)
+        return state
+
+    def find_delta_base(self, file_name):
+        """
+        :return: The path of the newest package of the same product, branch and platform in the catalog, or None.
+        """
+        parsed = parse_package_name(file_name)
+        if not self.catalog or not parsed:
+            return None
+        records = self.catalog.find(branch=self.branch, platform_package=self.platform_package)
+        for record in reversed(records):
+            base = parse_package_name(record['file_name'])
+            file_path = os.path.join(self.catalog.root_path, record['path'])
+            if record['file_name'] != file_name and base and base[0] == parsed[0] and os.path.isfile(file_path):
+                return file_path
+        return None
+
+    def create_delta_partial(self, file_path, url, remote):
+        """
+        Copy the blocks of the package found in the previous build (by the block index from a mirror peer) into the
+        preallocated file, and record the state of a partial download of the other ranges.
+        :return: The state dict, or None if the package can not be downloaded as a delta.
+        """
+        file_name = url.split('/')[-1]
+        base_path = self.find_delta_base(file_name)
+        if not base_path or not self.mirror:
+            return None
+        try:
+            index = self.mirror.get_block_index(file_name)
+            if not index or index['size'] != remote['size']:
+                return None
+            start = time.time()
+            found = match_blocks(base_path, index, DELTA_SCAN_TIMEOUT)
+            if not found:
+                self.logger.info('No block is found in {0}, download in full.'.format(os.path.basename(base_path)))
+                return None
+            with open(file_path, mode='wb') as f:
+                preallocate(f, remote['size'])
+                copy_blocks(base_path, f, index, found)
+            ranges = missing_ranges(index, found, DELTA_MAX_RANGES)
+            state = {'url': url, 'size': remote['size'], 'etag': remote['etag'],
+                     'last_modified': remote['last_modified'], 'segments': [[s, e, 0] for s, e in ranges]}
+            self.save_partial(file_path, state)
+        except Exception, e:
+            self.logger.warning('Prepare the delta download failed: {0}'.format(e))
+            self.discard_partial(file_path)
+            return None
+        reused = self.partial_received(state)
+        DELTA_REUSED_BYTES.inc(reused)
+        self.logger.info('Reuse {0}/{1} bytes of {2} (found in {3:.1f}s), download the other {4} ranges.'.format(
+            reused, remote['size'], os.path.basename(base_path), time.time() - start, len(ranges)))
+        return state
+
+    def _partial_save_due(self):
+        """
+        :return: True at most once per _PARTIAL_SAVE_INTERVAL.
+        """
+        with self._partial_lock:
+            now = time.time()
+            if now < self._partial_save_time:
+                return False
+            self._partial_save_time = now + _PARTIAL_SAVE_INTERVAL
+            return True
+
+    def save_partial(self, file_path, state):
+        """
+        Save the state of the partial download next to it.
+        """
+        with self._partial_lock:
+            partial_path = self._partial_path(file_path)
+            with open(partial_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.rename(partial_path + '.tmp', partial_path)
+
+    def discard_partial(self, file_path, keep_file=False):
+        partial_path = self._partial_path(file_path)
+        if os.path.isfile(partial_path):
+            os.remove(partial_path)
+        if not keep_file and os.path.isfile(file_path):
+            os.remove(file_path)
+
+    def download_segments(self, url, file_path, state):
+        """
+        Download the unfinished byte ranges recorded in the state concurrently, each segment writes to its own region
+        of the preallocated file.
+        :return: The md5 check sum of the downloaded file.
+        """
+        segments = [segment for segment in state['segments'] if segment[0] + segment[2] <= segment[1]]
+        self.logger.info('Start downloading from {0} in {1} segments'.format(url, len(segments)))
+        errors = []
+        # The first segment is digested while downloading, the others are read back from the file afterwards.
+        digest = StreamDigest()
+        # A delta download could have more segments than threads, each thread downloads them one after another.
+        pending = deque(segments)
+
+        def download_pending():
+            while True:
+                try:
+                    segment = pending.popleft()
+                except IndexError:
+                    return
+                self._download_segment(url, file_path, state, segment, errors, digest if segment[0] == 0 else None)
+
+        threads = [Thread(target=download_pending) for _ in range(min(len(segments), max(DOWNLOAD_SEGMENTS, 1)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.save_partial(file_path, state)
+        for error_type in (PartialExpired, RangeNotSupported, Exception):
+            for e in errors:
+                if isinstance(e, error_type):
+                    raise e
+        digest.update_from_file(file_path)
+        return digest.hexdigest()
+
+    def _download_segment(self, url, file_path, state, segment, errors, digest=None):
+        start, end = segment[0] + segment[2], segment[1]
+        headers = {'Range': 'bytes={0}-{1}'.format(start, end)}
+        validator = state.get('etag') or state.get('last_modified')
+        if segment[2] and validator:
+            headers['If-Range'] = validator
+        try:
+            if digest:
+                # Digest the part downloaded by the previous tries first.
+                digest.update_from_file(file_path, end=start)
+            with HOSTS.slot(url):
+                self._download_segment_response(url, file_path, state, segment, headers, digest)
+            if segment[0] + segment[2] <= end:
+                raise Exception('Segment {0}-{1} is truncated at {2}.'.format(segment[0], end, segment[0] + segment[2]))
+        except Exception, e:
+            errors.append(e)
+
+    def _download_segment_response(self, url, file_path, state, segment, headers, digest):
+        start, end = segment[0] + segment[2], segment[1]
+        response = _SESSION.get(url, stream=True, headers=headers)
+        try:
+            if response.status_code == 200 and 'If-Range' in headers:
+                raise PartialExpired()
+            if response.status_code != 206:
+                raise RangeNotSupported()
+            if not response.headers.get('content-range', '').startswith('bytes {0}-{1}/'.format(start, end)):
+                raise Exception('Unexpected content range: {0}'.format(response.headers.get('content-range')))
+            with open(file_path, 'r+b', WRITE_BUFFER_SIZE) as f:
+                f.seek(start)
+                # Only the bytes flushed out of the write buffer are recorded as done.
+                pending = [0]
+
+                def on_write(length):
+                    pending[0] += length
+                    if self._partial_save_due():
+                        f.flush()
+                        segment[2] += pending[0]
+                        pending[0] = 0
+                        self.save_partial(file_path, state)
+
+                try:
+                    self._write_response(response, f, on_write, digest)
+                finally:
+                    f.flush()
+                    segment[2] += pending[0]
+        finally:
+            response.close()
+
+    def download_stream(self, url, file_object, digest=None):
+        with HOSTS.slot(url):
+            # NOTE the stream=True parameter
+            response = _SESSION.get(url, stream=True)
+            assert response.status_code == 200
+            self.logger.info('Start downloading from {0}'.format(url))
+            size = response.headers.get('content-length')
+            if size and size.isdigit():
+                preallocate(file_object, int(size))
+            received = self._write_response(response, file_object, digest=digest)
+            response.close()
+        file_object.truncate(received)
+        if size and size.isdigit() and received != int(size):
+            raise Exception('Package is truncated, only {0}/{1} bytes received.'.format(received, size))
+        return True
+
+    def _write_response(self, response, file_object, on_write=None, digest=None):
+        """
+        Write the streamed response body to the file object.
+        :param on_write: Called with the length of each chunk after it is written to the file.
+        :param digest: The StreamDigest to update with each chunk.
+        :return: The number of bytes written.
+        """
+        received = 0
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
             if chunk:  # filter out keep-alive new chunks
+                # The package is flushed to disk only once before it is committed, see commit().
                 file_object.write(chunk)
-                file_object.flush()
-                os.fsync(file_object.fileno())  # make sure all internal buffers are written to disk
-        response.close()
-        return True
+                received += len(chunk)
+                self.record_received(len(chunk))
+                if digest:
+                    digest.update(chunk)
+                BANDWIDTH.throttle(len(chunk))
+                if on_write:
+                    on_write(len(chunk))
+        return received
 
-    def record_download_speed(self, chunk_size):
-        now = time.time()
-        if self._record_time < now:
-            self.logger.info('Downloading {0}kb/s'.format(self._downloaded_size / 1024 / RECORD_DOWNLOAD_INTERVAL))
-            self._record_time = now + RECORD_DOWNLOAD_INTERVAL
-            self._downloaded_size = 0
-        else:
-            self._downloaded_size += chunk_size
+    def set_progress(self, size, received=0):
+        """
+        Reset the progress of the package when a (resumed) download starts.
+        """
+        if self.progress:
+            self.progress.reset(size, received)
+
+    def record_received(self, length):
+        """
+        Called with the length of each chunk received, by both the download threads and the fetch engine.
+        """
+        DOWNLOAD_BYTES.inc(length)
+        if self.progress:
+            self.progress.add(length)
+        if RECORD_DOWNLOAD_SPEED:
+            self.record_download_speed(length)
+
+    def record_download_speed(self, length):
+        with self._record_lock:
+            now = time.time()
+            self._downloaded_size += length
+            if self._record_time is None:
+                self._record_time = now
+            elif now - self._record_time >= RECORD_DOWNLOAD_INTERVAL:
+                speed = self._downloaded_size / 1024 / (now - self._record_time)
+                self._record_time = now
+                self._downloaded_size = 0
+                self.logger.info('Downloading {0:.0f}kb/s'.format(speed))
 
     def get_md5(self, url):
+        check_sum = self.resolver.get_md5(url) if self.resolver else None
+        if check_sum:
+            return check_sum
         md5_url = url + '.md5'
-        response = requests.get(md5_url)
-        check_sum = response.content.split(' ')[-1].rstrip()
+        with MD5_SECONDS.time(stage='fetch'):
+            response = _SESSION.get(md5_url)
+        response.raise_for_status()
+        check_sum = self.parse_md5(response.content)
+        if self.resolver:
+            self.resolver.set_md5(url, check_sum)
+        return check_sum
+
+    def parse_md5(self, content):
+        """
+        Parse the content of the .md5 file, e.g. MD5 (splunk-6.5.0-59c8927def0f-Linux-x86_64.tgz) = <check sum>.
+        """
+        check_sum = content.split(' ')[-1].rstrip()
         self.logger.debug('Get md5 check sum [{0}] from url.'.format(check_sum))
         return check_sum
 
+    def _get_md5_async(self, url):
+        """
+        Get the md5 check sum of the url in another thread.
+        :return: A function which waits and returns the check sum (or raises the exception of getting it).
+        """
+        result = dict()
+
+        def target():
+            try:
+                result['check_sum'] = self.get_md5(url)
+            except Exception, e:
+                result['error'] = e
+
+        thread = Thread(target=target)
+        thread.start()
+
+        def get():
+            thread.join()
+            if 'error' in result:
+                raise result['error']
+            return result['check_sum']
+
+        return get
+
     def check_md5(self, file_path, check_sum):
-        m = hashlib.md5()
-        block_size = 2 ** 20
-        with open(file_path, "rb") as f:
-            while True:
-                buf = f.read(block_size)
-                if not buf:
-                    break
-                m.update(buf)
-        file_check_sum = m.hexdigest()
+        digest = StreamDigest()
+        digest.update_from_file(file_path)
+        return self.verify_md5(digest.hexdigest(), check_sum)
+
+    def verify_md5(self, file_check_sum, check_sum):
         if file_check_sum != check_sum:
             self.logger.warning(
                 'The expect check sum is {0} while the downloaded file\'s check sum is {1}.'.format(check_sum,
@@ -178,8 +770,10 @@ class BuildDownloader(Logging):
             count += 1
             if count > MAX_DOWNLOAD_TRY:
                 self.logger.error('Download package failed, just give up.')
+                DOWNLOADS.inc(result='failure')
                 break
             else:
+                DOWNLOAD_RETRIES.inc()
                 self.logger.warning('Download package failed {0} times, try again...'.format(count))
 
 
@@ -0,0 +1,190 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import json
+import time
+import requests
+from collections import deque
+from urllib import quote
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
+from logging_base import Logging
+from metrics import EVENTS, WEBHOOK_POSTS
+from settings import EVENT_HISTORY, WEBHOOKS, WEBHOOK_BATCH_SIZE, WEBHOOK_BATCH_DELAY
+
+# The catalog changes announced as events, by the names of the events.
+_EVENT_NAMES = {'add': 'added', 'remove': 'removed'}
+
+# The fields of the package in an event.
+_FIELDS = ('branch', 'build', 'version', 'platform_package', 'file_name', 'size', 'md5', 'downloaded_at')
+
+# A failed post to a webhook is retried after this delay (seconds), which doubles each time it fails again.
+_MIN_RETRY_DELAY = 5
+_MAX_RETRY_DELAY = 300
+
+# Max number of the events waiting to be posted to a webhook, the oldest ones are dropped if it is down for long.
+_MAX_PENDING = 10000
+
+# The seconds to wait for a webhook to answer.
+_POST_TIMEOUT = 30
+
+_SESSION = requests.session()
+
+
+def matches(event, filters):
+    """
+    :param filters: A dict maps 'branch', 'platform' and 'event' to the lists of the accepted values, a missing (or
+    empty) list accepts any value.
+    """
+    build = event['build']
+    for name, value in (('branch', build['branch']), ('platform', build['platform_package']),
+                        ('event', event['event'])):
+        if filters.get(name) and value not in filters[name]:
+            return False
+    return True
+
+
+class EventFeed(Logging):
+    def __init__(self, catalog, history=EVENT_HISTORY):
+        """
+        Announce the packages added to (i.e. downloaded and verified) and removed from (e.g. expired) the catalog as
+        events, so that the clients are told about the new builds instead of polling the listing. The recent events are
+        kept to be sent again to the clients which reconnect.
+        :param catalog: The BuildCatalog, in the web server process it is also told the changes of the worker.
+        :param history: Number of the recent events kept.
+        """
+        super(EventFeed, self).__init__()
+        self._events = deque(maxlen=history)
+        # The ids go up across restarts, so that a client can tell it may have missed some events.
+        self.last_id = int(time.time() * 1000)
+        self._listeners = []
+        catalog.subscribe(self._on_catalog_changed)
+
+    def subscribe(self, callback):
+        """
+        :param callback: Called with each new event in the reactor thread.
+        :return: A function to unsubscribe.
+        """
+        self._listeners.append(callback)
+
+        def unsubscribe():
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+        return unsubscribe
+
+    def _on_catalog_changed(self, event, record):
+        if event in _EVENT_NAMES:
+            # The catalog is changed by the download threads too.
+            reactor.callFromThread(self._publish, _EVENT_NAMES[event], record)
+
+    def _publish(self, name, record):
+        self.last_id += 1
+        build = dict((field, record.get(field)) for field in _FIELDS)
+        # The paths from sqlite are unicode, which quote can not take if they are not ascii.
+        build['href'] = '/' + quote(record['path'].encode('utf-8'))
+        event = {'id': self.last_id, 'event': name, 'time': time.time(), 'build': build}
+        self._events.append(event)
+        EVENTS.inc(event=name)
+        for callback in list(self._listeners):
+            try:
+                callback(event)
+            except Exception, e:
+                self.logger.error('Event listener failed: {0}'.format(e), exc_info=True)
+
+    def since(self, last_id, filters=None):
+        """
+        :param last_id: The id of the last event the client has got.
+        :return: A tuple of (the kept events after the id which match the filters, whether some events after the id
+        are not kept any more, then the client should reload the packages from /api/builds).
+        """
+        oldest_id = self._events[0]['id'] if self._events else self.last_id + 1
+        events = [event for event in self._events if event['id'] > last_id and matches(event, filters or {})]
+        return events, last_id < oldest_id - 1
+
+
+class Webhook(Logging):
+    def __init__(self, feed, url, filters=None, batch_size=WEBHOOK_BATCH_SIZE, delay=WEBHOOK_BATCH_DELAY):
+        """
+        Post the events of the feed to the url as json ({"events": [...]}) in batches: a batch is posted when it is
+        full or its first event has waited for the delay. A failed post is retried (with the newer events) after a
+        growing delay. At most one post is in flight, so that the events arrive in order.
+        :param filters: Only post the events match them, see matches.
+        """
+        super(Webhook, self).__init__()
+        self.url = url
+        self.filters = filters if filters else dict()
+        self.batch_size = batch_size
+        self.delay = delay
+        self._pending = []
+        self._timer = None
+        self._posting = False
+        self._retry_delay = 0
+        feed.subscribe(self._on_event)
+
+    def _on_event(self, event):
+        if not matches(event, self.filters):
+            return
+        self._pending.append(event)
+        if len(self._pending) > _MAX_PENDING:
+            self.logger.warning('{0} events to {1} are dropped, it is down for long.'.format(
+                len(self._pending) - _MAX_PENDING, self.url))
+            del self._pending[:len(self._pending) - _MAX_PENDING]
+        # Wait for the post in flight, or the retry.
+        if self._posting or self._retry_delay:
+            return
+        if len(self._pending) >= self.batch_size:
+            if self._timer:
+                self._timer.cancel()
+            self._post()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self.delay, self._post)
+
+    def _post(self):
+        self._timer = None
+        if self._posting or not self._pending:
+            return
+        batch = self._pending[:self.batch_size]
+        self._posting = True
+        d = deferToThread(self._send, batch)
+        d.addCallbacks(self._on_posted, self._on_failed, callbackArgs=(batch,), errbackArgs=(batch,))
+
+    def _send(self, batch):
+        response = _SESSION.post(self.url, data=json.dumps({'events': batch}, separators=(',', ':')),
+                                 headers={'content-type': 'application/json'}, timeout=_POST_TIMEOUT)
+        response.raise_for_status()
+
+    def _on_posted(self, result, batch):
+        self._posting = False
+        self._retry_delay = 0
+        WEBHOOK_POSTS.inc(result='ok')
+        # The pending events could be dropped meanwhile, so they are compared by the id.
+        self._pending = [event for event in self._pending if event['id'] > batch[-1]['id']]
+        if len(self._pending) >= self.batch_size:
+            self._post()
+        elif self._pending:
+            self._timer = reactor.callLater(self.delay, self._post)
+
+    def _on_failed(self, failure, batch):
+        self._posting = False
+        self._retry_delay = min(self._retry_delay * 2, _MAX_RETRY_DELAY) if self._retry_delay else _MIN_RETRY_DELAY
+        WEBHOOK_POSTS.inc(result='failed')
+        self.logger.warning('Post {0} events to {1} failed, retry in {2}s: {3}'.format(
+            len(batch), self.url, self._retry_delay, failure.getErrorMessage()))
+        self._timer = reactor.callLater(self._retry_delay, self._post)
+
+
+def create_webhooks(feed, hooks=WEBHOOKS):
+    """
+    :param hooks: The urls, or the dicts of the url and the filters, see WEBHOOKS in settings.py.
+    :return: The list of the Webhooks posting the events of the feed.
+    """
+    webhooks = []
+    for hook in hooks:
+        if isinstance(hook, basestring):
+            hook = {'url': hook}
+        filters = dict((name, values) for name, values in hook.items() if name != 'url')
+        webhooks.append(Webhook(feed, hook['url'], filters))
+    return webhooks
@@ -0,0 +1,802 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import os
+import time
+from twisted.internet import reactor, task
+from twisted.internet.defer import Deferred, DeferredList, DeferredLock, DeferredSemaphore, CancelledError, \
+    inlineCallbacks, returnValue, succeed
+from twisted.internet.protocol import Protocol
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool, RedirectAgent, ResponseDone, readBody
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from download import StreamDigest, PartialExpired, RangeNotSupported, parse_remote_info
+from logging_base import Logging
+from metrics import TRANSFERS, DOWNLOADS, DOWNLOAD_RETRIES, DOWNLOAD_QUEUE, RESOLVE_SECONDS, MD5_SECONDS
+from scheduler import BANDWIDTH, HOSTS
+from settings import MAX_CONCURRENT_DOWNLOADS, MAX_DOWNLOAD_TRY, DOWNLOAD_SEGMENTS, MIN_SEGMENT_SIZE, \
+    WRITE_BUFFER_SIZE
+
+# The delay (seconds) before retrying doubles after each failure, up to this value.
+_MAX_RETRY_DELAY = 60
+
+# Max try number of getting the url from the build fetcher, 5 seconds between each try.
+_RESOLVE_TRY = 12
+
+# A pull has a web client waiting for it, so the url is not retried.
+_PULL_RESOLVE_TRY = 1
+
+# Bytes written into the staging file of a pull at a time, smaller than the others so that its followers are not
+# kept waiting.
+_PULL_WRITE_SIZE = 256 * 1024
+
+# The buffered data is written after these seconds even if it is less than a batch, e.g. of a slow connection.
+_WRITE_DELAY = 0.5
+
+
+def _response_headers(response):
+    return dict((name.lower(), values[-1]) for name, values in response.headers.getAllRawHeaders())
+
+
+def _remove_file(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def _remove_unresumable(downloader, tmp_path):
+    """
+    Keep the partial file to resume from if its state is recorded, otherwise it is useless.
+    """
+    if not os.path.isfile(downloader._partial_path(tmp_path)):
+        _remove_file(tmp_path)
+
+
+class _AsyncFile(object):
+    """
+    Write the data into the file in the reactor thread pool, a batch at a time and in order, so that the reactor never
+    waits for the disk. Notice the data is held in memory until it is written, the writer of the data should wait
+    (see wait_drained) while the file is `full`, i.e. a batch is buffered besides the one in writing.
+    """
+
+    def __init__(self, path, mode, offset=0, batch_size=WRITE_BUFFER_SIZE, on_written=None):
+        """
+        :param on_written: Called with the number of bytes after they are written into the file.
+        """
+        self._file = open(path, mode, 0)
+        if offset:
+            self._file.seek(offset)
+        self.batch_size = batch_size
+        self.on_written = on_written
+        self.failure = None
+        self._buffer = []
+        self._buffered = 0
+        self._writing = False
+        self._timer = None
+        self._waiters = []
+        self._closed = None
+
+    @property
+    def full(self):
+        return self._buffered >= self.batch_size
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.batch_size:
+            self._flush()
+        elif self._timer is None and not self._writing:
+            self._timer = reactor.callLater(_WRITE_DELAY, self._flush)
+
+    def wait_drained(self):
+        """
+        :return: A deferred fires when the file is not full any more.
+        """
+        d = Deferred()
+        if self.full and not self.failure:
+            self._waiters.append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def _flush(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if self._writing or not self._buffer or self.failure:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._writing = True
+        deferToThread(self._file.write, data).addBoth(self._on_written, len(data))
+
+    def _on_written(self, result, length):
+        self._writing = False
+        if isinstance(result, Failure):
+            self.failure = result
+        elif self.on_written:
+            self.on_written(length)
+        if self._closed or self._buffered >= self.batch_size:
+            self._flush()
+        elif self._buffer and self._timer is None:
+            self._timer = reactor.callLater(_WRITE_DELAY, self._flush)
+        if not self.full or self.failure:
+            waiters, self._waiters = self._waiters, []
+            for d in waiters:
+                d.callback(None)
+        if self._closed and not self._writing:
+            self._finish_close()
+
+    def close(self):
+        """
+        Write the buffered data and close the file.
+        :return: A deferred fires when it is closed, or fails if the data could not be written.
+        """
+        self._closed = Deferred()
+        d = self._closed
+        self._flush()
+        if not self._writing:
+            self._finish_close()
+        return d
+
+    def _finish_close(self):
+        closed, self._closed = self._closed, None
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._file.close()
+        if self.failure:
+            closed.errback(self.failure)
+        else:
+            closed.callback(None)
+
+
+class _BodyWriter(Protocol):
+    """
+    Write the response body to the _AsyncFile, `finished` fires with the number of received bytes.
+    """
+
+    def __init__(self, file_object, on_data):
+        self.file_object = file_object
+        self.on_data = on_data
+        self.received = 0
+        # The reasons ('bandwidth' or 'disk') the connection is paused for.
+        self._pauses = set()
+        self.finished = Deferred(self._cancel)
+
+    def _cancel(self, d):
+        if self.transport:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        if self.file_object.failure:
+            # The file can not be written, the rest of the body is useless.
+            self.transport.stopProducing()
+            return
+        self.file_object.write(data)
+        self.received += len(data)
+        self.on_data(data)
+        # Stop reading from the connection for a while if the bandwidth limit is exceeded.
+        wait = BANDWIDTH.consume(len(data))
+        if wait and 'bandwidth' not in self._pauses:
+            self._pause('bandwidth')
+            reactor.callLater(wait, self._resume, 'bandwidth')
+        # Or until the data in memory is written.
+        if self.file_object.full and 'disk' not in self._pauses:
+            self._pause('disk')
+            self.file_object.wait_drained().addCallback(lambda _: self._resume('disk'))
+
+    def _pause(self, reason):
+        if not self._pauses:
+            self.transport.pauseProducing()
+        self._pauses.add(reason)
+
+    def _resume(self, reason):
+        self._pauses.discard(reason)
+        if not self._pauses and not self.finished.called:
+            self.transport.resumeProducing()
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.received)
+        else:
+            self.finished.errback(reason)
+
+
+class _Discard(Protocol):
+    """
+    Drop the unwanted response body without reading it.
+    """
+
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+
+class Transfer(object):
+    """
+    The state of one package in the fetch engine.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.state = 'queued'
+        self.url = None
+        self.size = None
+        self.received = 0
+        self.retries = 0
+        self.started_at = None
+        self.cancelled = False
+        self._deferreds = set()
+        self._waiters = []
+
+    def track(self, d):
+        """
+        Track the deferred which the transfer is waiting for, so that it can be cancelled.
+        """
+        self._deferreds.add(d)
+
+        def untrack(result):
+            self._deferreds.discard(d)
+            return result
+
+        return d.addBoth(untrack)
+
+    def cancel(self):
+        self.cancelled = True
+        for d in list(self._deferreds):
+            d.cancel()
+
+    def wait(self):
+        d = Deferred()
+        self._waiters.append(d)
+        return d
+
+    def done(self, result):
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(result)
+
+    def to_dict(self):
+        return {'key': self.key, 'state': self.state, 'url': self.url, 'size': self.size, 'received': self.received,
+                'retries': self.retries, 'started_at': self.started_at}
+
+
+class Pull(Transfer):
+    """
+    A package downloaded for the web clients, who follow it by reading the staging file while it is downloading.
+    """
+
+    def __init__(self, key):
+        Transfer.__init__(self, key)
+        # The staging file, it is readable when the state is 'downloading'.
+        self.tmp_path = None
+        # The number of bytes flushed into the staging file.
+        self.written = 0
+        # The downloaded package, set when the pull succeeds.
+        self.file_path = None
+        self.finished = False
+        self._followers = []
+
+    def follow(self, callback):
+        """
+        :param callback: Called whenever the state changes or more data is written.
+        :return: A function to stop following.
+        """
+        self._followers.append(callback)
+
+        def unfollow():
+            if callback in self._followers:
+                self._followers.remove(callback)
+
+        return unfollow
+
+    def notify(self):
+        for callback in list(self._followers):
+            callback()
+
+    def done(self, result):
+        self.finished = True
+        self.state = 'done' if self.file_path else 'failed'
+        self.notify()
+        Transfer.done(self, result)
+
+
+class FetchEngine(Logging):
+    def __init__(self, max_concurrent=MAX_CONCURRENT_DOWNLOADS):
+        """
+        Download the packages inside the twisted reactor, over a pool of persistent connections.
+        :param max_concurrent: Max number of packages in downloading at the same time.
+        """
+        super(FetchEngine, self).__init__()
+        pool = HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = max_concurrent * (max(DOWNLOAD_SEGMENTS, 1) + 1)
+        self.agent = RedirectAgent(Agent(reactor, pool=pool))
+        self.semaphore = DeferredSemaphore(max_concurrent)
+        self.transfers = dict()
+        self.pulls = dict()
+        # The deferreds waiting for the md5 check sums in downloading, the bytes are only downloaded once at a time.
+        self._claims = dict()
+        # The states of the partial downloads are saved in the thread pool one at a time, so that an older state
+        # never overwrites a newer one.
+        self._partial_lock = DeferredLock()
+
+    def fetch(self, downloader):
+        """
+        Download the package described by the BuildDownloader, retry with a growing delay if failed.
+        :return: A deferred fires with True if the package is downloaded successfully.
+        """
+        key = downloader.key
+        if key in self.transfers:
+            return self.transfers[key].wait()
+        transfer = Transfer(key)
+        self.transfers[key] = transfer
+        waiter = transfer.wait()
+        DOWNLOAD_QUEUE.inc()
+        d = self.semaphore.run(self._fetch, downloader, transfer)
+        d.addErrback(self._on_error, downloader, transfer)
+        d.addCallback(self._on_done, transfer)
+        return waiter
+
+    def pull(self, downloader):
+        """
+        Download the package for the web clients right now, all the pulls of the same package share one download.
+        :return: The Pull to follow.
+        """
+        key = downloader.key
+        if key in self.pulls:
+            return self.pulls[key]
+        pull = self.pulls[key] = Pull(key)
+        d = self._pull(downloader, pull)
+        d.addErrback(self._on_error, downloader, pull)
+        d.addCallback(self._on_pulled, pull)
+        return pull
+
+    def cancel(self, key):
+        """
+        Cancel the transfer in queue or in flight.
+        """
+        if key in self.transfers:
+            self.transfers[key].cancel()
+
+    def status(self):
+        """
+        :return: A list of dicts describe the transfers in queue or in flight.
+        """
+        return [transfer.to_dict() for transfer in self.transfers.values() + self.pulls.values()]
+
+    def _on_error(self, failure, downloader, transfer):
+        if failure.check(CancelledError):
+            downloader.logger.warning('Download is cancelled.')
+        else:
+            downloader.logger.error('Download package failed: {0!r}'.format(failure.value))
+        return False
+
+    def _on_done(self, result, transfer):
+        self.transfers.pop(transfer.key, None)
+        if not result:
+            DOWNLOADS.inc(result='failure')
+        transfer.done(result)
+
+    def _on_pulled(self, result, pull):
+        self.pulls.pop(pull.key, None)
+        if not result:
+            DOWNLOADS.inc(result='failure')
+        pull.done(result)
+
+    def _request(self, transfer, method, url, headers=None):
+        # The urls from the json caches and the peers are unicode, while the agent takes bytes.
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return transfer.track(self.agent.request(method, url, Headers(headers if headers else {})))
+
+    def _sleep(self, transfer, seconds):
+        return transfer.track(task.deferLater(reactor, seconds, lambda: None))
+
+    @inlineCallbacks
+    def _fetch(self, downloader, transfer):
+        DOWNLOAD_QUEUE.dec()
+        if transfer.cancelled:
+            raise CancelledError()
+        transfer.started_at = time.time()
+        transfer.state = 'resolving'
+        url = yield self._resolve(downloader, transfer)
+        transfer.url = url
+        file_name, file_path, tmp_path = downloader.get_paths(url)
+        # The catalog is read from sqlite, none of the file system calls are made in the reactor thread.
+        downloaded = yield deferToThread(downloader.is_downloaded, file_path)
+        if downloaded:
+            downloader.logger.info('Package exists already, skip downloading.')
+            returnValue(True)
+        yield deferToThread(downloader.make_dirs)
+        linked, check_sum = yield self._link_from_store(downloader, transfer, url, file_path)
+        if linked:
+            returnValue(True)
+        try:
+            result = yield self._fetch_package(downloader, transfer, url, file_path, tmp_path, check_sum)
+        finally:
+            if check_sum:
+                self._unclaim(check_sum)
+        returnValue(result)
+
+    @inlineCallbacks
+    def _fetch_package(self, downloader, transfer, url, file_path, tmp_path, check_sum=None):
+        count = 0
+        while True:
+            # Asking the peers is blocking.
+            source_url, peer_check_sum = yield deferToThread(downloader.locate, url)
+            transfer.state = 'downloading'
+            downloader.progress = TRANSFERS.start(transfer.key, source_url)
+            try:
+                result = yield self._download(downloader, transfer, url, file_path, tmp_path, source_url,
+                                              check_sum if check_sum else peer_check_sum)
+            except CancelledError:
+                raise
+            except Exception, e:
+                downloader.logger.error('Exception during download: {0}'.format(e))
+                result = False
+            finally:
+                TRANSFERS.finish(downloader.progress)
+            if result:
+                returnValue(True)
+            count += 1
+            if count > MAX_DOWNLOAD_TRY:
+                downloader.logger.error('Download package failed, just give up.')
+                returnValue(False)
+            delay = min(5 * 2 ** (count - 1), _MAX_RETRY_DELAY)
+            downloader.logger.warning('Download package failed {0} times, try again after {1}s...'.format(count, delay))
+            transfer.retries = count
+            DOWNLOAD_RETRIES.inc()
+            transfer.state = 'waiting'
+            yield self._sleep(transfer, delay)
+
+    @inlineCallbacks
+    def _resolve(self, downloader, transfer, tries=_RESOLVE_TRY):
+        if downloader.url:
+            returnValue(downloader.url)
+        start = time.time()
+        url = downloader.resolver.get_url(downloader) if downloader.resolver else None
+        if url:
+            RESOLVE_SECONDS.observe(time.time() - start, source='cache')
+            returnValue(url)
+        url = downloader.get_fetcher_url()
+        downloader.logger.debug('Get url from splunk build fetcher: {0}'.format(url))
+        for i in range(tries):
+            try:
+                response = yield self._request(transfer, 'GET', url)
+                body = yield transfer.track(readBody(response))
+                if response.code == 200:
+                    RESOLVE_SECONDS.observe(time.time() - start, source='fetcher')
+                    if downloader.resolver:
+                        downloader.resolver.set_url(downloader, body.rstrip())
+                    returnValue(body.rstrip())
+            except CancelledError:
+                raise
+            except Exception, e:
+                downloader.logger.debug('Get url failed: {0}'.format(e))
+            if i + 1 < tries:
+                downloader.logger.warning('Get url failed. Retry after 5 seconds.')
+                yield self._sleep(transfer, 5)
+        raise Exception('Get url failed after {0} tries.'.format(tries))
+
+    @inlineCallbacks
+    def _link_from_store(self, downloader, transfer, url, file_path):
+        """
+        Check the md5 before the transfer, a package in the store already is linked instead of downloaded. If not, the
+        download of the md5 is claimed (after the one downloading it ends, if any).
+        :return: A deferred fires with a tuple of (whether it is linked, the claimed md5 check sum or None).
+        """
+        if not downloader.store:
+            returnValue((False, None))
+        try:
+            check_sum = yield self._get_md5(downloader, transfer, url)
+        except CancelledError:
+            raise
+        except Exception, e:
+            downloader.logger.warning('Get md5 check sum failed, can not look up the store: {0}'.format(e))
+            returnValue((False, None))
+        while True:
+            linked = yield deferToThread(downloader.link_from_store, check_sum, file_path, url)
+            if linked:
+                returnValue((True, check_sum))
+            if check_sum not in self._claims:
+                self._claims[check_sum] = []
+                returnValue((False, check_sum))
+            downloader.logger.info('Package with the same md5 is in downloading, wait for it.')
+            waiting = Deferred()
+            self._claims[check_sum].append(waiting)
+            yield transfer.track(waiting)
+
+    def _unclaim(self, check_sum):
+        for waiting in self._claims.pop(check_sum, []):
+            # The waiting one could be cancelled.
+            if not waiting.called:
+                waiting.callback(None)
+
+    @inlineCallbacks
+    def _get_md5(self, downloader, transfer, url):
+        check_sum = downloader.resolver.get_md5(url) if downloader.resolver else None
+        if check_sum:
+            returnValue(check_sum)
+        start = time.time()
+        response = yield self._request(transfer, 'GET', url + '.md5')
+        body = yield transfer.track(readBody(response))
+        MD5_SECONDS.observe(time.time() - start, stage='fetch')
+        if response.code != 200:
+            raise Exception('Get md5 check sum failed: {0}'.format(response.code))
+        check_sum = downloader.parse_md5(body)
+        if downloader.resolver:
+            downloader.resolver.set_md5(url, check_sum)
+        returnValue(check_sum)
+
+    @inlineCallbacks
+    def _download(self, downloader, transfer, url, file_path, tmp_path, source_url, check_sum=None):
+        # Fetch the md5 check sum while the package is downloading.
+        md5_result = succeed(check_sum) if check_sum else self._get_md5(downloader, transfer, url)
+        try:
+            response = yield self._request(transfer, 'HEAD', source_url)
+            yield transfer.track(readBody(response))
+            remote = parse_remote_info(response.code, _response_headers(response))
+            transfer.size = remote['size']
+            if remote['size'] is not None and remote['accept_ranges']:
+                state = yield deferToThread(downloader.load_partial, tmp_path, source_url, remote)
+                if state is None and downloader.delta:
+                    # Looking for the blocks in the previous build is cpu bound.
+                    transfer.state = 'scanning'
+                    state = yield deferToThread(downloader.create_delta_partial, tmp_path, source_url, remote)
+                    transfer.state = 'downloading'
+                if state is None:
+                    segments = DOWNLOAD_SEGMENTS if remote['size'] >= MIN_SEGMENT_SIZE else 1
+                    state = yield deferToThread(downloader.create_partial, tmp_path, source_url, remote,
+                                                max(segments, 1))
+                downloader.set_progress(remote['size'], downloader.partial_received(state))
+                try:
+                    file_check_sum = yield self._download_segments(downloader, transfer, source_url, tmp_path, state)
+                except RangeNotSupported:
+                    downloader.logger.warning('Server does not support range requests, fall back to a single stream.')
+                    file_check_sum = None
+                except PartialExpired:
+                    downloader.logger.warning('Package changed on the server, discard the partial file.')
+                    failure = Failure()
+                    yield deferToThread(downloader.discard_partial, tmp_path)
+                    failure.raiseException()
+            else:
+                file_check_sum = None
+            if file_check_sum is None:
+                yield deferToThread(downloader.discard_partial, tmp_path)
+                downloader.set_progress(remote['size'])
+                file_check_sum = yield self._download_stream(downloader, transfer, source_url, tmp_path)
+            check_sum = yield md5_result
+        except Exception:
+            # The exception is lost by the yield below.
+            failure = Failure()
+            md5_result.addErrback(lambda _: None)
+            md5_result.cancel()
+            yield deferToThread(_remove_unresumable, downloader, tmp_path)
+            failure.raiseException()
+        yield deferToThread(downloader.discard_partial, tmp_path, keep_file=True)
+        if not downloader.verify_md5(file_check_sum, check_sum):
+            yield deferToThread(_remove_file, tmp_path)
+            downloader.delta = False
+            returnValue(False)
+        # fsync could take a while, do not block the reactor.
+        yield deferToThread(downloader.commit, tmp_path, file_path)
+        # The catalog is saved in sqlite.
+        yield deferToThread(downloader.record, file_path, url, file_check_sum)
+        returnValue(True)
+
+    @inlineCallbacks
+    def _pull(self, downloader, pull):
+        pull.started_at = time.time()
+        pull.state = 'resolving'
+        url = yield self._resolve(downloader, pull, _PULL_RESOLVE_TRY)
+        pull.url = url
+        file_name, file_path, tmp_path = downloader.get_paths(url)
+        # The package could be downloaded into any folder already.
+        records = (yield deferToThread(downloader.catalog.find, file_name=file_name)) if downloader.catalog else []
+        if records:
+            pull.file_path = os.path.join(downloader.catalog.root_path, records[-1]['path'])
+            returnValue(True)
+        yield deferToThread(downloader.make_dirs)
+        linked, check_sum = yield self._link_from_store(downloader, pull, url, file_path)
+        if linked:
+            pull.file_path = file_path
+            returnValue(True)
+        try:
+            result = yield self._pull_package(downloader, pull, url, file_path, tmp_path, check_sum)
+        finally:
+            if check_sum:
+                self._unclaim(check_sum)
+        returnValue(result)
+
+    @inlineCallbacks
+    def _pull_package(self, downloader, pull, url, file_path, tmp_path, check_sum=None):
+        source_url, peer_check_sum = yield deferToThread(downloader.locate, url)
+        check_sum = check_sum if check_sum else peer_check_sum
+        md5_result = succeed(check_sum) if check_sum else self._get_md5(downloader, pull, url)
+        try:
+            release = yield pull.track(HOSTS.acquire(source_url))
+            downloader.progress = TRANSFERS.start(pull.key, source_url)
+            try:
+                file_check_sum = yield self._pull_response(downloader, pull, source_url, tmp_path)
+            finally:
+                TRANSFERS.finish(downloader.progress)
+                release()
+            check_sum = yield md5_result
+        except Exception:
+            failure = Failure()
+            md5_result.addErrback(lambda _: None)
+            md5_result.cancel()
+            yield deferToThread(_remove_file, tmp_path)
+            failure.raiseException()
+        if not downloader.verify_md5(file_check_sum, check_sum):
+            yield deferToThread(_remove_file, tmp_path)
+            returnValue(False)
+        pull.state = 'committing'
+        yield deferToThread(downloader.commit, tmp_path, file_path)
+        # The catalog is saved in sqlite.
+        yield deferToThread(downloader.record, file_path, url, file_check_sum)
+        pull.file_path = file_path
+        returnValue(True)
+
+    @inlineCallbacks
+    def _pull_response(self, downloader, pull, url, tmp_path):
+        response = yield self._request(pull, 'GET', url)
+        if response.code != 200:
+            response.deliverBody(_Discard())
+            raise Exception('Unexpected response code: {0}'.format(response.code))
+        downloader.logger.info('Start pulling from {0}'.format(url))
+        pull.size = response.length if isinstance(response.length, (int, long)) else None
+        downloader.set_progress(pull.size)
+        digest = StreamDigest()
+
+        def on_written(length):
+            # The followers read the data from the file.
+            pull.written += length
+            pull.notify()
+
+        f = _AsyncFile(tmp_path, 'wb', batch_size=_PULL_WRITE_SIZE, on_written=on_written)
+        try:
+            def on_data(data):
+                digest.update(data)
+                self._on_data(downloader, pull, data)
+
+            pull.tmp_path = tmp_path
+            pull.state = 'downloading'
+            pull.notify()
+            writer = _BodyWriter(f, on_data)
+            response.deliverBody(writer)
+            received = yield pull.track(writer.finished)
+        finally:
+            yield f.close()
+        if pull.size is not None and received != pull.size:
+            raise Exception('Package is truncated, only {0}/{1} bytes received.'.format(received, pull.size))
+        returnValue(digest.hexdigest())
+
+    def _on_data(self, downloader, transfer, data):
+        transfer.received += len(data)
+        downloader.record_received(len(data))
+
+    @inlineCallbacks
+    def _download_stream(self, downloader, transfer, url, tmp_path):
+        release = yield transfer.track(HOSTS.acquire(url))
+        try:
+            result = yield self._download_stream_response(downloader, transfer, url, tmp_path)
+        finally:
+            release()
+        returnValue(result)
+
+    @inlineCallbacks
+    def _download_stream_response(self, downloader, transfer, url, tmp_path):
+        response = yield self._request(transfer, 'GET', url)
+        if response.code != 200:
+            response.deliverBody(_Discard())
+            raise Exception('Unexpected response code: {0}'.format(response.code))
+        downloader.logger.info('Start downloading from {0}'.format(url))
+        digest = StreamDigest()
+        transfer.received = 0
+        f = _AsyncFile(tmp_path, 'wb')
+        try:
+            def on_data(data):
+                digest.update(data)
+                self._on_data(downloader, transfer, data)
+
+            writer = _BodyWriter(f, on_data)
+            response.deliverBody(writer)
+            received = yield transfer.track(writer.finished)
+        finally:
+            yield f.close()
+        if isinstance(response.length, (int, long)) and received != response.length:
+            raise Exception('Package is truncated, only {0}/{1} bytes received.'.format(received, response.length))
+        returnValue(digest.hexdigest())
+
+    @inlineCallbacks
+    def _download_segments(self, downloader, transfer, url, tmp_path, state):
+        segments = [segment for segment in state['segments'] if segment[0] + segment[2] <= segment[1]]
+        downloader.logger.info('Start downloading from {0} in {1} segments'.format(url, len(segments)))
+        transfer.received = downloader.partial_received(state)
+        # The first segment is digested while downloading, the others are read back from the file afterwards.
+        digest = StreamDigest()
+        if segments and segments[0][0] == 0:
+            # Digest the part downloaded by the previous tries first.
+            yield deferToThread(digest.update_from_file, tmp_path, segments[0][2])
+        # A delta download could have many segments, only some of them are downloaded at the same time.
+        semaphore = DeferredSemaphore(max(DOWNLOAD_SEGMENTS, 1))
+        results = yield DeferredList(
+            [semaphore.run(self._download_segment, downloader, transfer, url, tmp_path, state, segment,
+                           digest if segment[0] == 0 else None) for segment in segments],
+            consumeErrors=True)
+        yield self._save_partial(downloader, tmp_path, state)
+        failures = [failure for success, failure in results if not success]
+        for error_type in (CancelledError, PartialExpired, RangeNotSupported, Exception):
+            for failure in failures:
+                if failure.check(error_type):
+                    failure.raiseException()
+        yield deferToThread(digest.update_from_file, tmp_path)
+        returnValue(digest.hexdigest())
+
+    @inlineCallbacks
+    def _download_segment(self, downloader, transfer, url, tmp_path, state, segment, digest=None):
+        # The segment could wait for its turn until the transfer is cancelled.
+        if transfer.cancelled:
+            raise CancelledError()
+        release = yield transfer.track(HOSTS.acquire(url))
+        try:
+            yield self._download_segment_response(downloader, transfer, url, tmp_path, state, segment, digest)
+        finally:
+            release()
+
+    @inlineCallbacks
+    def _download_segment_response(self, downloader, transfer, url, tmp_path, state, segment, digest=None):
+        start, end = segment[0] + segment[2], segment[1]
+        headers = {'Range': ['bytes={0}-{1}'.format(start, end)]}
+        validator = state.get('etag') or state.get('last_modified')
+        if segment[2] and validator:
+            headers['If-Range'] = [validator]
+        response = yield self._request(transfer, 'GET', url, headers)
+        content_range = (response.headers.getRawHeaders('content-range') or [''])[-1]
+        if response.code != 206 or not content_range.startswith('bytes {0}-{1}/'.format(start, end)):
+            response.deliverBody(_Discard())
+            if response.code == 200 and 'If-Range' in headers:
+                raise PartialExpired()
+            if response.code != 206:
+                raise RangeNotSupported()
+            raise Exception('Unexpected content range: {0}'.format(content_range))
+
+        def on_written(length):
+            # Only the bytes written into the file are recorded as done.
+            segment[2] += length
+            if downloader._partial_save_due():
+                self._save_partial(downloader, tmp_path, state)
+
+        f = _AsyncFile(tmp_path, 'r+b', start, on_written=on_written)
+        try:
+            def on_data(data):
+                if digest:
+                    digest.update(data)
+                self._on_data(downloader, transfer, data)
+
+            writer = _BodyWriter(f, on_data)
+            response.deliverBody(writer)
+            yield transfer.track(writer.finished)
+        finally:
+            yield f.close()
+        if segment[0] + segment[2] <= end:
+            raise Exception('Segment {0}-{1} is truncated at {2}.'.format(segment[0], end, segment[0] + segment[2]))
+
+    def _save_partial(self, downloader, tmp_path, state):
+        """
+        Save a copy of the state in the thread pool, as the segments go on in the reactor meanwhile.
+        :return: A deferred fires when it is saved, a failure is only logged as the download can go on without it.
+        """
+        snapshot = dict(state, segments=[list(segment) for segment in state['segments']])
+        d = self._partial_lock.run(deferToThread, downloader.save_partial, tmp_path, snapshot)
+        d.addErrback(lambda failure: downloader.logger.warning(
+            'Save the partial state failed: {0}'.format(failure.getErrorMessage())))
+        return d
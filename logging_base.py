@@ -3,15 +3,182 @@
 @contact: cuyu@splunk.com
 @since: 6/15/16
 '''
+import json
 import logging
 import os
+import random
+import Queue
 from abc import ABCMeta
 from logging.handlers import RotatingFileHandler
-
-_CURRENT_DIR = os.path.dirname(__file__)
+from threading import Lock, Thread
+from settings import LOG_DIR, LOG_JSON
 
 _LOG_FORMAT = '[%(asctime)s] %(levelname)s - %(name)s: %(message)s'
-_FILE_NAME = os.path.join(_CURRENT_DIR, "splunk-build-manager.log")
+# Each process of the supervisor has its own log file (set by the SPLUNKBMD_LOG_FILE environment variable).
+_FILE_NAME = os.environ.get('SPLUNKBMD_LOG_FILE', os.path.join(LOG_DIR, "splunk-build-manager.log"))
+
+# Max number of the log records waiting to be written, the new ones are dropped (and counted) if it is full.
+_QUEUE_SIZE = 10000
+
+# Max number of the log records written at a time.
+_BATCH_SIZE = 500
+
+# The seconds to wait for the queued log records to be written when the process exits.
+_CLOSE_TIMEOUT = 5
+
+
+def process_log_file(process):
+    """
+    :return: The log file of a child process of the supervisor, next to the main one.
+    """
+    root, ext = os.path.splitext(_FILE_NAME)
+    return '{0}-{1}{2}'.format(root, process, ext)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format the log record as a line of json.
+    """
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage(), 'thread': record.threadName}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if hasattr(record, 'sample_rate'):
+            entry['sample_rate'] = record.sample_rate
+        return json.dumps(entry)
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    def emit_batch(self, records):
+        """
+        Format the records and write them at once, the file is rotated before if they do not fit in it.
+        """
+        lines = []
+        for record in records:
+            try:
+                line = self.format(record)
+            except Exception:
+                self.handleError(record)
+                continue
+            lines.append(line.encode('utf-8') if isinstance(line, unicode) else line)
+        if not lines:
+            return
+        data = '\n'.join(lines) + '\n'
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self.stream.tell() and self.stream.tell() + len(data) >= self.maxBytes:
+                self.doRollover()
+            self.stream.write(data)
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+class QueueHandler(logging.Handler):
+    def __init__(self, handler, size=_QUEUE_SIZE):
+        """
+        Put the log records into a queue, a background thread writes them into the handler in batches, so that logging
+        never blocks on the disk (e.g. in the download threads or the reactor). If the queue is full, the new records
+        are dropped rather than waiting.
+        :param handler: The BatchRotatingFileHandler to write the records.
+        """
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.size = size
+        self.dropped = 0
+        # The records are dropped by the emitting threads and reported by the writer thread.
+        self._dropped_lock = Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = Queue.Queue(self.size)
+        self._thread = Thread(target=self._write, args=(self._queue,), name='LogWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prepare(self, record):
+        """
+        Format the message and the exception now, the arguments could be changed before the record is written.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        # A forked process (see splunkbmd start) does not have the writer thread.
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _write(self, queue):
+        while True:
+            records = [queue.get()]
+            try:
+                while len(records) < _BATCH_SIZE:
+                    records.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            # None is put by close.
+            stopped = None in records
+            records = [record for record in records if record is not None]
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                records.append(logging.makeLogRecord({
+                    'name': 'LogWriter', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '{0} log records are dropped, the queue is full.'.format(dropped)}))
+            self.handler.emit_batch(records)
+            if stopped:
+                return
+
+    def close(self):
+        """
+        Write the queued records before the process exits (called by logging.shutdown).
+        """
+        if self._thread and self._pid == os.getpid() and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=_CLOSE_TIMEOUT)
+                self._thread.join(_CLOSE_TIMEOUT)
+            except Queue.Full:
+                pass
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate):
+        """
+        Pass only a fraction of the records below WARNING, e.g. the logs of every web request.
+        :param rate: The fraction of the records to pass, 1 passes all of them.
+        """
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        record.sample_rate = self.rate
+        return random.random() < self.rate
 
 
 def setup_logger(debug=False):
@@ -24,10 +191,12 @@ def setup_logger(debug=False):
     level = logging.INFO
     if debug:
         level = logging.DEBUG
-    hdlr = RotatingFileHandler(filename=_FILE_NAME, mode='w', maxBytes=500000, backupCount=2)
-    fmt = logging.Formatter(_LOG_FORMAT)
+    if not os.path.isdir(os.path.dirname(_FILE_NAME) or '.'):
+        os.makedirs(os.path.dirname(_FILE_NAME))
+    hdlr = BatchRotatingFileHandler(filename=_FILE_NAME, mode='w', maxBytes=500000, backupCount=2)
+    fmt = JsonFormatter() if LOG_JSON else logging.Formatter(_LOG_FORMAT)
     hdlr.setFormatter(fmt)
-    logging.root.addHandler(hdlr)
+    logging.root.addHandler(QueueHandler(hdlr))
     logging.root.setLevel(level)
     # Disable some unnecessary logs.
     logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.WARNING)
@@ -4,51 +4,45 @@
 @since: 6/15/16
 '''
 import os
-import operator
 import re
-import requests
-import time
-from bs4 import BeautifulSoup
-from multiprocessing.pool import ThreadPool
+from twisted.internet.defer import DeferredList
+from twisted.internet.threads import deferToThread
+from catalog import BuildCatalog
 from download import BuildDownloader
 from logging_base import Logging
-from settings import MAX_CONCURRENT_THREADS, PLATFORM_PACKAGES, FILTER_BRANCH_REGEX, MUST_DOWNLOAD_BRANCH, EXPIRE_DAYS, \
-    NEVER_DELETE_BRANCH, RESERVE_RC_BUILDS
-
-_SESSION = requests.session()
-_BASE_URL = 'http://releases.splunk.com'
-_RELEASE_URL = 'http://releases.splunk.com/status.html'
+from resolver import UrlResolver
+from retention import RetentionEngine
+from scheduler import DownloadScheduler, get_priority
+from scraper import ReleaseScraper
+from settings import PLATFORM_PACKAGES, FILTER_BRANCH_REGEX, MUST_DOWNLOAD_BRANCH, RESERVE_RC_BUILDS
 
 
 class BuildManager(Logging):
-    def __init__(self, root_path):
+    def __init__(self, root_path, catalog=None, branch_filter=None, mirror=None):
         """
         :param root_path: The root dir path to save the downloaded builds.
+        :param catalog: The BuildCatalog of the root path, will open it if not given.
+        :param branch_filter: A function returns whether to download the latest builds of the branch, default is to
+        download all the branches.
+        :param mirror: The PeerMirror to download the packages from the peers which have them.
         """
         super(BuildManager, self).__init__()
         self.root_path = root_path
-        self._cache = dict()
-        self.branch_list = self._get_branch_list()
+        self.catalog = catalog if catalog else BuildCatalog(root_path)
+        self.mirror = mirror
+        self.scraper = ReleaseScraper(root_path)
+        # Parsed once and shared by the branch list and the RC builds.
+        self.release_page = self.scraper.get_release_page()
+        self.branch_list = self._filter_branches(self.release_page.branches)
         if RESERVE_RC_BUILDS:
-            self.rc_builds = self._get_rc_list()
+            self.rc_builds = self.scraper.get_rc_builds(self.release_page, self.branch_list)
         else:
             self.rc_builds = dict()
-
-    def _get_branch_list(self):
-        """
-        Acquire the branch list of splunk from http://releases.splunk.com/.
-        """
-        response = _SESSION.get(_RELEASE_URL)
-        self._cache['release_page'] = response.content
-        parsed_html = BeautifulSoup(response.content, 'html.parser')
-        branch_list = []
-        for tag in parsed_html.find_all('center'):
-            if tag.string:
-                if tag.string.startswith('Branch: '):
-                    branch_name = tag.string.replace('Branch: ', '').strip()
-                    if branch_name:
-                        branch_list.append(branch_name)
-        return self._filter_branches(branch_list)
+        # The RC builds above are reserved for all the branches, but only these branches are downloaded.
+        self.download_branches = [branch for branch in self.branch_list if not branch_filter or branch_filter(branch)]
+        self.resolver = UrlResolver(root_path)
+        # Resolve the package urls of all the branches in one pass, a changed page could have new builds.
+        self.resolver.prefetch(self.release_page, self.download_branches, force=self.release_page.changed)
 
     def _filter_branches(self, branch_list):
         filtered_branches = []
@@ -64,77 +58,76 @@ class BuildManager(Logging):
                 filtered_branches.append(branch)
         return filtered_branches
 
-    def _get_rc_list(self):
-        rc_builds = dict()
-        release_page = self._cache.get('release_page')
-        if not release_page:
-            release_page = _SESSION.get(_RELEASE_URL).content
-        parsed_html = BeautifulSoup(release_page, 'html.parser')
-        for tag in parsed_html.find_all('tr', {'bgcolor': '#54C944'}):
-            branch = tag.contents[0].text
-            if branch in self.branch_list:
-                link = tag.contents[1].find('a').attrs['href']
-                download_page = _SESSION.get(_BASE_URL + '/' + link).content
-                build_number = self._get_commit_number(download_page)
-                label = tag.contents[2].text
-                rc_builds[label] = (branch, build_number)
-        return rc_builds
+    def _get_downloaders(self):
+        """
+        :return: A list of (priority, BuildDownloader) of the latest builds not downloaded yet, ordered by the priority.
+        """
+        rc_branches = set(rc[0] for rc in self.rc_builds.values())
+        downloaders = []
+        for branch in self.download_branches:
+            priority = get_priority(branch, rc_branches)
+            for platform_pkg in PLATFORM_PACKAGES:
+                downloader = BuildDownloader(os.path.join(self.root_path, branch), platform_pkg, branch=branch,
+                                             catalog=self.catalog, resolver=self.resolver, mirror=self.mirror)
+                if not self._is_up_to_date(downloader):
+                    downloaders.append((priority, downloader))
+        # sorted is stable, so the order of the branches is kept in the same priority.
+        return sorted(downloaders, key=lambda pair: pair[0])
 
-    def _get_commit_number(self, download_page):
-        parsed_html = BeautifulSoup(download_page, 'html.parser')
-        for tag in parsed_html.find_all('a'):
-            href = tag.attrs['href']
-            if href.endswith(PLATFORM_PACKAGES[0]):
-                return href[:-len(PLATFORM_PACKAGES[0])].split('-')[-2]
+    def _is_up_to_date(self, downloader):
+        """
+        Whether the latest package of the downloader is resolved already and downloaded.
+        """
+        url = self.resolver.get_url(downloader)
+        return bool(url) and downloader.is_downloaded(downloader.get_paths(url)[1])
 
-    def download_latest_builds(self):
-        self.logger.info('Start downloading latest builds of these branch: {0}'.format(str(self.branch_list)))
-        results = []
-        thread_pool = ThreadPool(processes=MAX_CONCURRENT_THREADS)
-        for branch in self.branch_list:
+    def get_latest_packages(self):
+        """
+        :return: A dict maps the downloaded branches to {platform package: the latest package file name}, only the
+        resolved ones are included.
+        """
+        packages = dict()
+        for branch in self.download_branches:
+            packages[branch] = dict()
             for platform_pkg in PLATFORM_PACKAGES:
-                downloader = BuildDownloader(os.path.join(self.root_path, branch), platform_pkg, branch=branch)
-                results.append(thread_pool.apply_async(downloader.start_download))
+                url = self.resolver.get_url(BuildDownloader(os.path.join(self.root_path, branch), platform_pkg,
+                                                            branch=branch))
+                if url:
+                    packages[branch][platform_pkg] = url.split('/')[-1]
+        return packages
 
-        for result in results:
-            msg = result.get()
-            if msg:
-                self.logger.error(msg)
+    def download_latest_builds(self):
+        self.logger.info('Start downloading latest builds of these branch: {0}'.format(str(self.download_branches)))
+        scheduler = DownloadScheduler()
+        for priority, downloader in self._get_downloaders():
+            scheduler.submit(downloader, priority)
+        scheduler.run()
         self.logger.info('All download threads end.')
+        # The urls and md5 check sums looked up by the downloads.
+        self.resolver.save()
 
-    def delete_expire_builds(self):
-        never_delete_folders = [os.path.join(self.root_path, branch) for branch in NEVER_DELETE_BRANCH]
-        rc_builds = [rc[1] for rc in self.rc_builds.values()]
-        expire_time = time.time() - EXPIRE_DAYS * 3600 * 24
-        delete_files = []
-        for root, dirs, files in os.walk(self.root_path):
-            if root in never_delete_folders:
-                continue
-            create_times = dict()
-            for f in files:
-                if not f.startswith('.'):
-                    build_number = f.split('-')[2]
-                    if build_number in rc_builds:
-                        continue
-                    platform_pkg = '-'.join(f.split('-')[3:])
-                    if not platform_pkg in create_times:
-                        create_times[platform_pkg] = dict()
-                    file_path = os.path.join(root, f)
-                    create_times[platform_pkg][file_path] = os.path.getctime(file_path)
-            for platform_pkg in create_times.keys():
-                sorted_pairs = sorted(create_times[platform_pkg].items(), key=operator.itemgetter(1))
-                # Will delete the package if it is expired and not the only one file (of that platform) in that folder.
-                for file_path, ct in sorted_pairs[:-1]:
-                    if ct < expire_time:
-                        delete_files.append(file_path)
-
-        for file_path in delete_files:
-            os.remove(file_path)
-            self.logger.info('{0} is deleted due to expiration.'.format(file_path))
+    def download_latest_builds_async(self, engine):
+        """
+        Download the latest builds by the FetchEngine, must be called in the reactor thread.
+        :return: A deferred fires when all the downloads end.
+        """
+        self.logger.info('Start downloading latest builds of these branch: {0}'.format(str(self.download_branches)))
+        # The engine starts the downloads in the order they are fetched.
+        d = DeferredList([engine.fetch(downloader) for priority, downloader in self._get_downloaders()])
+        d.addCallback(lambda _: self.logger.info('All downloads end.'))
+        d.addCallback(lambda _: deferToThread(self.resolver.save))
+        return d
 
+    def delete_expire_builds(self, retention=None):
+        """
+        :param retention: The RetentionEngine to decide which packages to delete, will load one if not given.
+        """
+        rc_builds = [rc[1] for rc in self.rc_builds.values()]
+        if retention is None:
+            retention = RetentionEngine(self.catalog, follow_catalog=False)
+        retention.run(rc_builds)
         self.logger.info('All expired files are deleted.')
 
-
 if __name__ == '__main__':
     manager = BuildManager('/tmp/splunk_builds')
     # manager.download_latest_builds()
@@ -0,0 +1,323 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import codecs
+import os
+import posixpath
+import Queue
+import struct
+import tarfile
+import time
+import zlib
+from threading import Thread
+from logging_base import Logging
+
+try:
+    import olefile
+except ImportError:
+    olefile = None
+
+# The fields of each file in the manifest, the entries are saved as lists of them to be compact.
+FIELDS = ('name', 'size', 'mtime', 'type', 'version')
+
+# The bits of the msi column types (see the _Columns table).
+_MSI_TYPE_VALID = 0x0100
+_MSI_TYPE_STRING = 0x0800
+_MSI_TYPE_NULLABLE = 0x1000
+
+# The characters packed into the stream names of the msi tables, two in a unicode character.
+_MSI_NAME_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz._'
+
+# The layout of the _Columns table itself: Table, Number, Name, Type.
+_MSI_COLUMNS_TYPES = (_MSI_TYPE_STRING | _MSI_TYPE_VALID | 64, _MSI_TYPE_VALID | 2,
+                      _MSI_TYPE_STRING | _MSI_TYPE_VALID | 64, _MSI_TYPE_VALID | 2)
+
+# The errors of reading a broken (or truncated) package.
+_ERRORS = (IOError, OSError, EOFError, tarfile.TarError, zlib.error, struct.error, IndexError, KeyError, ValueError)
+
+
+class ManifestError(Exception):
+    pass
+
+
+def can_index(file_name):
+    return file_name.endswith(('.tgz', '.tar.gz')) or (olefile is not None and file_name.endswith('.msi'))
+
+
+def can_extract(file_name):
+    return file_name.endswith(('.tgz', '.tar.gz'))
+
+
+def build_manifest(file_path):
+    """
+    List the files in the package: a tgz is streamed through its tar headers, the file table of a msi is read (needs
+    olefile). Neither is loaded into memory as a whole.
+    :return: A list of [name, size, mtime, type, version] (see FIELDS) of each file.
+    """
+    try:
+        if file_path.endswith('.msi'):
+            return _msi_entries(file_path)
+        return _tar_entries(file_path)
+    except _ERRORS, e:
+        raise ManifestError('Index {0} failed: {1}'.format(os.path.basename(file_path), e))
+
+
+def _decode_name(name):
+    """
+    The names in a tar are bytes in any encoding, they are kept in unicode so that the manifest can be saved as json.
+    """
+    return name.decode('utf-8', 'replace') if isinstance(name, str) else name
+
+
+def _tar_entries(file_path):
+    entries = []
+    tar = tarfile.open(file_path, 'r|gz')
+    try:
+        while True:
+            member = tar.next()
+            if member is None:
+                break
+            kind = 'file' if member.isfile() else 'dir' if member.isdir() else 'link' if member.issym() or \
+                member.islnk() else 'other'
+            entries.append([_decode_name(member.name), member.size if member.isfile() else 0, member.mtime, kind, None])
+            # The stream mode keeps all the members it has read, which are not needed.
+            tar.members = []
+    finally:
+        tar.close()
+    return entries
+
+
+def open_member(file_path, name):
+    """
+    Find a file in the tgz package by streaming through it, the files before it are skipped without being extracted.
+    :return: A tuple of (the TarInfo of the file, a file object to read it, the TarFile to close after reading).
+    """
+    tar = tarfile.open(file_path, 'r|gz')
+    try:
+        while True:
+            member = tar.next()
+            if member is None:
+                raise KeyError('No such file: {0}'.format(name))
+            # The name is asked for by its entry in the manifest.
+            if _decode_name(member.name) == _decode_name(name):
+                if not member.isfile():
+                    raise KeyError('Not a file: {0}'.format(name))
+                return member, tar.extractfile(member), tar
+            tar.members = []
+    except Exception:
+        tar.close()
+        raise
+
+
+def _decode_msi_name(name):
+    chars = []
+    for ch in name:
+        code = ord(ch)
+        if 0x3800 <= code < 0x4800:
+            code -= 0x3800
+            chars.append(_MSI_NAME_CHARS[code & 0x3f])
+            chars.append(_MSI_NAME_CHARS[code >> 6])
+        elif 0x4800 <= code < 0x4840:
+            chars.append(_MSI_NAME_CHARS[code - 0x4800])
+        elif code == 0x4840:
+            # The prefix of the table streams.
+            chars.append('!')
+        else:
+            chars.append(ch)
+    return ''.join(chars)
+
+
+def _msi_strings(pool, data):
+    """
+    :return: A tuple of (the list of the strings by id, bytes of a string reference).
+    """
+    if len(pool) < 4:
+        return [None], 2
+    words = struct.unpack('<{0}H'.format(len(pool) // 2), pool[:len(pool) // 2 * 2])
+    codepage = words[0] | ((words[1] & 0x7fff) << 16)
+    ref_size = 3 if words[1] & 0x8000 else 2
+    codec = 'utf-8' if codepage == 65001 else 'cp{0}'.format(codepage) if codepage else 'latin-1'
+    try:
+        codecs.lookup(codec)
+    except LookupError:
+        codec = 'latin-1'
+    strings = [None]
+    offset = 0
+    i = 1
+    while i < len(words) // 2:
+        length, refs = words[i * 2], words[i * 2 + 1]
+        if length == 0 and refs == 0:
+            # An empty entry still takes an id.
+            strings.append(None)
+            i += 1
+            continue
+        if length == 0:
+            # The length of a string over 64KB is given in the next entry.
+            length = (words[i * 2 + 3] << 16) + words[i * 2 + 2]
+            i += 2
+        else:
+            i += 1
+        strings.append(data[offset:offset + length].decode(codec, 'replace'))
+        offset += length
+    return strings, ref_size
+
+
+def _msi_column_size(column_type, ref_size):
+    if column_type & ~_MSI_TYPE_NULLABLE == _MSI_TYPE_STRING | _MSI_TYPE_VALID:
+        # A binary column, stored in a stream of its own.
+        return 2
+    if column_type & _MSI_TYPE_STRING:
+        return ref_size
+    return 2 if column_type & 0xff <= 2 else 4
+
+
+def _msi_rows(data, types, ref_size):
+    """
+    Read a table stream, the values are stored column by column. The integers are stored with the sign bit flipped,
+    and 0 is null.
+    :return: A list of the rows, each is a list of the integer values (or string ids).
+    """
+    sizes = [_msi_column_size(column_type, ref_size) for column_type in types]
+    count = len(data) // sum(sizes) if sizes else 0
+    columns = []
+    offset = 0
+    for column_type, size in zip(types, sizes):
+        if size == 2:
+            values = list(struct.unpack_from('<{0}H'.format(count), data, offset))
+        elif size == 4:
+            values = list(struct.unpack_from('<{0}I'.format(count), data, offset))
+        else:
+            # The long string references take 3 bytes.
+            parts = struct.unpack_from('<' + 'HB' * count, data, offset)
+            values = [low | (high << 16) for low, high in zip(parts[::2], parts[1::2])]
+        if not column_type & _MSI_TYPE_STRING:
+            values = [value - (1 << (8 * size - 1)) if value else None for value in values]
+        columns.append(values)
+        offset += size * count
+    return [list(row) for row in zip(*columns)]
+
+
+def _msi_table(read, columns, strings, ref_size, name):
+    """
+    :return: The rows of the table as dicts of the column names to the values.
+    """
+    if name not in columns:
+        return []
+    names = [column for column, column_type in columns[name]]
+    types = [column_type for column, column_type in columns[name]]
+    rows = []
+    for row in _msi_rows(read('!' + name), types, ref_size):
+        for i, column_type in enumerate(types):
+            if column_type & _MSI_TYPE_STRING:
+                row[i] = strings[row[i]] if 0 < row[i] < len(strings) else None
+        rows.append(dict(zip(names, row)))
+    return rows
+
+
+def _msi_entries(file_path):
+    if olefile is None:
+        raise ManifestError('Index {0} needs olefile.'.format(os.path.basename(file_path)))
+    # Keep the stream names in unicode to decode them.
+    ole = olefile.OleFileIO(file_path, path_encoding=None)
+    try:
+        streams = dict((_decode_msi_name(entry[0]), entry) for entry in ole.listdir() if len(entry) == 1)
+
+        def read(stream_name):
+            # The table streams are small, the files are in the cab streams which are not read.
+            return ole.openstream(streams[stream_name]).read() if stream_name in streams else ''
+
+        strings, ref_size = _msi_strings(read('!_StringPool'), read('!_StringData'))
+        columns = dict()
+        for table, number, name, column_type in _msi_rows(read('!_Columns'), _MSI_COLUMNS_TYPES, ref_size):
+            columns.setdefault(strings[table], []).append((number, strings[name], column_type))
+        columns = dict((table, [(name, column_type) for number, name, column_type in sorted(table_columns)])
+                       for table, table_columns in columns.items())
+        directories = dict((row['Directory'], row) for row in _msi_table(read, columns, strings, ref_size,
+                                                                          'Directory'))
+        components = dict((row['Component'], row['Directory_']) for row in _msi_table(read, columns, strings,
+                                                                                       ref_size, 'Component'))
+        files = _msi_table(read, columns, strings, ref_size, 'File')
+    finally:
+        ole.close()
+
+    paths = dict()
+
+    def directory_path(key, depth=0):
+        if key in paths:
+            return paths[key]
+        row = directories.get(key)
+        # The root (TARGETDIR) has no parent.
+        if not row or not row['Directory_Parent'] or row['Directory_Parent'] == key or depth > 64:
+            return ''
+        # DefaultDir is target[:source], each is short|long, '.' means the parent itself.
+        name = (row['DefaultDir'] or '.').split(':')[0].split('|')[-1]
+        parent = directory_path(row['Directory_Parent'], depth + 1)
+        paths[key] = parent if name == '.' else posixpath.join(parent, name)
+        return paths[key]
+
+    entries = []
+    for row in files:
+        name = (row['FileName'] or '').split('|')[-1]
+        entries.append([posixpath.join(directory_path(components.get(row['Component_'])), name),
+                        row['FileSize'] or 0, None, 'file', row.get('Version')])
+    return entries
+
+
+class ManifestIndexer(Logging):
+    def __init__(self, catalog, follow_catalog=True):
+        """
+        Index the files in the packages of the catalog. The packages added to the catalog are indexed one at a time in
+        a background thread (see start), so that neither the downloads nor the web server wait for it. The others (e.g.
+        downloaded before) are indexed when they are asked for, see index.
+        :param catalog: The BuildCatalog to save the manifests.
+        :param follow_catalog: Index the packages added to the catalog, set to False to index only on demand (e.g. in
+        the web server process while the worker indexes the new ones).
+        """
+        super(ManifestIndexer, self).__init__()
+        self.catalog = catalog
+        self._queue = Queue.Queue()
+        if follow_catalog:
+            catalog.subscribe(self._on_catalog_changed)
+
+    def start(self):
+        thread = Thread(target=self._run, name='ManifestIndexer')
+        thread.daemon = True
+        thread.start()
+
+    def _on_catalog_changed(self, event, record):
+        if event == 'add' and can_index(record['file_name']):
+            self._queue.put(record['path'])
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            try:
+                self.index(os.path.join(self.catalog.root_path, path))
+            except ManifestError, e:
+                self.logger.warning(e)
+            except Exception, e:
+                # e.g. the database is locked by the other process, keep indexing the others.
+                self.logger.error('Index {0} failed: {1}'.format(path, e), exc_info=True)
+
+    def index(self, file_path):
+        """
+        Notice it reads through the package, call it in a thread.
+        :return: The manifest of the package, which is built and saved if it is not indexed yet.
+        """
+        entries = self.catalog.get_manifest(file_path)
+        if entries is not None:
+            return entries
+        record = self.catalog.get(file_path)
+        if not record:
+            raise ManifestError('{0} is not in the catalog.'.format(self.catalog.relative_path(file_path)))
+        start = time.time()
+        entries = build_manifest(file_path)
+        # The package could be deleted (or downloaded again) while indexing.
+        current = self.catalog.get(file_path)
+        if current and current['downloaded_at'] == record['downloaded_at']:
+            self.catalog.set_manifest(file_path, entries)
+        self.logger.info('{0} files of {1} are indexed in {2:.1f}s.'.format(len(entries), record['path'],
+                                                                           time.time() - start))
+        return entries
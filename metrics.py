@@ -0,0 +1,303 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+# The upper bounds (seconds) of the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+# The rate of a transfer is measured over at least this many seconds.
+_RATE_WINDOW = 1
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+class Metric(object):
+    type = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = Lock()
+        # The values by the sorted (label name, label value) tuples.
+        self._values = dict()
+
+    def collect(self):
+        """
+        :return: A list of (labels, value) of the metric.
+        """
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self, samples=None):
+        """
+        :param samples: The (labels, value) list to render, default is the collected values.
+        """
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.type)]
+        for labels, value in self.collect() if samples is None else samples:
+            lines.append('{0}{1} {2}'.format(self.name, _format_labels(labels), value))
+        return lines
+
+    def to_dict(self, samples=None):
+        return {'type': self.type, 'help': self.help,
+                'values': [{'labels': dict(labels), 'value': value}
+                           for labels, value in (self.collect() if samples is None else samples)]}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help_text, function=None):
+        """
+        :param function: Returns the value, or a list of (labels dict, value), when the metric is collected.
+        """
+        super(Gauge, self).__init__(name, help_text)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def collect(self):
+        if not self.function:
+            return super(Gauge, self).collect()
+        value = self.function()
+        if isinstance(value, list):
+            return sorted((tuple(sorted(labels.items())), v) for labels, v in value)
+        return [((), value)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help_text)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['count'] += 1
+            state['sum'] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds spent in the block.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def collect(self):
+        with self._lock:
+            return sorted((labels, dict(state, counts=list(state['counts']))) for labels, state in self._values.items())
+
+    def render(self, samples=None):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.type)]
+        for labels, state in self.collect() if samples is None else samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(labels + (('le', bound),)),
+                                                        cumulative))
+            lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(labels + (('le', '+Inf'),)),
+                                                    state['count']))
+            lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(labels), state['sum']))
+            lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(labels), state['count']))
+        return lines
+
+    def to_dict(self, samples=None):
+        return {'type': self.type, 'help': self.help, 'buckets': list(self.buckets),
+                'values': [{'labels': dict(labels), 'count': state['count'], 'sum': state['sum'],
+                            'counts': state['counts']}
+                           for labels, state in (self.collect() if samples is None else samples)]}
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = []
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text, function=None):
+        return self._register(Gauge(name, help_text, function))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def collect(self):
+        """
+        :return: A dict maps the metric names to their (labels, value) lists, which can be sent to another process.
+        """
+        return dict((metric.name, metric.collect()) for metric in list(self._metrics))
+
+    def _merge(self, metric, processes):
+        """
+        :param processes: A dict maps the process names to their collected metrics (see collect), e.g. the local ones
+        and the ones from the worker process.
+        :return: The samples of the metric from all the processes, labeled with the process.
+        """
+        samples = []
+        for process, collected in sorted(processes.items()):
+            for labels, value in collected.get(metric.name, []):
+                # The labels are lists after a json round trip.
+                samples.append((tuple(tuple(label) for label in labels) + (('process', process),), value))
+        return samples
+
+    def render_text(self, processes=None):
+        """
+        :param processes: Render the metrics of several processes, see _merge.
+        :return: All the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in list(self._metrics):
+            lines.extend(metric.render(self._merge(metric, processes) if processes else None))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self, processes=None):
+        return dict((metric.name, metric.to_dict(self._merge(metric, processes) if processes else None))
+                    for metric in list(self._metrics))
+
+
+class TransferProgress(object):
+    """
+    The progress of one package in downloading.
+    """
+
+    def __init__(self, key, url):
+        self.key = key
+        self.url = url
+        self.size = None
+        self.received = 0
+        self.started_at = time.time()
+        self.rate = 0
+        self._lock = Lock()
+        self._sample = (self.started_at, 0)
+
+    def add(self, length):
+        with self._lock:
+            self.received += length
+
+    def reset(self, size, received=0):
+        """
+        Restart the progress when a (resumed) download starts.
+        """
+        with self._lock:
+            self.size = size
+            self.received = received
+            self._sample = (time.time(), received)
+
+    def to_dict(self, now=None):
+        now = now if now else time.time()
+        with self._lock:
+            sample_time, sample_received = self._sample
+            if now - sample_time >= _RATE_WINDOW:
+                self.rate = (self.received - sample_received) / (now - sample_time)
+                self._sample = (now, self.received)
+            received = self.received
+        eta = (self.size - received) / self.rate if self.size and self.rate else None
+        return {'key': self.key, 'url': self.url, 'size': self.size, 'received': received,
+                'started_at': self.started_at, 'percent': round(100.0 * received / self.size, 1) if self.size else None,
+                'rate': self.rate, 'elapsed': now - self.started_at, 'eta': eta}
+
+
+class ProgressRegistry(object):
+    def __init__(self):
+        """
+        The packages in downloading of both engines, for the live progress view.
+        """
+        self._lock = Lock()
+        self._transfers = dict()
+
+    def start(self, key, url):
+        progress = TransferProgress(key, url)
+        with self._lock:
+            self._transfers[id(progress)] = progress
+        return progress
+
+    def finish(self, progress):
+        with self._lock:
+            self._transfers.pop(id(progress), None)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            transfers = self._transfers.values()
+        return sorted((progress.to_dict(now) for progress in transfers), key=lambda t: t['started_at'])
+
+
+# Shared by all the downloads and the web server of this process.
+METRICS = MetricsRegistry()
+TRANSFERS = ProgressRegistry()
+
+DOWNLOAD_BYTES = METRICS.counter('splunkbmd_download_bytes_total', 'Bytes received by the downloads.')
+DOWNLOADS = METRICS.counter('splunkbmd_downloads_total', 'Finished downloads by result.')
+DOWNLOAD_RETRIES = METRICS.counter('splunkbmd_download_retries_total', 'Download tries failed and retried.')
+DOWNLOAD_QUEUE = METRICS.gauge('splunkbmd_download_queue_depth', 'Packages waiting for a download slot.')
+METRICS.gauge('splunkbmd_downloads_in_flight', 'Packages in downloading.', lambda: len(TRANSFERS.snapshot()))
+METRICS.gauge('splunkbmd_download_rate_bytes', 'Bytes/s received by all the downloads.',
+              lambda: sum(transfer['rate'] for transfer in TRANSFERS.snapshot()))
+METRICS.gauge('splunkbmd_transfer_rate_bytes', 'Bytes/s received by each download.',
+              lambda: [({'key': transfer['key']}, transfer['rate']) for transfer in TRANSFERS.snapshot()])
+STORE_LINKED_BYTES = METRICS.counter('splunkbmd_store_linked_bytes_total',
+                                     'Bytes linked from the object store instead of downloaded.')
+DELTA_REUSED_BYTES = METRICS.counter('splunkbmd_delta_reused_bytes_total',
+                                     'Bytes copied from the previous builds instead of downloaded.')
+RESOLVE_SECONDS = METRICS.histogram('splunkbmd_resolve_seconds', 'Seconds to resolve a package url by the source.')
+MD5_SECONDS = METRICS.histogram('splunkbmd_md5_seconds',
+                                'Seconds to fetch the md5 check sum or to digest a downloaded file.')
+CYCLE_SECONDS = METRICS.histogram('splunkbmd_cycle_seconds', 'Seconds of a fetch cycle.',
+                                  buckets=(60, 300, 600, 1800, 3600, 7200, 14400, 28800))
+HTTP_REQUEST_SECONDS = METRICS.histogram('splunkbmd_http_request_seconds',
+                                         'Seconds to serve a web request by the response code.')
+HTTP_RESPONSE_BYTES = METRICS.counter('splunkbmd_http_response_bytes_total', 'Bytes served by the web server.')
+EVENTS = METRICS.counter('splunkbmd_events_total', 'Events of the packages added or removed, by the event.')
+WEBHOOK_POSTS = METRICS.counter('splunkbmd_webhook_posts_total', 'Batches of events posted to the webhooks by result.')
@@ -0,0 +1,109 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import time
+import requests
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from logging_base import Logging
+from settings import MIRROR_PEERS, MAX_CONCURRENT_THREADS
+
+# A peer which can not be reached is not asked again in this period (seconds).
+_PEER_RETRY_INTERVAL = 300
+
+# The seconds to wait for a peer to answer its catalog.
+_PEER_TIMEOUT = 5
+
+# The seconds to wait for a peer to answer a block index, which could be built for the request.
+_INDEX_TIMEOUT = 120
+
+# The weight of the newest sample in the (moving average) latency of a peer.
+_LATENCY_WEIGHT = 0.3
+
+_SESSION = requests.session()
+_SESSION.mount('http', HTTPAdapter(pool_maxsize=MAX_CONCURRENT_THREADS))
+
+
+class PeerMirror(Logging):
+    def __init__(self, peers=MIRROR_PEERS):
+        """
+        Locate the packages in the catalogs of the peers (other splunkbmd web servers), so that a package is only
+        downloaded from releases.splunk.com once and the other nodes replicate it from the nearest peer.
+        :param peers: The base urls of the peers, e.g. ['http://lab2:8080'].
+        """
+        super(PeerMirror, self).__init__()
+        self.peers = [peer.rstrip('/') for peer in peers]
+        self._lock = Lock()
+        self._latency = dict()
+        self._down_until = dict()
+
+    def _query(self, peer, file_name):
+        """
+        :return: The catalog record (with href) of the package in the peer, or None if the peer does not have it.
+        """
+        if self._down_until.get(peer, 0) > time.time():
+            return None
+        start = time.time()
+        try:
+            response = _SESSION.get(peer + '/api/builds', params={'file_name': file_name, 'limit': 1},
+                                    timeout=_PEER_TIMEOUT)
+            response.raise_for_status()
+            builds = response.json()['builds']
+        except (requests.RequestException, ValueError, KeyError), e:
+            self.logger.warning('Peer {0} is down: {1}'.format(peer, e))
+            with self._lock:
+                self._down_until[peer] = time.time() + _PEER_RETRY_INTERVAL
+            return None
+        latency = time.time() - start
+        with self._lock:
+            last = self._latency.get(peer)
+            self._latency[peer] = latency if last is None else last + (latency - last) * _LATENCY_WEIGHT
+        return builds[0] if builds else None
+
+    def _find(self, file_name):
+        """
+        Ask all the peers at the same time for the package.
+        :return: A tuple of (the nearest peer which has the package, its catalog record), or None.
+        """
+        if not self.peers:
+            return None
+        thread_pool = ThreadPool(processes=len(self.peers))
+        try:
+            records = thread_pool.map(lambda peer: self._query(peer, file_name), self.peers)
+        finally:
+            thread_pool.close()
+        found = [(self._latency[peer], peer, record) for peer, record in zip(self.peers, records) if record]
+        if not found:
+            return None
+        latency, peer, record = min(found)
+        return peer, record
+
+    def locate(self, file_name):
+        """
+        :return: A tuple of (url, md5 check sum) of the package in the nearest peer which has it, or None.
+        """
+        found = self._find(file_name)
+        if not found:
+            return None
+        peer, record = found
+        return peer + record['href'], record['md5']
+
+    def get_block_index(self, file_name):
+        """
+        :return: The block index (see delta.build_index) of the package from the nearest peer which has it, or None.
+        """
+        found = self._find(file_name)
+        if not found:
+            return None
+        peer, record = found
+        try:
+            response = _SESSION.get(peer + '/api/blocks' + record['href'], timeout=_INDEX_TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError), e:
+            self.logger.warning('Get the block index from peer {0} failed: {1}'.format(peer, e))
+            return None
+
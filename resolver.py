@@ -0,0 +1,159 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import json
+import os
+import time
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from urlparse import urljoin
+from requests.adapters import HTTPAdapter
+from catalog import parse_package_name
+from logging_base import Logging
+from scraper import HTML_PARSER, get_download_page_url
+from settings import MAX_CONCURRENT_THREADS, PLATFORM_PACKAGES, RESOLVE_CACHE_TTL
+
+# The resolved urls and md5 check sums are cached under the root dir, hidden from the web server.
+_CACHE_FILE_NAME = '.resolve_cache.json'
+
+_SESSION = requests.session()
+_SESSION.mount('http', HTTPAdapter(pool_maxsize=MAX_CONCURRENT_THREADS))
+
+
+def _make_key(package_type, branch, build, platform_package):
+    return '/'.join((package_type, branch, str(build), platform_package))
+
+
+class UrlResolver(Logging):
+    def __init__(self, root_path, ttl=RESOLVE_CACHE_TTL):
+        """
+        Resolve the package urls of the latest builds in bulk from the download pages linked in the release page,
+        the build fetcher is only asked for the ones not found there.
+        :param root_path: The root dir path to save the downloaded builds, the cache is saved there.
+        :param ttl: The seconds a resolved url or md5 check sum is cached.
+        """
+        super(UrlResolver, self).__init__()
+        self.cache_path = os.path.join(root_path, _CACHE_FILE_NAME)
+        self.ttl = ttl
+        self._lock = Lock()
+        # The cache is changed in memory by each lookup, and saved at once by save (e.g. at the end of a cycle).
+        self._save_lock = Lock()
+        self._dirty = False
+        self._cache = {'urls': {}, 'md5': {}}
+        if os.path.isfile(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    self._cache.update(json.load(f))
+            except (IOError, ValueError):
+                self.logger.warning('The resolve cache is broken, ignore it.')
+
+    @staticmethod
+    def _key(downloader):
+        return _make_key(downloader.package_type, downloader.branch, downloader.build, downloader.platform_package)
+
+    def _get(self, section, key):
+        with self._lock:
+            entry = self._cache[section].get(key)
+        if entry and entry[1] > time.time() - self.ttl:
+            return entry[0]
+        return None
+
+    def _set(self, values, section):
+        with self._lock:
+            now = time.time()
+            for key, value in values.items():
+                self._cache[section][key] = (value, now)
+            self._dirty = True
+
+    def save(self):
+        """
+        Save the cache if it is changed, it is written out of the lock so that the lookups do not wait for the disk.
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                # Drop the expired entries so the cache does not grow with the deleted branches.
+                expired_time = time.time() - self.ttl
+                for entries in self._cache.values():
+                    for key, entry in entries.items():
+                        if entry[1] <= expired_time:
+                            del entries[key]
+                data = json.dumps(self._cache)
+                self._dirty = False
+            with open(self.cache_path + '.tmp', 'w') as f:
+                f.write(data)
+            os.rename(self.cache_path + '.tmp', self.cache_path)
+
+    def get_url(self, downloader):
+        """
+        :return: The cached package url of the downloader, None if it is not cached or expired.
+        """
+        return self._get('urls', self._key(downloader))
+
+    def set_url(self, downloader, url):
+        self._set({self._key(downloader): url}, 'urls')
+
+    def get_md5(self, url):
+        """
+        :return: The cached md5 check sum of the package url, None if it is not cached or expired.
+        """
+        return self._get('md5', url)
+
+    def set_md5(self, url, check_sum):
+        self._set({url: check_sum}, 'md5')
+
+    def prefetch(self, page, branch_list, force=False):
+        """
+        Resolve the latest package urls of the branches from their download pages, concurrently.
+        :param page: The ReleasePage.
+        :param force: If True, resolve all the branches even if their urls are cached.
+        """
+        links = dict()
+        for row in page.rows:
+            # The first row of a branch is its latest build.
+            if row['branch'] in branch_list and row['branch'] not in links:
+                links[row['branch']] = row['link']
+        if not force:
+            for branch in links.keys():
+                if all(self._get('urls', _make_key('splunk', branch, 'latest', platform_pkg))
+                       for platform_pkg in PLATFORM_PACKAGES):
+                    del links[branch]
+        if not links:
+            return
+        thread_pool = ThreadPool(processes=min(MAX_CONCURRENT_THREADS, len(links)))
+        try:
+            results = thread_pool.map(self._get_package_urls, links.values())
+        finally:
+            thread_pool.close()
+        urls = dict()
+        for branch, package_urls in zip(links.keys(), results):
+            for platform_pkg, url in package_urls.items():
+                urls[_make_key('splunk', branch, 'latest', platform_pkg)] = url
+        self.logger.info('Resolved {0} package urls of {1} branches from the download pages.'.format(len(urls),
+                                                                                                     len(links)))
+        self._set(urls, 'urls')
+        self.save()
+
+    def _get_package_urls(self, link):
+        """
+        :return: A dict maps the platform packages to the splunk package urls in the download page.
+        """
+        page_url = get_download_page_url(link)
+        try:
+            content = _SESSION.get(page_url).content
+        except requests.RequestException, e:
+            self.logger.warning('Get download page {0} failed: {1}'.format(page_url, e))
+            return dict()
+        urls = dict()
+        for tag in BeautifulSoup(content, HTML_PARSER, parse_only=SoupStrainer('a')).find_all('a'):
+            href = tag.attrs.get('href', '')
+            package = parse_package_name(href.split('/')[-1])
+            if package and package[0] == 'splunk' and package[3] in PLATFORM_PACKAGES:
+                urls.setdefault(package[3], urljoin(page_url, href))
+        return urls
+
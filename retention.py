@@ -0,0 +1,138 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import os
+import re
+import time
+from threading import Lock
+from logging_base import Logging
+from settings import EXPIRE_DAYS, NEVER_DELETE_BRANCH, ROOT_DIR_QUOTA, BRANCH_WEIGHTS
+
+
+def get_branch_weight(branch):
+    for pattern, weight in BRANCH_WEIGHTS:
+        if re.match(pattern, branch):
+            return weight
+    return 1
+
+
+class RetentionEngine(Logging):
+    def __init__(self, catalog, quota=ROOT_DIR_QUOTA, expire_days=EXPIRE_DAYS, follow_catalog=True):
+        """
+        Decide which packages to delete: the expired ones first, then the least recently used ones (weighted by the
+        branch) until the packages fit in the quota.
+        :param catalog: The BuildCatalog, it is loaded into an in-memory index once.
+        :param quota: Max bytes of all the packages on disk, 0 means unlimited. The packages linked to the same blob in
+        the store are counted once.
+        :param follow_catalog: Keep the index up to date with the changes of the catalog, set to False for one-off use.
+        """
+        super(RetentionEngine, self).__init__()
+        self.catalog = catalog
+        self.quota = quota
+        self.expire_days = expire_days
+        self._lock = Lock()
+        self._index = dict((record['path'], record) for record in catalog.find())
+        if follow_catalog:
+            catalog.subscribe(self._on_catalog_changed)
+
+    def _on_catalog_changed(self, event, record):
+        with self._lock:
+            if event == 'add':
+                self._index[record['path']] = dict(record)
+            elif event == 'remove':
+                self._index.pop(record['path'], None)
+            elif event == 'access' and record['path'] in self._index:
+                self._index[record['path']]['last_accessed'] = record['last_accessed']
+
+    def _content_key(self, record):
+        # The packages with the same md5 are links to one blob of the store.
+        return record['md5'] if self.catalog.store and record['md5'] else record['path']
+
+    def disk_usage(self, excludes=()):
+        """
+        :param excludes: The paths of the packages not counted in, e.g. the ones to delete.
+        :return: The bytes of the packages on disk.
+        """
+        with self._lock:
+            records = self._index.values()
+        return sum(dict((self._content_key(record), record['size']) for record in records
+                        if record['path'] not in excludes).values())
+
+    @property
+    def total_size(self):
+        return self.disk_usage()
+
+    @staticmethod
+    def _idle_score(record, now):
+        """
+        The weighted seconds since the package was last used, the highest one is deleted first.
+        """
+        last_used = max(record['last_accessed'] or 0, record['downloaded_at'])
+        return (now - last_used) / float(get_branch_weight(record['branch'] or record['folder']))
+
+    def plan(self, pinned_builds=()):
+        """
+        :param pinned_builds: The build numbers never to delete, e.g. the RC builds.
+        :return: A list of (record, reason) of the packages to delete, the reason is 'expired' or 'quota'.
+        """
+        now = time.time()
+        with self._lock:
+            records = self._index.values()
+        groups = dict()
+        for record in records:
+            if record['folder'] in NEVER_DELETE_BRANCH or record['build'] in pinned_builds:
+                continue
+            groups.setdefault((record['folder'], record['platform_package']), []).append(record)
+
+        candidates = []
+        for group in groups.values():
+            # The newest package (of that platform) in each folder is always kept.
+            group.sort(key=lambda r: r['downloaded_at'])
+            candidates.extend(group[:-1])
+
+        expire_time = now - self.expire_days * 3600 * 24
+        expired = [record for record in candidates if record['downloaded_at'] < expire_time]
+        unexpired = sorted([record for record in candidates if record['downloaded_at'] >= expire_time],
+                           key=lambda r: self._idle_score(r, now), reverse=True)
+        links = dict()
+        for record in records:
+            key = self._content_key(record)
+            links[key] = links.get(key, 0) + 1
+        remaining = sum(dict((self._content_key(record), record['size']) for record in records).values())
+        deletes = []
+        for reason, record in [('expired', r) for r in expired] + [('quota', r) for r in unexpired]:
+            if reason == 'quota' and (not self.quota or remaining <= self.quota):
+                break
+            deletes.append((record, reason))
+            key = self._content_key(record)
+            links[key] -= 1
+            # The disk space of a blob is freed with its last link.
+            if not links[key]:
+                remaining -= record['size']
+        if self.quota and remaining > self.quota:
+            self.logger.warning('The pinned packages ({0} bytes) exceed the quota ({1} bytes).'.format(
+                remaining, self.quota))
+        return deletes
+
+    def run(self, pinned_builds=(), dry_run=False):
+        """
+        Delete the packages by the plan.
+        :param dry_run: If True, only report the packages to delete.
+        :return: The plan, see plan.
+        """
+        # The access times recorded by the web server.
+        self.catalog.flush_accesses()
+        deletes = self.plan(pinned_builds)
+        for record, reason in deletes:
+            file_path = os.path.join(self.catalog.root_path, record['path'])
+            if dry_run:
+                self.logger.info('{0} ({1} bytes) would be deleted due to {2}.'.format(file_path, record['size'],
+                                                                                       reason))
+                continue
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+            self.catalog.remove(file_path)
+            self.logger.info('{0} is deleted due to {1}.'.format(file_path, reason))
+        return deletes
@@ -0,0 +1,224 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import itertools
+import re
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from Queue import PriorityQueue, Empty
+from threading import Condition, Lock, Thread
+from urlparse import urlparse
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from logging_base import Logging
+from metrics import DOWNLOAD_QUEUE
+from settings import MAX_CONCURRENT_THREADS, MUST_DOWNLOAD_BRANCH, CURRENT_BRANCH_REGEX, BANDWIDTH_LIMIT, \
+    BANDWIDTH_WINDOWS, MAX_CONNECTIONS_PER_HOST
+
+# The priority classes of downloads, the smaller one is downloaded first.
+PRIORITY_MUST = 0
+PRIORITY_CURRENT = 1
+PRIORITY_OTHER = 2
+
+
+def get_priority(branch, rc_branches=()):
+    """
+    MUST_DOWNLOAD_BRANCH and the branches with RC builds first, then current branches, then the rest.
+    """
+    if branch in MUST_DOWNLOAD_BRANCH or branch in rc_branches:
+        return PRIORITY_MUST
+    for pattern in CURRENT_BRANCH_REGEX:
+        if re.match(pattern, branch):
+            return PRIORITY_CURRENT
+    return PRIORITY_OTHER
+
+
+def _minutes(hh_mm):
+    hour, minute = hh_mm.split(':')
+    return int(hour) * 60 + int(minute)
+
+
+def get_bandwidth_limit(now=None):
+    """
+    :return: The aggregate bandwidth limit (bytes/s) at the time, 0 means unlimited.
+    """
+    now = now if now else datetime.now()
+    minute = now.hour * 60 + now.minute
+    for start, end, limit in BANDWIDTH_WINDOWS:
+        start, end = _minutes(start), _minutes(end)
+        # A window like ('22:00', '06:00') crosses midnight.
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            return limit
+    return BANDWIDTH_LIMIT
+
+
+class TokenBucket(object):
+    def __init__(self, get_rate=get_bandwidth_limit):
+        """
+        A token bucket shared by all the downloads, refilled at the rate (bytes/s) with a burst of one second.
+        :param get_rate: Returns the current rate, 0 means unlimited.
+        """
+        self.get_rate = get_rate
+        self._lock = Lock()
+        self._tokens = 0
+        self._last = time.time()
+
+    def consume(self, size):
+        """
+        Take the tokens of the received bytes.
+        :return: The seconds to wait before receiving more data, the bucket goes into debt instead of blocking.
+        """
+        rate = self.get_rate()
+        if not rate:
+            return 0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(rate, self._tokens + (now - self._last) * rate) - size
+            self._last = now
+            return -self._tokens / float(rate) if self._tokens < 0 else 0
+
+    def throttle(self, size):
+        """
+        Block the current thread until the received bytes are allowed.
+        """
+        wait = self.consume(size)
+        if wait:
+            time.sleep(wait)
+
+
+def _host(url):
+    return urlparse(url).netloc
+
+
+class HostLimiter(object):
+    def __init__(self, max_connections=MAX_CONNECTIONS_PER_HOST):
+        """
+        Limit the number of concurrent download connections to each host. The download threads and the reactor engine
+        share the same slots of a host, a freed slot is given to the reactor engine first if both are waiting.
+        """
+        self.max_connections = max_connections
+        self._lock = Lock()
+        self._condition = Condition(self._lock)
+        # The slots in use and the deferreds of the reactor engine waiting for one, by the hosts.
+        self._active = dict()
+        self._waiters = dict()
+
+    def _release(self, host):
+        with self._lock:
+            waiters = self._waiters.get(host)
+            if waiters:
+                # Hand the slot over to the waiting deferred, it is fired in the reactor thread.
+                reactor.callFromThread(self._grant, waiters.popleft(), host)
+                return
+            self._active[host] -= 1
+            # The threads of all the hosts wait on the same condition.
+            self._condition.notify_all()
+
+    def _grant(self, d, host):
+        if d.called:
+            # It is cancelled after given the slot.
+            self._release(host)
+        else:
+            d.callback(self._releaser(host))
+
+    def _releaser(self, host):
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self._release(host)
+
+        return release
+
+    @contextmanager
+    def slot(self, url):
+        """
+        Hold a connection slot of the url's host in the block (for the download threads).
+        """
+        if not self.max_connections:
+            yield
+            return
+        host = _host(url)
+        with self._lock:
+            while self._active.get(host, 0) >= self.max_connections:
+                self._condition.wait()
+            self._active[host] = self._active.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            self._release(host)
+
+    def acquire(self, url):
+        """
+        Wait for a connection slot of the url's host (for the reactor engine).
+        :return: A deferred fires with a function to release the slot.
+        """
+        if not self.max_connections:
+            return succeed(lambda: None)
+        host = _host(url)
+        with self._lock:
+            if self._active.get(host, 0) < self.max_connections:
+                self._active[host] = self._active.get(host, 0) + 1
+                return succeed(self._releaser(host))
+            waiters = self._waiters.setdefault(host, deque())
+
+            def cancel(d):
+                with self._lock:
+                    if d in waiters:
+                        waiters.remove(d)
+
+            d = Deferred(cancel)
+            waiters.append(d)
+            return d
+
+
+# Shared by all the downloads of this process.
+BANDWIDTH = TokenBucket()
+HOSTS = HostLimiter()
+
+
+class DownloadScheduler(Logging):
+    def __init__(self, workers=MAX_CONCURRENT_THREADS):
+        """
+        Run the downloads in worker threads, the ones with higher priority (smaller number) first.
+        """
+        super(DownloadScheduler, self).__init__()
+        self.workers = workers
+        self._queue = PriorityQueue()
+        self._counter = itertools.count()
+
+    def submit(self, downloader, priority=PRIORITY_OTHER):
+        # The counter keeps the submitted order in the same priority.
+        self._queue.put((priority, next(self._counter), downloader))
+        DOWNLOAD_QUEUE.inc()
+
+    @property
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            try:
+                priority, _, downloader = self._queue.get_nowait()
+            except Empty:
+                return
+            DOWNLOAD_QUEUE.dec()
+            try:
+                downloader.start_download()
+            except Exception, e:
+                downloader.logger.error('Download package failed: {0}'.format(e), exc_info=True)
+
+    def run(self):
+        """
+        Download all the submitted packages, block until all of them end.
+        """
+        threads = [Thread(target=self._work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
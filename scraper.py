@@ -0,0 +1,164 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import json
+import os
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+from multiprocessing.pool import ThreadPool
+from logging_base import Logging
+from settings import MAX_CONCURRENT_THREADS, PLATFORM_PACKAGES, RELEASE_SERVER
+
+_BASE_URL = RELEASE_SERVER
+_RELEASE_URL = RELEASE_SERVER + '/status.html'
+
+# The scraped release page is cached under the root dir, hidden from the web server.
+_CACHE_FILE_NAME = '.release_cache.json'
+
+# The background color of the RC build rows in the release page.
+_RC_COLOR = '#54C944'
+
+# Use the faster lxml parser if it is installed.
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+_SESSION = requests.session()
+
+
+def get_download_page_url(link):
+    """
+    :return: The absolute url of a download page link in the release page.
+    """
+    return _BASE_URL + '/' + link
+
+
+def _cells(tag):
+    return [child for child in tag.contents if getattr(child, 'name', None)]
+
+
+class ReleasePage(object):
+    def __init__(self, branches=None, rows=None, changed=True):
+        """
+        The parsed model of the release page (status.html).
+        :param branches: All the branch names in the page.
+        :param rows: A list of dicts contain the branch, download page link, label and whether it is an RC build of
+        each build row in the page.
+        :param changed: False if the page is not modified since the last scrape.
+        """
+        self.branches = branches if branches else []
+        self.rows = rows if rows else []
+        self.changed = changed
+
+    @classmethod
+    def parse(cls, content):
+        """
+        Parse the release page once, only the branch titles and the build rows are parsed.
+        """
+        parsed_html = BeautifulSoup(content, HTML_PARSER, parse_only=SoupStrainer(['center', 'tr']))
+        branches = []
+        for tag in parsed_html.find_all('center'):
+            if tag.string and tag.string.startswith('Branch: '):
+                branch_name = tag.string.replace('Branch: ', '').strip()
+                if branch_name:
+                    branches.append(branch_name)
+        rows = []
+        for tag in parsed_html.find_all('tr'):
+            cells = _cells(tag)
+            if len(cells) < 3 or not cells[1].find('a'):
+                continue
+            link = cells[1].find('a').attrs.get('href')
+            if link:
+                rows.append({'branch': cells[0].text.strip(), 'link': link, 'label': cells[2].text.strip(),
+                             'rc': tag.attrs.get('bgcolor', '').upper() == _RC_COLOR.upper()})
+        return cls(branches, rows)
+
+    def to_dict(self):
+        return {'branches': self.branches, 'rows': self.rows}
+
+
+class ReleaseScraper(Logging):
+    def __init__(self, root_path):
+        """
+        Scrape the release page of RELEASE_SERVER, the page and the RC build numbers are cached across cycles.
+        :param root_path: The root dir path to save the downloaded builds, the cache is saved there.
+        """
+        super(ReleaseScraper, self).__init__()
+        self.cache_path = os.path.join(root_path, _CACHE_FILE_NAME)
+        self._cache = {'etag': None, 'last_modified': None, 'page': None, 'rc_builds': {}}
+        if os.path.isfile(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    self._cache.update(json.load(f))
+            except (IOError, ValueError):
+                self.logger.warning('The release page cache is broken, ignore it.')
+
+    def _save_cache(self):
+        with open(self.cache_path + '.tmp', 'w') as f:
+            json.dump(self._cache, f)
+        os.rename(self.cache_path + '.tmp', self.cache_path)
+
+    def get_release_page(self):
+        """
+        Get the release page by a conditional GET, it is parsed only if it is modified.
+        :rtype: ReleasePage
+        """
+        headers = dict()
+        if self._cache['page'] is not None:
+            if self._cache['etag']:
+                headers['If-None-Match'] = self._cache['etag']
+            if self._cache['last_modified']:
+                headers['If-Modified-Since'] = self._cache['last_modified']
+        response = _SESSION.get(_RELEASE_URL, headers=headers)
+        if response.status_code == 304:
+            self.logger.info('The release page is not modified.')
+            page = self._cache['page']
+            return ReleasePage(page['branches'], page['rows'], changed=False)
+        response.raise_for_status()
+        page = ReleasePage.parse(response.content)
+        self._cache['etag'] = response.headers.get('etag')
+        self._cache['last_modified'] = response.headers.get('last-modified')
+        self._cache['page'] = page.to_dict()
+        self._save_cache()
+        return page
+
+    def get_rc_builds(self, page, branch_list):
+        """
+        :return: A dict maps the RC labels to (branch, build number) of the given branches.
+        """
+        rc_rows = [row for row in page.rows if row['rc'] and row['branch'] in branch_list]
+        # The commit number of an RC never changes, only the new ones are fetched (concurrently).
+        new_links = list(set(row['link'] for row in rc_rows if row['link'] not in self._cache['rc_builds']))
+        if new_links:
+            thread_pool = ThreadPool(processes=min(MAX_CONCURRENT_THREADS, len(new_links)))
+            try:
+                build_numbers = thread_pool.map(self._get_commit_number, new_links)
+            finally:
+                thread_pool.close()
+            for link, build_number in zip(new_links, build_numbers):
+                if build_number:
+                    self._cache['rc_builds'][link] = build_number
+            self._save_cache()
+        return dict((row['label'], (row['branch'], self._cache['rc_builds'].get(row['link']))) for row in rc_rows)
+
+    def get_known_rc_builds(self):
+        """
+        :return: The build numbers of all the RC builds scraped before, without accessing the release page.
+        """
+        return set(self._cache['rc_builds'].values())
+
+    def _get_commit_number(self, link):
+        try:
+            download_page = _SESSION.get(get_download_page_url(link)).content
+        except requests.RequestException, e:
+            self.logger.warning('Get download page {0} failed: {1}'.format(link, e))
+            return None
+        parsed_html = BeautifulSoup(download_page, HTML_PARSER, parse_only=SoupStrainer('a'))
+        for tag in parsed_html.find_all('a'):
+            href = tag.attrs.get('href', '')
+            if href.endswith(PLATFORM_PACKAGES[0]):
+                return href[:-len(PLATFORM_PACKAGES[0])].split('-')[-2]
@@ -0,0 +1,221 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import hashlib
+import json
+import mmap
+import os
+import time
+from multiprocessing import Pool
+from threading import Thread
+from twisted.internet import reactor
+from download import BuildDownloader
+from logging_base import Logging
+from scheduler import DownloadScheduler
+from settings import SCRUB_INTERVAL, SCRUB_PROCESSES, SCRUB_BANDWIDTH
+
+# The progress of the scrub is saved under the root dir, hidden from the web server.
+_STATE_FILE_NAME = '.scrub_state.json'
+
+# The corrupt packages are moved into this dir under the root dir.
+_QUARANTINE_DIR_NAME = '.quarantine'
+
+# Bytes hashed at a time, the file is mapped into memory so it is not copied.
+_BLOCK_SIZE = 8 * 1024 * 1024
+
+# The seconds to wait before checking again whether the downloads are finished.
+_BUSY_WAIT = 30
+
+
+def _init_worker():
+    # Hashing is the lowest priority work of the server.
+    os.nice(19)
+
+
+def _hash_file(args):
+    """
+    Compute the md5 check sum of the file in a worker process, reading at most `rate` bytes/s.
+    :return: A tuple of (check sum, error message).
+    """
+    file_path, rate = args
+    md5 = hashlib.md5()
+    try:
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return md5.hexdigest(), None
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = time.time()
+                for offset in xrange(0, size, _BLOCK_SIZE):
+                    md5.update(buffer(data, offset, _BLOCK_SIZE))
+                    if rate:
+                        ahead = (offset + _BLOCK_SIZE) / float(rate) - (time.time() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            finally:
+                data.close()
+    except (IOError, OSError, mmap.error), e:
+        return None, str(e)
+    return md5.hexdigest(), None
+
+
+class Scrubber(Logging):
+    def __init__(self, catalog, engine=None, mirror=None, is_busy=None, processes=SCRUB_PROCESSES,
+                 bandwidth=SCRUB_BANDWIDTH):
+        """
+        Re-verify the packages in the catalog against their recorded md5 check sums. The broken ones are moved into
+        the quarantine dir and downloaded again.
+        :param catalog: The BuildCatalog.
+        :param engine: The FetchEngine to download the broken packages again, if not given will download them in
+        threads after the scrub.
+        :param mirror: The PeerMirror to download the broken packages from a peer.
+        :param is_busy: A function returns True if the server is busy (e.g. downloading), the scrub waits for it.
+        :param processes: Number of processes hashing the packages.
+        :param bandwidth: Max bytes/s read by all the processes, 0 means unlimited.
+        """
+        super(Scrubber, self).__init__()
+        self.catalog = catalog
+        self.engine = engine
+        self.mirror = mirror
+        self.is_busy = is_busy
+        self.processes = processes
+        self.bandwidth = bandwidth
+        self.state_path = os.path.join(catalog.root_path, _STATE_FILE_NAME)
+        self.quarantine_path = os.path.join(catalog.root_path, _QUARANTINE_DIR_NAME)
+
+    def _load_state(self):
+        if os.path.isfile(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    return json.load(f)
+            except (IOError, ValueError):
+                self.logger.warning('The scrub state is broken, ignore it.')
+        return {'started_at': None, 'finished_at': None, 'verified': []}
+
+    def _save_state(self, state):
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def start(self):
+        """
+        Scrub every SCRUB_INTERVAL hours in a background thread.
+        """
+        thread = Thread(target=self._run, name='Scrubber')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            state = self._load_state()
+            # An unfinished scrub is resumed at once.
+            if not state['started_at'] and state['finished_at']:
+                wait = state['finished_at'] + SCRUB_INTERVAL * 3600 - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                self.scrub()
+            except Exception, e:
+                self.logger.error('Scrub failed: {0}'.format(e), exc_info=True)
+                time.sleep(_BUSY_WAIT)
+
+    def _wait_idle(self):
+        while self.is_busy and self.is_busy():
+            time.sleep(_BUSY_WAIT)
+
+    def scrub(self):
+        """
+        Verify all the packages, resume the last scrub if it is not finished.
+        :return: A list of (record, problem) of the broken packages.
+        """
+        state = self._load_state()
+        if not state['started_at']:
+            state.update(started_at=time.time(), verified=[])
+        verified = set(state['verified'])
+        records = [record for record in self.catalog.find() if record['path'] not in verified]
+        self.logger.info('Start scrubbing {0} packages ({1} verified already).'.format(len(records), len(verified)))
+        rate = self.bandwidth / self.processes if self.bandwidth else 0
+        broken = []
+        pool = Pool(self.processes, initializer=_init_worker)
+        try:
+            for i in range(0, len(records), self.processes):
+                self._wait_idle()
+                batch = records[i:i + self.processes]
+                # The packages without md5 (e.g. added by reconcile) are only checked by the size.
+                hashed = [record for record in batch if record['md5']]
+                results = dict(zip([record['path'] for record in hashed], pool.map(
+                    _hash_file, [(os.path.join(self.catalog.root_path, record['path']), rate) for record in hashed])))
+                for record in batch:
+                    check_sum, error = results.get(record['path'], (None, None))
+                    problem = self._check(record, check_sum, error)
+                    if problem:
+                        broken.append((record, problem))
+                    verified.add(record['path'])
+                state['verified'] = list(verified)
+                self._save_state(state)
+        finally:
+            pool.close()
+            pool.join()
+        state.update(started_at=None, finished_at=time.time(), verified=[])
+        self._save_state(state)
+        self.logger.info('Scrub finished, {0} packages are broken.'.format(len(broken)))
+        self._download_again([record for record, problem in broken])
+        return broken
+
+    def _check(self, record, check_sum, error):
+        """
+        :return: The problem of the package, or None if it is fine.
+        """
+        file_path = os.path.join(self.catalog.root_path, record['path'])
+        # The package could be deleted by the retention during the scrub.
+        if not self.catalog.contains(file_path):
+            return None
+        if not os.path.isfile(file_path):
+            problem = 'missing'
+        elif error:
+            problem = error
+        elif os.path.getsize(file_path) != record['size']:
+            problem = 'truncated'
+        elif record['md5'] and check_sum != record['md5']:
+            problem = 'corrupt'
+        else:
+            return None
+        self.logger.warning('{0} is broken: {1}.'.format(file_path, problem))
+        if os.path.isfile(file_path):
+            # The blob is the same file, the other links of it are found broken in this scrub too.
+            if self.catalog.store and self.catalog.store.links_to(file_path, record['md5']):
+                self.catalog.store.discard(record['md5'])
+            self._quarantine(record)
+        self.catalog.remove(file_path)
+        return problem
+
+    def _quarantine(self, record):
+        if not os.path.isdir(self.quarantine_path):
+            os.makedirs(self.quarantine_path)
+        target = os.path.join(self.quarantine_path, record['path'].replace(os.sep, '--'))
+        os.rename(os.path.join(self.catalog.root_path, record['path']), target)
+        self.logger.info('{0} is moved into the quarantine.'.format(record['path']))
+
+    def _download_again(self, records):
+        downloaders = []
+        for record in records:
+            if not record['url']:
+                self.logger.warning('{0} has no recorded url, it is left for the next cycle.'.format(record['path']))
+                continue
+            downloaders.append(BuildDownloader(
+                os.path.join(self.catalog.root_path, record['folder']), record['platform_package'],
+                branch=record['branch'], build=record['build'], catalog=self.catalog, mirror=self.mirror,
+                url=record['url']))
+        if not downloaders:
+            return
+        if self.engine:
+            for downloader in downloaders:
+                reactor.callFromThread(self.engine.fetch, downloader)
+        else:
+            scheduler = DownloadScheduler()
+            for downloader in downloaders:
+                scheduler.submit(downloader)
+            scheduler.run()
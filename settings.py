@@ -1,5 +1,15 @@
-# Will download builds under this directory.
-ROOT_DIR = '/root/splunk_builds'
+import os
+
+# Will download builds under this directory (can be overridden by the SPLUNKBMD_ROOT_DIR environment variable).
+ROOT_DIR = os.environ.get('SPLUNKBMD_ROOT_DIR', '/root/splunk_builds')
+
+# Packages in downloading are staged in this directory, it must be on the same filesystem as ROOT_DIR so that moving
+# the finished package into place is an atomic rename.
+STAGING_DIR = os.path.join(ROOT_DIR, '.staging')
+
+# The release server to scrape the builds from (can be overridden by the SPLUNKBMD_RELEASE_SERVER environment variable,
+# e.g. the fake upstream of the benchmark).
+RELEASE_SERVER = os.environ.get('SPLUNKBMD_RELEASE_SERVER', 'http://releases.splunk.com').rstrip('/')
 
 # Max try number of downloading builds if not successful.
 MAX_DOWNLOAD_TRY = 5
@@ -7,6 +17,28 @@ MAX_DOWNLOAD_TRY = 5
 # Max number of concurrent threads when downloading builds.
 MAX_CONCURRENT_THREADS = 5
 
+# How to download the builds: 'thread' downloads each package in a thread (at most MAX_CONCURRENT_THREADS threads),
+# 'reactor' downloads all the packages asynchronously inside the twisted reactor (at most MAX_CONCURRENT_DOWNLOADS).
+DOWNLOAD_ENGINE = 'thread'
+
+# Max number of packages downloading at the same time when DOWNLOAD_ENGINE is 'reactor'.
+MAX_CONCURRENT_DOWNLOADS = 20
+
+# Max number of concurrent connections to one host (each segment of a package is a connection), 0 means unlimited.
+MAX_CONNECTIONS_PER_HOST = 12
+
+# Number of byte ranges fetched concurrently (via HTTP Range requests) for one package, 1 means a single stream.
+DOWNLOAD_SEGMENTS = 4
+
+# Packages smaller than this size (bytes) will always be downloaded in a single stream.
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Size (bytes) of each chunk read from the network when downloading.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Buffer size (bytes) of the file that a package is written to when downloading.
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
 # The platforms of the downloaded builds.
 # Refer to the build fetcher from http://releases.splunk.com/
 PLATFORM_PACKAGES = ['Linux-x86_64.tgz',
@@ -16,6 +48,10 @@ PLATFORM_PACKAGES = ['Linux-x86_64.tgz',
 # Branch name in the following will must be downloaded even if it matches the FILTER_BRANCH_REGEX.
 MUST_DOWNLOAD_BRANCH = []
 
+# Builds of MUST_DOWNLOAD_BRANCH and the branches with RC builds are downloaded first, then the branches match the
+# following regex, then the others.
+CURRENT_BRANCH_REGEX = ['current']
+
 # Branch name matches the following regex will not be downloaded.
 FILTER_BRANCH_REGEX = ['.*-.*',
                        '.*_.*',
@@ -29,23 +65,114 @@ FILTER_BRANCH_REGEX = ['.*-.*',
                        'develop',
                        'cloud']
 
+# If True, a package is downloaded as a delta against the newest local package of the same branch and platform: a
+# rolling check sum finds the blocks of the new package in the old one, they are copied and only the changed ranges are
+# fetched (by HTTP Range requests). The block index of the new package is asked from a mirror peer which has it (see
+# MIRROR_PEERS), without one the package is downloaded in full.
+DELTA_DOWNLOAD = False
+
+# Size (bytes) of the blocks in the block indexes served to the peers.
+DELTA_BLOCK_SIZE = 64 * 1024
+
+# Max number of ranges fetched for a delta download, the nearest ranges are merged if there are more.
+DELTA_MAX_RANGES = 64
+
+# Max seconds to look for the blocks in the old package (rolling the check sum over the changed parts is slow on big
+# packages without numpy), the blocks found by then are still reused, 0 means unlimited.
+DELTA_SCAN_TIMEOUT = 120
+
+# If True, the packages are kept in a content-addressed store (ROOT_DIR/.objects) keyed by md5 and hardlinked into the
+# branch folders, so that the same package published under several branches is downloaded and stored only once.
+OBJECT_STORE = True
+
+# If True, the files in each package (.tgz, and .msi if olefile is installed) are indexed in the background when it is
+# downloaded, so that they can be browsed and a single file pulled out of a tgz without downloading the whole package.
+MANIFEST_INDEX = True
+
+# Number of the recent events (packages added or removed) kept for the clients of /api/events which reconnect.
+EVENT_HISTORY = 1000
+
+# The urls to post the events to, each is a url or a dict of the url and the filters (lists of the accepted values of
+# 'branch', 'platform' and 'event'), e.g. [{'url': 'http://ci:8080/hook', 'branch': ['ivory'], 'event': ['added']}].
+WEBHOOKS = []
+
+# The events are posted to a webhook in batches of at most this many, once the first one has waited for these seconds.
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_BATCH_DELAY = 5
+
 # The package downloaded before these days will be deleted unless it is the only one in that folder.
 EXPIRE_DAYS = 3
 
+# Max bytes of the packages under ROOT_DIR, 0 means unlimited. If exceeded, the packages not used for the longest time
+# are deleted before they expire (the pinned ones, i.e. the newest of each platform in a folder, the RC builds and the
+# ones in NEVER_DELETE_BRANCH are never deleted).
+ROOT_DIR_QUOTA = 0
+
+# A list of (branch regex, weight). A package of a branch with a higher weight is kept longer when the quota is
+# exceeded, e.g. [('current', 4)] keeps the current branch four times as long as the others (whose weight is 1).
+BRANCH_WEIGHTS = []
+
+# The interval (hours) between two scrubs, which re-verify the md5 check sums of all the packages, 0 to disable it.
+SCRUB_INTERVAL = 24
+
+# Number of processes hashing the packages in a scrub.
+SCRUB_PROCESSES = 2
+
+# Max bytes/s read from the disk by a scrub (shared by its processes), 0 means unlimited.
+SCRUB_BANDWIDTH = 50 * 1024 * 1024
+
+# The aggregate bandwidth limit (bytes/s) of all the downloads, 0 means unlimited.
+BANDWIDTH_LIMIT = 0
+
+# The bandwidth limits (bytes/s) in the given time-of-day windows (local time), which override BANDWIDTH_LIMIT.
+# e.g. [('09:00', '18:00', 2 * 1024 * 1024)] limits the downloads to 2MB/s in the business hours.
+BANDWIDTH_WINDOWS = []
+
+# The log files are written under this directory, out of the source tree (can be overridden by the SPLUNKBMD_LOG_DIR
+# environment variable).
+LOG_DIR = os.environ.get('SPLUNKBMD_LOG_DIR', os.path.join(ROOT_DIR, '.logs'))
+
+# If True, each log record is written into the log file as a line of json (time, level, logger, message, ...).
+LOG_JSON = False
+
 # If True, will check and record download speed in the logs, this could affect the effectiveness of the program.
 RECORD_DOWNLOAD_SPEED = True
 
 # The interval (seconds) between two records of download speed.
 RECORD_DOWNLOAD_INTERVAL = 30
 
-# The interval (hours) between two download processes start.
+# The seconds a resolved package url (and its md5 check sum) is cached before resolving it again.
+RESOLVE_CACHE_TTL = 3600
+
+# The initial interval (hours) between two polls of a branch, adjusted by how often it gets new builds.
 FETCH_INTERVAL = 2
 
-# The port of the twisted web server.
-WEB_SERVER_PORT = 8080
+# Each branch is polled more often if it gets new builds frequently, and less often if not, in the range (hours).
+MIN_FETCH_INTERVAL = 0.25
+MAX_FETCH_INTERVAL = 24
+
+# How to run the service: 'single' runs the web server and the fetch cycles in one process, 'split' runs the fetch
+# cycles (download, verify and expire) in a worker process, so that they do not slow down the web server. Either way the
+# processes are restarted by the supervisor (see ./splunkbmd start) if they die (can be overridden by the
+# SPLUNKBMD_PROCESS_MODE environment variable).
+PROCESS_MODE = os.environ.get('SPLUNKBMD_PROCESS_MODE', 'single')
+
+# The unix socket between the web server and the worker process in the 'split' mode.
+CONTROL_SOCKET = os.path.join(ROOT_DIR, '.control.sock')
+
+# The port of the twisted web server (can be overridden by the SPLUNKBMD_PORT environment variable).
+WEB_SERVER_PORT = int(os.environ.get('SPLUNKBMD_PORT', 8080))
+
+# The base urls of other splunkbmd web servers, e.g. ['http://lab2:8080']. A package is downloaded from the nearest
+# peer which has it, only from releases.splunk.com if none of them has (can be overridden by the SPLUNKBMD_PEERS
+# environment variable, separated by commas).
+MIRROR_PEERS = [peer for peer in os.environ.get('SPLUNKBMD_PEERS', '').split(',') if peer]
 
 # Packages in this folder will never be deleted due to expiration.
 NEVER_DELETE_BRANCH = ['manual-build']
 
+# The folder (under ROOT_DIR) to save the packages pulled on demand from the web server, they expire like the others.
+PULL_BUILD_DIR = 'pulled-build'
+
 # If True, all RC builds of the satisfied branches will reserved forever.
 RESERVE_RC_BUILDS = True
\ No newline at end of file
@@ -0,0 +1,140 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import errno
+import os
+import re
+from threading import Lock, Event
+from logging_base import Logging
+
+# The packages are stored by their md5 check sums in this dir under the root dir, hidden from the web server.
+_OBJECTS_DIR_NAME = '.objects'
+
+_CHECK_SUM = re.compile(r'^[0-9a-f]{32}$')
+
+
+def is_check_sum(value):
+    return bool(value) and bool(_CHECK_SUM.match(value))
+
+
+class ObjectStore(Logging):
+    def __init__(self, root_path):
+        """
+        A content-addressed store of the packages keyed by md5. Each package under the root path is a hardlink to its
+        blob, so that the same bytes published under several branches are downloaded and stored only once.
+        :param root_path: The root dir path of the downloaded builds, must be on one filesystem with the store.
+        """
+        super(ObjectStore, self).__init__()
+        self.path = os.path.join(root_path, _OBJECTS_DIR_NAME)
+        self._lock = Lock()
+        # The md5 check sums in downloading by the threads.
+        self._claims = dict()
+
+    def blob_path(self, check_sum):
+        return os.path.join(self.path, check_sum[:2], check_sum)
+
+    def contains(self, check_sum):
+        return is_check_sum(check_sum) and os.path.isfile(self.blob_path(check_sum))
+
+    def links_to(self, file_path, check_sum):
+        """
+        :return: True if the file is a link to the blob of the md5 check sum.
+        """
+        return self.contains(check_sum) and os.path.samefile(file_path, self.blob_path(check_sum))
+
+    def link(self, check_sum, file_path):
+        """
+        Link the blob of the md5 check sum to the file path.
+        :return: True if linked, False if the store does not have it.
+        """
+        if not is_check_sum(check_sum):
+            return False
+        tmp_path = file_path + '.link'
+        try:
+            os.link(self.blob_path(check_sum), tmp_path)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                os.remove(tmp_path)
+                return self.link(check_sum, file_path)
+            if e.errno != errno.ENOENT:
+                self.logger.warning('Link {0} from the store failed: {1}'.format(file_path, e))
+            return False
+        os.rename(tmp_path, file_path)
+        return True
+
+    def add(self, file_path, check_sum):
+        """
+        Keep the committed package in the store. If the store has the same bytes already, the package is replaced by
+        a link to them.
+        """
+        if not is_check_sum(check_sum):
+            return
+        blob_path = self.blob_path(check_sum)
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            try:
+                os.makedirs(os.path.dirname(blob_path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            os.link(file_path, blob_path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                # e.g. the filesystem does not support hardlinks, the package is just not deduplicated.
+                self.logger.warning('Add {0} into the store failed: {1}'.format(file_path, e))
+            elif not os.path.samefile(file_path, blob_path):
+                self.link(check_sum, file_path)
+
+    def claim(self, check_sum):
+        """
+        Claim the download of the md5 check sum, so that the same bytes are not downloaded twice at the same time.
+        :return: None if claimed, otherwise an Event which is set when the claimer ends.
+        """
+        with self._lock:
+            if check_sum in self._claims:
+                return self._claims[check_sum]
+            self._claims[check_sum] = Event()
+            return None
+
+    def unclaim(self, check_sum):
+        with self._lock:
+            event = self._claims.pop(check_sum, None)
+        if event:
+            event.set()
+
+    def release(self, check_sum):
+        """
+        Delete the blob if no package links to it any more.
+        """
+        if not is_check_sum(check_sum):
+            return
+        blob_path = self.blob_path(check_sum)
+        try:
+            if os.stat(blob_path).st_nlink <= 1:
+                os.remove(blob_path)
+                self.logger.info('Blob {0} is deleted, it has no links.'.format(check_sum))
+        except OSError:
+            pass
+
+    def discard(self, check_sum):
+        """
+        Delete the blob whatever links to it, e.g. it is found broken.
+        """
+        if self.contains(check_sum):
+            os.remove(self.blob_path(check_sum))
+
+    def collect_garbage(self):
+        """
+        Delete the blobs no package links to, e.g. left by a crash between the removal of a package and its blob.
+        :return: The number of deleted blobs.
+        """
+        count = 0
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                blob_path = os.path.join(root, f)
+                if os.stat(blob_path).st_nlink <= 1:
+                    os.remove(blob_path)
+                    count += 1
+        return count
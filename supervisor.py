@@ -0,0 +1,137 @@
+'''_
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+'''
+import errno
+import os
+import signal
+import subprocess
+import time
+from logging_base import Logging
+
+# The seconds between two checks of the child processes.
+_POLL_INTERVAL = 1
+
+# A child process is restarted after this delay (seconds), which doubles each time it dies soon after starting.
+_MIN_RESTART_DELAY = 1
+_MAX_RESTART_DELAY = 60
+
+# A child process which runs longer than these seconds before it dies is restarted at once.
+_STABLE_SECONDS = 60
+
+# The seconds to wait for a process to exit after SIGTERM, before it is killed.
+STOP_TIMEOUT = 30
+
+
+def read_pid(pid_file):
+    """
+    :return: The pid in the pid file if the process is alive, otherwise None.
+    """
+    try:
+        with open(pid_file) as f:
+            pid = int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+    return pid if is_alive(pid) else None
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class _Child(object):
+    def __init__(self, name, command, env):
+        self.name = name
+        self.command = command
+        self.env = env
+        self.process = None
+        self.started_at = None
+        self.restart_at = 0
+        self.restart_delay = _MIN_RESTART_DELAY
+        self.restarts = 0
+
+
+class Supervisor(Logging):
+    def __init__(self, children, pid_file):
+        """
+        Run the child processes (e.g. the web server and the worker) and restart them if they die. SIGTERM stops the
+        children and then the supervisor.
+        :param children: A list of (name, command line, extra environment variables) of the child processes, they are
+        started in order.
+        :param pid_file: The pid of the supervisor is written into this file while it is running.
+        """
+        super(Supervisor, self).__init__()
+        self.pid_file = pid_file
+        self._children = [_Child(name, command, env) for name, command, env in children]
+        self._stopping = False
+
+    def run(self):
+        with open(self.pid_file, 'w') as f:
+            f.write('%s' % os.getpid())
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        self.logger.info('Supervisor {0} is started.'.format(os.getpid()))
+        try:
+            while not self._stopping:
+                self._check()
+                time.sleep(_POLL_INTERVAL)
+        finally:
+            self._stop_children()
+            if os.path.isfile(self.pid_file):
+                os.remove(self.pid_file)
+            self.logger.info('Supervisor {0} is stopped.'.format(os.getpid()))
+
+    def _on_signal(self, signum, frame):
+        self._stopping = True
+
+    def _check(self):
+        now = time.time()
+        for child in self._children:
+            if child.process is None:
+                if now >= child.restart_at:
+                    self._start(child)
+                continue
+            code = child.process.poll()
+            if code is None:
+                continue
+            ran = now - child.started_at
+            child.process = None
+            # Restart at once if it has been running for a while, otherwise back off.
+            child.restart_delay = _MIN_RESTART_DELAY if ran >= _STABLE_SECONDS else min(
+                child.restart_delay * 2, _MAX_RESTART_DELAY)
+            child.restart_at = now + (0 if ran >= _STABLE_SECONDS else child.restart_delay)
+            child.restarts += 1
+            self.logger.error('The {0} process exited with {1} after {2:.0f}s, restart it in {3:.0f}s.'.format(
+                child.name, code, ran, child.restart_at - now))
+
+    def _start(self, child):
+        env = dict(os.environ)
+        env.update(child.env)
+        try:
+            child.process = subprocess.Popen(child.command, env=env, close_fds=True)
+        except OSError, e:
+            self.logger.error('Start the {0} process failed: {1}'.format(child.name, e))
+            child.restart_at = time.time() + _MAX_RESTART_DELAY
+            return
+        child.started_at = time.time()
+        self.logger.info('The {0} process {1} is started.'.format(child.name, child.process.pid))
+
+    def _stop_children(self):
+        running = [child for child in self._children if child.process and child.process.poll() is None]
+        # Stop the children in the reverse order, e.g. the web server before the worker.
+        for child in reversed(running):
+            self.logger.info('Stop the {0} process {1}.'.format(child.name, child.process.pid))
+            child.process.terminate()
+        deadline = time.time() + STOP_TIMEOUT
+        for child in running:
+            while child.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if child.process.poll() is None:
+                self.logger.warning('The {0} process does not exit, kill it.'.format(child.name))
+                child.process.kill()
+                child.process.wait()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+"""
+import calendar
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.threads import deferToThread
+from twisted.python.compat import _PY3
+from twisted.python.failure import Failure
+from twisted.web import http, resource, server
+
+from delta import build_index
+from metrics import METRICS, TRANSFERS
+
+if _PY3:
+    from urllib.parse import quote
+else:
+    from urllib import quote
+
+
+def _parseTime(value):
+    """
+    Parse a timestamp given as epoch seconds or as (UTC) 'YYYY-MM-DD' / 'YYYY-MM-DDTHH:MM:SS'.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise ValueError('Invalid time: {0}'.format(value))
+
+
+def renderJson(request, content, status=http.OK):
+    """
+    Write the content as compact json, answer 304 if the client has the same version already.
+    """
+    body = json.dumps(content, separators=(',', ':'), sort_keys=True)
+    etag = '"{0}"'.format(hashlib.md5(body.encode('utf8')).hexdigest())
+    request.setResponseCode(status)
+    request.setHeader(b'content-type', b'application/json')
+    request.setHeader(b'etag', etag)
+    if status == http.OK and request.setETag(etag) is http.CACHED:
+        return b''
+    return body
+
+
+def renderJsonLater(request, d, status=http.OK):
+    """
+    Write the result of the deferred as json when it fires, e.g. the answer of
+    the worker process. Answer 503 if it fails.
+    """
+    def write(content, status):
+        # The channel is gone if the connection is lost.
+        if request.channel is None:
+            return
+        request.write(renderJson(request, content, status))
+        request.finish()
+
+    d.addCallbacks(write, lambda failure: write({'error': failure.getErrorMessage()}, http.SERVICE_UNAVAILABLE),
+                   callbackArgs=(status,))
+    return server.NOT_DONE_YET
+
+
+class BuildListResource(resource.Resource):
+    """
+    List the packages in the catalog as json.
+
+    Query arguments:
+        - branch, platform, build, file_name: filter by the values (can be given several times)
+        - newer_than: only the packages downloaded after the time (epoch seconds or YYYY-MM-DD[THH:MM:SS] in UTC)
+        - latest: if true, only the newest package of each branch and platform
+        - sort: the field to sort by (default is downloaded_at), order: asc or desc (default)
+        - limit, offset: the page of the result
+    """
+    isLeaf = True
+
+    # Map the query arguments to the catalog columns.
+    filters = {'branch': 'branch', 'platform': 'platform_package', 'build': 'build', 'file_name': 'file_name'}
+
+    fields = ('branch', 'build', 'version', 'platform_package', 'file_name', 'size', 'md5', 'downloaded_at')
+
+    def __init__(self, catalog):
+        resource.Resource.__init__(self)
+        self.catalog = catalog
+
+    def _getArgument(self, request, name, default=None):
+        values = request.args.get(name)
+        return values[-1] if values else default
+
+    def render_GET(self, request):
+        try:
+            conditions = dict((column, request.args[name]) for name, column in self.filters.items()
+                              if request.args.get(name))
+            newerThan = self._getArgument(request, 'newer_than')
+            newerThan = _parseTime(newerThan) if newerThan else None
+            latest = self._getArgument(request, 'latest', 'false').lower() in ('1', 'true', 'yes')
+            sort = self._getArgument(request, 'sort', 'downloaded_at')
+            if sort == 'platform':
+                sort = 'platform_package'
+            if sort not in self.fields:
+                raise ValueError('Can not sort by {0}'.format(sort))
+            order = self._getArgument(request, 'order', 'desc').lower()
+            if order not in ('asc', 'desc'):
+                raise ValueError('Invalid order: {0}'.format(order))
+            limit = self._getArgument(request, 'limit')
+            limit = int(limit) if limit else None
+            offset = int(self._getArgument(request, 'offset', 0))
+            if (limit is not None and limit < 0) or offset < 0:
+                raise ValueError('Invalid limit or offset.')
+        except ValueError as e:
+            return renderJson(request, {'error': str(e)}, http.BAD_REQUEST)
+
+        total, records = self.catalog.query(conditions, newer_than=newerThan, latest=latest, sort=sort,
+                                            descending=order == 'desc', limit=limit, offset=offset)
+        builds = []
+        for record in records:
+            build = dict((field, record[field]) for field in self.fields)
+            build['href'] = '/' + quote(record['path'])
+            builds.append(build)
+        return renderJson(request, {'total': total, 'offset': offset, 'builds': builds})
+
+
+class CycleResource(resource.Resource):
+    """
+    GET the state of the fetch cycles, or POST to start a cycle now.
+
+    Query arguments of POST:
+        - branch: only check these branches (can be given several times), default is all the branches
+    """
+    isLeaf = True
+
+    def __init__(self, scheduler):
+        """
+        :param scheduler: The CycleScheduler, or the RemoteScheduler of the
+        worker process whose methods return Deferreds.
+        """
+        resource.Resource.__init__(self)
+        self.scheduler = scheduler
+
+    def render_GET(self, request):
+        return renderJsonLater(request, maybeDeferred(self.scheduler.status))
+
+    def render_POST(self, request):
+        d = maybeDeferred(self.scheduler.trigger, request.args.get('branch'))
+        d.addCallback(lambda started: {'started': started, 'queued': not started})
+        return renderJsonLater(request, d, http.ACCEPTED)
+
+
+class MetricsResource(resource.Resource):
+    """
+    The metrics of the downloads, the fetch cycles and the web server, in the
+    Prometheus text format.
+
+    Query arguments:
+        - format: json to get them as json instead
+    """
+    isLeaf = True
+
+    def __init__(self, registry=METRICS, remote=None):
+        """
+        :param remote: Returns a Deferred of the collected metrics of the
+        worker process, which are merged with the local ones (labeled by the
+        process).
+        """
+        resource.Resource.__init__(self)
+        self.registry = registry
+        self.remote = remote
+
+    def render_GET(self, request):
+        asJson = request.args.get('format', [''])[-1] == 'json'
+        if not self.remote:
+            return self._render(request, None, asJson)
+        d = self.remote()
+        # The local metrics are still served if the worker does not answer.
+        d.addCallbacks(lambda collected: {'web': self.registry.collect(), 'worker': collected},
+                       lambda failure: {'web': self.registry.collect()})
+        d.addCallback(lambda processes: self._finish(request, self._render(request, processes, asJson)))
+        return server.NOT_DONE_YET
+
+    def _render(self, request, processes, asJson):
+        if asJson:
+            return renderJson(request, self.registry.to_dict(processes))
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4')
+        return self.registry.render_text(processes)
+
+    def _finish(self, request, body):
+        if request.channel is not None:
+            request.write(body)
+            request.finish()
+
+
+class ProgressResource(resource.Resource):
+    """
+    The live progress (size, received bytes, bytes/s and eta) of the packages
+    in downloading.
+    """
+    isLeaf = True
+
+    def __init__(self, progress=TRANSFERS, remote=None):
+        """
+        :param remote: Returns a Deferred of the transfers of the worker
+        process, which are shown with the local ones (e.g. the pulls).
+        """
+        resource.Resource.__init__(self)
+        self.progress = progress
+        self.remote = remote
+
+    def render_GET(self, request):
+        if not self.remote:
+            return renderJson(request, self._render(self.progress.snapshot()))
+        d = self.remote()
+        d.addErrback(lambda failure: [])
+        d.addCallback(lambda transfers: self._render(sorted(transfers + self.progress.snapshot(),
+                                                            key=lambda transfer: transfer['started_at'])))
+        return renderJsonLater(request, d)
+
+    def _render(self, transfers):
+        return {'rate': sum(transfer['rate'] for transfer in transfers), 'transfers': transfers}
+
+
+class BlockIndexResource(resource.Resource):
+    """
+    The block index of a package, e.g. /api/blocks/<folder>/<file name>, so
+    that the peers download it as a delta against their previous builds. The
+    index is built in a thread on the first request and cached.
+    """
+    isLeaf = True
+
+    # Max number of the cached indexes.
+    cacheSize = 32
+
+    def __init__(self, catalog, blockSize=64 * 1024):
+        resource.Resource.__init__(self)
+        self.catalog = catalog
+        self.blockSize = blockSize
+        self._cache = OrderedDict()
+        # The requests waiting for the indexes in building.
+        self._building = dict()
+
+    def render_GET(self, request):
+        record = self.catalog.get(os.path.join(self.catalog.root_path, *request.postpath))
+        if not record:
+            return renderJson(request, {'error': 'No such package.'}, http.NOT_FOUND)
+        key = (record['path'], record['size'], record['downloaded_at'])
+        if key in self._cache:
+            index = self._cache.pop(key)
+            self._cache[key] = index
+            return renderJson(request, index)
+        waiting = self._building.get(key)
+        if waiting is None:
+            waiting = self._building[key] = []
+            filePath = os.path.join(self.catalog.root_path, record['path'])
+            deferToThread(build_index, filePath, self.blockSize).addBoth(self._onBuilt, key)
+        waiting.append(request)
+        return server.NOT_DONE_YET
+
+    def _onBuilt(self, result, key):
+        if isinstance(result, Failure):
+            content, status = {'error': result.getErrorMessage()}, http.INTERNAL_SERVER_ERROR
+        else:
+            content, status = result, http.OK
+            self._cache[key] = result
+            while len(self._cache) > self.cacheSize:
+                self._cache.popitem(last=False)
+        for request in self._building.pop(key):
+            # The channel is gone if the connection is lost.
+            if request.channel is None:
+                continue
+            request.write(renderJson(request, content, status))
+            request.finish()
@@ -7,28 +7,120 @@
 """
 import itertools
 import os
+import stat
 from datetime import datetime
-from twisted.python import filepath
-from twisted.web import resource
-from twisted.web.static import File, getTypeAndEncoding, formatFileSize
+from twisted.web import http, resource
+from twisted.web.static import File, getTypeAndEncoding, formatFileSize, NoRangeStaticProducer, \
+    SingleRangeStaticProducer
 from twisted.python.compat import escape, _PY3, nativeString
 
 from html_generator import HtmlGenerator
+from manifest import can_index
+from sendfile_producer import SendfileProducer, canSendfile
+from settings import SENDFILE_MIN_SIZE
 
 if _PY3:
     from urllib.parse import quote, unquote
 else:
     from urllib import quote, unquote
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Rendered listing pages, {directory path: (directory mtime, {header: page})}.
+_LISTING_CACHE = {}
+
+# Max number of the pages cached of a directory, it could be requested by several paths (e.g. with or without the
+# trailing slash).
+_LISTING_PAGES = 4
+
+
+def invalidateListing(path):
+    """
+    Drop the cached listing pages of the directory, e.g. when a file is added into it.
+    """
+    _LISTING_CACHE.pop(os.path.abspath(path), None)
+
 
 class CustomiseFile(File):
+    # The catalog of the packages (see BuildCatalog), used to list the files without stat them.
+    catalog = None
+
+    # If True, the packages link to their manifests (see ManifestResource) in the listing.
+    manifests = False
+
+    def createSimilarFile(self, path):
+        f = File.createSimilarFile(self, path)
+        f.catalog = self.catalog
+        f.manifests = self.manifests
+        return f
+
+    def listNames(self):
+        """
+        Hidden files and folders (e.g. packages in downloading) are not listed.
+        """
+        return [name for name in File.listNames(self) if not name.startswith('.')]
+
+    def getChild(self, path, request):
+        if path.startswith('.'):
+            return self.childNotFound
+        return File.getChild(self, path, request)
+
+    def render_GET(self, request):
+        """
+        Besides the Last-Modified, the verified md5 of a catalogued package is
+        used as its strong ETag for If-None-Match and If-Range requests.
+        """
+        self.restat(False)
+        record = self.catalog.get(self.path) if self.catalog and self.isfile() else None
+        etag = b'"%s"' % (record['md5'],) if record and record['md5'] else None
+        if record and request.method == b'GET':
+            # The access time is used to decide which packages to delete first when the disk is full.
+            self.catalog.touch(self.path)
+        if etag:
+            request.setHeader(b'etag', etag)
+            if request.setETag(etag) is http.CACHED:
+                return b''
+        ifRange = request.getHeader(b'if-range')
+        if ifRange is not None and request.getHeader(b'range') is not None:
+            if ifRange.startswith(b'"') or ifRange.startswith(b'W/'):
+                matched = ifRange == etag
+            else:
+                matched = self.exists() and ifRange == http.datetimeToString(self.getModificationTime())
+            if not matched:
+                # The client's copy is outdated, send the entire file instead of the range.
+                request.requestHeaders.removeHeader(b'range')
+        return File.render_GET(self, request)
+    render_HEAD = render_GET
+
+    def makeProducer(self, request, fileForReading):
+        """
+        Send the entire file or a single range of a large file by sendfile.
+        Multiple ranges are left to the L{MultipleRangeStaticProducer}.
+        """
+        producer = File.makeProducer(self, request, fileForReading)
+        if self.getFileSize() < SENDFILE_MIN_SIZE or not canSendfile(request):
+            return producer
+        if isinstance(producer, SingleRangeStaticProducer):
+            return SendfileProducer(request, fileForReading, producer.offset, producer.size)
+        if isinstance(producer, NoRangeStaticProducer):
+            return SendfileProducer(request, fileForReading, 0, self.getFileSize())
+        return producer
 
     def directoryListing(self):
+        # The lister enumerates the directory itself, see CustomiseDirectoryLister._listEntries.
         return CustomiseDirectoryLister(self.path,
-                                        self.listNames(),
+                                        None,
                                         self.contentTypes,
                                         self.contentEncodings,
-                                        self.defaultType)
+                                        self.defaultType,
+                                        self.catalog,
+                                        self.manifests)
 
 
 class CustomiseDirectoryLister(resource.Resource):
@@ -57,6 +149,14 @@ class CustomiseDirectoryLister(resource.Resource):
 
     @ivar path: directory which content should be listed.
     @type path: C{str}
+
+    @ivar catalog: the catalog of the packages, the size and download time of
+        the recorded packages are taken from it instead of the file system.
+    @type catalog: C{NoneType} or L{BuildCatalog}
+
+    @ivar manifests: if True, the recorded packages which can be indexed link
+        to the files in them (see L{ManifestResource}).
+    @type manifests: C{bool}
     """
 
     template = HtmlGenerator()
@@ -72,7 +172,9 @@ class CustomiseDirectoryLister(resource.Resource):
     def __init__(self, pathname, dirs=None,
                  contentTypes=File.contentTypes,
                  contentEncodings=File.contentEncodings,
-                 defaultType='text/html'):
+                 defaultType='text/html',
+                 catalog=None,
+                 manifests=False):
         resource.Resource.__init__(self)
         self.contentTypes = contentTypes
         self.contentEncodings = contentEncodings
@@ -80,8 +182,56 @@ class CustomiseDirectoryLister(resource.Resource):
         # dirs allows usage of the File to specify what gets listed
         self.dirs = dirs
         self.path = pathname
+        self.catalog = catalog
+        self.manifests = manifests
 
-    def _getFilesAndDirectories(self, directory):
+    def _listEntries(self):
+        """
+        Enumerate the entries to be listed, stat each of them at most once.
+        Packages recorded in the catalog are not stat'ed at all.
+
+        @return: a sorted list of (name, isdir, size, ctime)
+        @rtype: C{list} of C{tuple}
+        """
+        records = self.catalog.list_folder(self.path) if self.catalog else {}
+        entries = []
+        if self.dirs is None and scandir is not None:
+            for entry in scandir(self.path):
+                if entry.name.startswith('.'):
+                    continue
+                record = records.get(entry.name)
+                if record:
+                    entries.append((entry.name, False, record['size'], record['downloaded_at']))
+                elif entry.is_dir():
+                    entries.append((entry.name, True, -1, None))
+                else:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((entry.name, False, st.st_size, st.st_ctime))
+        else:
+            if self.dirs is None:
+                names = [name for name in os.listdir(self.path) if not name.startswith('.')]
+            else:
+                names = self.dirs
+            for name in names:
+                record = records.get(name)
+                if record:
+                    entries.append((name, False, record['size'], record['downloaded_at']))
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    entries.append((name, True, -1, None))
+                else:
+                    entries.append((name, False, st.st_size, st.st_ctime))
+        entries.sort()
+        return entries
+
+    def _getFilesAndDirectories(self, entries):
         """
         Helper returning files and directories in given directory listing, with
         attributes to be used to build a table content with
@@ -93,39 +243,33 @@ class CustomiseDirectoryLister(resource.Resource):
         files = []
         dirs = []
 
-        for path in directory:
+        for path, isdir, size, ctime in entries:
             if _PY3:
                 if isinstance(path, bytes):
                     path = path.decode("utf8")
 
             url = quote(path, "/")
             escapedPath = escape(path)
-            childPath = filepath.FilePath(self.path).child(path)
 
-            if childPath.isdir():
+            if isdir:
                 dirs.append({'text': escapedPath + "/", 'href': url + "/", 'size_int': -1,
                              'size': '', 'type': '[Directory]', 'ctime': ''})
             else:
                 mimetype, encoding = getTypeAndEncoding(path, self.contentTypes,
                                                         self.contentEncodings,
                                                         self.defaultType)
-                try:
-                    size = childPath.getsize()
-                except OSError:
-                    continue
+                fileType = '[%s]' % mimetype
+                if self.manifests and can_index(path):
+                    manifestUrl = quote(self.catalog.relative_path(os.path.join(self.path, path)), "/")
+                    fileType += ' <a href="/api/manifest/%s?format=html">[files]</a>' % (manifestUrl,)
                 files.append({
                     'text': escapedPath, "href": url,
-                    'type': '[%s]' % mimetype,
+                    'type': fileType,
                     'size_int': size,
                     'size': formatFileSize(size),
-                    'ctime': self.getCreateTime(childPath.path)})
+                    'ctime': str(datetime.fromtimestamp(ctime))})
         return dirs, files
 
-    def getCreateTime(self, file_path):
-        create_time = os.path.getctime(file_path)
-        dt = datetime.fromtimestamp(create_time)
-        return str(dt)
-
     def _buildTableContent(self, elements):
         """
         Build a table content using C{self.linePattern} and giving elements odd
@@ -143,22 +287,34 @@ class CustomiseDirectoryLister(resource.Resource):
         Render a listing of the content of C{self.path}.
         """
         request.setHeader(b"content-type", b"text/html; charset=utf-8")
-        if self.dirs is None:
-            directory = os.listdir(self.path)
-            directory.sort()
-        else:
-            directory = self.dirs
+        # By the path without the query, so that e.g. the cache busters share the cached page.
+        header = "Directory listing for %s" % (
+            escape(unquote(nativeString(request.path))),)
 
-        dirs, files = self._getFilesAndDirectories(directory)
+        # The page is cached until the directory is modified or invalidated.
+        key = os.path.abspath(self.path)
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        cached = _LISTING_CACHE.get(key)
+        if self.dirs is None and cached and cached[0] == mtime and header in cached[1]:
+            return cached[1][header]
 
-        tableContent = "".join(self._buildTableContent(dirs + files))
+        dirs, files = self._getFilesAndDirectories(self._listEntries())
 
-        header = "Directory listing for %s" % (
-            escape(unquote(nativeString(request.uri))),)
+        tableContent = "".join(self._buildTableContent(dirs + files))
 
         done = self.template.generatePage({"header": header, "tableContent": tableContent})
         done = done.encode("utf8")
 
+        if self.dirs is None:
+            if not cached or cached[0] != mtime:
+                cached = (mtime, {})
+                _LISTING_CACHE[key] = cached
+            if len(cached[1]) >= _LISTING_PAGES:
+                cached[1].clear()
+            cached[1][header] = done
         return done
 
     def __repr__(self):
@@ -7,26 +7,42 @@
 """
 import copy
 import os
+import time
 
 from twisted.web import server
 from twisted.internet import reactor
 
-from customise_resource import CustomiseFile
-from logging_base import get_logger
-from settings import STATIC_RESOURCE_PATH
+from api_resource import BuildListResource, BlockIndexResource, CycleResource, MetricsResource, ProgressResource
+from customise_resource import CustomiseFile, invalidateListing
+from event_resource import EventsResource
+from manifest_resource import ManifestResource
+from pull_resource import PullResource
+import sendfile_producer
+from logging_base import SampleFilter, get_logger
+from metrics import HTTP_REQUEST_SECONDS, HTTP_RESPONSE_BYTES
+from settings import STATIC_RESOURCE_PATH, REQUEST_LOG_SAMPLE_RATE
 from twisted.web import resource
 
 
 _LOGGER = get_logger('WebServer')
+_LOGGER.addFilter(SampleFilter(REQUEST_LOG_SAMPLE_RATE))
 
 
 def hackGetResourceFor(self, request):
     """
-    Hack the getResourceFor function to log the site visit info.
+    Hack the getResourceFor function to log the site visit info and measure the requests.
     """
     request.site = self
     if (not request.uri.startswith('/static')) and (not request.uri.endswith('/')):
-        _LOGGER.info('Request for uri: {0} from {1}'.format(request.uri, request.client.host))
+        # Formatted lazily, only if it is sampled.
+        _LOGGER.info('Request for uri: %s from %s', request.uri, request.client.host)
+    startedAt = time.time()
+
+    def onFinish(result):
+        HTTP_REQUEST_SECONDS.observe(time.time() - startedAt, code=request.code)
+        HTTP_RESPONSE_BYTES.inc(request.sentLength)
+
+    request.notifyFinish().addBoth(onFinish)
     request.sitepath = copy.copy(request.prepath)
     return resource.getChildForRequest(self.resource, request)
 
@@ -35,20 +51,71 @@ server.Site.getResourceFor = hackGetResourceFor
 
 
 class CustomiseServer(object):
-    def __init__(self, static_file_path, port=8080):
+    def __init__(self, static_file_path, port=8080, catalog=None, scheduler=None, puller=None, block_size=64 * 1024,
+                 worker=None, indexer=None, feed=None):
         """
         :param static_resource_path: The dir that you put the css and js files. Should be full path.
+        :param catalog: The catalog of the files under static_file_path (optional).
+        :param scheduler: The CycleScheduler to trigger the fetch cycles (optional).
+        :param puller: A function(branch, build, platform_package, package_type) returns the Pull of the package, to
+        download the packages on demand (optional).
+        :param block_size: The block size of the block indexes served to the peers for the delta downloads.
+        :param worker: The ControlChannel to the worker process if the fetch cycles run there, its downloads are shown
+        in the metrics and the progress (optional).
+        :param indexer: The ManifestIndexer of the catalog, to browse the files in the packages (optional).
+        :param feed: The EventFeed of the catalog, to push the new packages to the clients (optional).
         """
         self.static_file_path = static_file_path
         self.port = port
+        self.catalog = catalog
+        self.scheduler = scheduler
+        self.puller = puller
+        self.block_size = block_size
+        self.worker = worker
+        self.indexer = indexer
+        self.feed = feed
 
     def run(self):
         """
         :param static_file_path: The dir you want to display all the files in it on the web page.
         :param port: Web server port.
         """
-        resource = CustomiseFile(self.static_file_path)
-        resource.putChild(STATIC_RESOURCE_PATH.split(os.sep)[-1], CustomiseFile(STATIC_RESOURCE_PATH))
-        site = server.Site(resource)
+        root = CustomiseFile(self.static_file_path)
+        root.catalog = self.catalog
+        api = resource.Resource()
+        if self.catalog:
+            self.catalog.subscribe(self._onCatalogChanged)
+            # The json api, e.g. /api/builds?branch=ivory&latest=true
+            api.putChild('builds', BuildListResource(self.catalog))
+            # The block index of a package for the delta downloads of the peers, e.g. /api/blocks/ivory/<file name>
+            api.putChild('blocks', BlockIndexResource(self.catalog, self.block_size))
+        if self.indexer:
+            # The files in a package, e.g. /api/manifest/ivory/<file name>?format=html, or ?member=<name> to pull one
+            root.manifests = True
+            api.putChild('manifest', ManifestResource(self.indexer))
+        if self.feed:
+            # The packages added or removed, by long poll at /api/events?since=<id> or Server-Sent Events at
+            # /api/events/stream
+            api.putChild('events', EventsResource(self.feed))
+        if self.scheduler:
+            # e.g. curl -X POST /api/cycle?branch=ivory
+            api.putChild('cycle', CycleResource(self.scheduler))
+        # Prometheus text at /api/metrics (or ?format=json), the downloads in flight at /api/progress
+        worker = self.worker
+        api.putChild('metrics', MetricsResource(remote=(lambda: worker.call('metrics')) if worker else None))
+        api.putChild('progress', ProgressResource(remote=(lambda: worker.call('progress')) if worker else None))
+        root.putChild('api', api)
+        if self.puller:
+            # e.g. /pull/ivory/latest/Linux-x86_64.tgz
+            root.putChild('pull', PullResource(self.puller, self.static_file_path))
+        root.putChild(STATIC_RESOURCE_PATH.split(os.sep)[-1], CustomiseFile(STATIC_RESOURCE_PATH))
+        if sendfile_producer.sendfile is None:
+            _LOGGER.warning('sendfile is not available (install pysendfile), the files are sent by reading them.')
+        site = server.Site(root)
         reactor.listenTCP(self.port, site)
         reactor.run()
+
+    def _onCatalogChanged(self, event, record):
+        if event == 'access':
+            return
+        invalidateListing(os.path.join(self.static_file_path, record['folder']))
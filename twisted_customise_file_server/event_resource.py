@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+"""
+import json
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web import http, resource, server
+
+from api_resource import renderJson
+from events import matches
+from settings import EVENT_POLL_TIMEOUT, EVENT_KEEPALIVE_INTERVAL
+
+
+def _getFilters(request):
+    return dict((name, request.args.get(name)) for name in ('branch', 'platform', 'event'))
+
+
+def _getLastId(request, feed):
+    """
+    The id of the last event the client has got, by default only the events
+    after the request are sent.
+    """
+    lastId = request.getHeader(b'last-event-id') or request.args.get('since', [None])[-1]
+    return int(lastId) if lastId else feed.last_id
+
+
+class EventStreamResource(resource.Resource):
+    """
+    The events as Server-Sent Events, e.g. /api/events/stream?branch=ivory.
+    The events after the Last-Event-ID header (sent by the browsers when they
+    reconnect) or the since argument are sent first. A 'missed' event tells
+    the client that some events are not kept any more.
+    """
+    isLeaf = True
+
+    def __init__(self, feed):
+        resource.Resource.__init__(self)
+        self.feed = feed
+
+    def render_GET(self, request):
+        try:
+            lastId = _getLastId(request, self.feed)
+        except ValueError:
+            return renderJson(request, {'error': 'Invalid event id.'}, http.BAD_REQUEST)
+        filters = _getFilters(request)
+        request.setHeader(b'content-type', b'text/event-stream')
+        request.setHeader(b'cache-control', b'no-cache')
+        # The clients reconnect after these milliseconds if the connection is lost.
+        request.write(b'retry: 5000\n\n')
+        events, missed = self.feed.since(lastId, filters)
+        if missed:
+            request.write(b'event: missed\ndata: {}\n\n')
+        for event in events:
+            self._send(request, event)
+
+        def onEvent(event):
+            if matches(event, filters):
+                self._send(request, event)
+
+        unsubscribe = self.feed.subscribe(onEvent)
+        keepalive = LoopingCall(request.write, b': keepalive\n\n')
+        keepalive.start(EVENT_KEEPALIVE_INTERVAL, now=False)
+
+        def stop(_):
+            unsubscribe()
+            keepalive.stop()
+
+        request.notifyFinish().addBoth(stop)
+        return server.NOT_DONE_YET
+
+    def _send(self, request, event):
+        request.write(b'id: %d\nevent: %s\ndata: %s\n\n' % (event['id'], event['event'],
+                                                            json.dumps(event, separators=(',', ':'))))
+
+
+class EventsResource(resource.Resource):
+    """
+    The feed of the packages added (downloaded and verified) and removed
+    (e.g. expired), by long poll: the request waits until there is an event.
+    See /api/events/stream for the Server-Sent Events.
+
+    Query arguments:
+        - branch, platform, event (added or removed): filter the events (can be given several times)
+        - since: the id of the last event received (the last_id of the previous answer), default is the newest
+        - timeout: max seconds to wait, default (and max) is EVENT_POLL_TIMEOUT
+    """
+
+    def __init__(self, feed):
+        resource.Resource.__init__(self)
+        self.feed = feed
+        self.putChild('stream', EventStreamResource(feed))
+
+    def render_GET(self, request):
+        try:
+            lastId = _getLastId(request, self.feed)
+            timeout = min(float(request.args.get('timeout', [EVENT_POLL_TIMEOUT])[-1]), EVENT_POLL_TIMEOUT)
+        except ValueError:
+            return renderJson(request, {'error': 'Invalid since or timeout.'}, http.BAD_REQUEST)
+        filters = _getFilters(request)
+        events, missed = self.feed.since(lastId, filters)
+        if events or missed or timeout <= 0:
+            return renderJson(request, self._result(events, missed))
+
+        def onEvent(event):
+            if matches(event, filters):
+                finish([event])
+
+        def finish(events):
+            unsubscribe()
+            if timer.active():
+                timer.cancel()
+            # The channel is gone if the connection is lost.
+            if request.channel is None:
+                return
+            request.write(renderJson(request, self._result(events, False)))
+            request.finish()
+
+        unsubscribe = self.feed.subscribe(onEvent)
+        timer = reactor.callLater(timeout, finish, [])
+        request.notifyFinish().addErrback(lambda _: finish([]))
+        return server.NOT_DONE_YET
+
+    def _result(self, events, missed):
+        return {'events': events, 'last_id': self.feed.last_id, 'missed': missed}
@@ -21,6 +21,7 @@ def url_for(file_path):
 class HtmlGenerator(object):
     def __init__(self):
         self.env = Environment(loader=FileSystemLoader(STATIC_RESOURCE_PATH))
+        self._template = None
 
     def generatePage(self, variables):
         """
@@ -29,5 +30,7 @@ class HtmlGenerator(object):
         :param variables: A dict contains variables corresponding to the given html file.
         :return: A unicode string of rendered html content.
         """
-        template = self.env.get_template(TEMPLATE_FILE)
-        return template.render(url_for=url_for, **variables)
+        # The template is compiled only once.
+        if self._template is None:
+            self._template = self.env.get_template(TEMPLATE_FILE)
+        return self._template.render(url_for=url_for, **variables)
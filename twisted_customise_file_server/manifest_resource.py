@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+"""
+import itertools
+import os
+import posixpath
+from datetime import datetime
+from threading import Event, Thread
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.threads import blockingCallFromThread, deferToThread
+from twisted.python.compat import _PY3, escape
+from twisted.python.failure import Failure
+from twisted.web import http, resource, server
+from twisted.web.static import formatFileSize
+from zope.interface import implementer
+
+from api_resource import renderJson
+from customise_resource import CustomiseDirectoryLister
+from manifest import FIELDS, can_extract, open_member
+from settings import MEMBER_CHUNK_SIZE
+
+if _PY3:
+    from urllib.parse import quote
+else:
+    from urllib import quote
+
+
+@implementer(IPushProducer)
+class MemberStreamer(object):
+    """
+    Stream a single file out of a tgz package to the client. The package is
+    read in a thread, which waits while the client is slow, so that no more
+    than a chunk is held in memory.
+    """
+
+    def __init__(self, request, filePath, name):
+        self.request = request
+        self.filePath = filePath
+        self.name = name
+        self.stopped = False
+        self._resumed = Event()
+        self._resumed.set()
+
+    def start(self):
+        self.request.notifyFinish().addErrback(lambda _: self.stopProducing())
+        thread = Thread(target=self._read, name='MemberStreamer')
+        thread.daemon = True
+        thread.start()
+
+    def _read(self):
+        try:
+            member, fileObject, tar = open_member(self.filePath, self.name)
+        except KeyError as e:
+            reactor.callFromThread(self._fail, http.NOT_FOUND, e.args[0])
+            return
+        except Exception as e:
+            reactor.callFromThread(self._fail, http.INTERNAL_SERVER_ERROR, 'Read the package failed: {0}'.format(e))
+            return
+        try:
+            blockingCallFromThread(reactor, self._begin, member)
+            while not self.stopped:
+                self._resumed.wait()
+                if self.stopped:
+                    break
+                data = fileObject.read(MEMBER_CHUNK_SIZE)
+                if not data:
+                    break
+                # Wait for the write, which pauses the producer if the transport is full.
+                blockingCallFromThread(reactor, self._write, data)
+        except Exception:
+            # Break the connection, so that the client knows the file is broken.
+            reactor.callFromThread(self._abort)
+        else:
+            reactor.callFromThread(self._finish)
+        finally:
+            tar.close()
+
+    def _fail(self, status, message):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.request.write(renderJson(self.request, {'error': message}, status))
+        self.request.finish()
+
+    def _begin(self, member):
+        if self.stopped:
+            return
+        self.request.setHeader(b'content-type', b'application/octet-stream')
+        self.request.setHeader(b'content-disposition',
+                               b'attachment; filename="%s"' % (posixpath.basename(member.name),))
+        self.request.setHeader(b'content-length', str(member.size))
+        self.request.registerProducer(self, True)
+
+    def _write(self, data):
+        if not self.stopped:
+            self.request.write(data)
+
+    def _finish(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def _abort(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.request.unregisterProducer()
+        self.request.transport.loseConnection()
+
+    def pauseProducing(self):
+        self._resumed.clear()
+
+    def resumeProducing(self):
+        self._resumed.set()
+
+    def stopProducing(self):
+        self.stopped = True
+        # Wake up the thread to let it exit.
+        self._resumed.set()
+
+
+class ManifestResource(resource.Resource):
+    """
+    The files in a package, e.g. /api/manifest/<folder>/<file name>. The
+    package is indexed in a thread on the first request if it is not yet.
+
+    Query arguments:
+        - prefix: only the files whose names start with it
+        - format: html to show them as a page
+        - member: the name of a file to pull it out of the (tgz) package
+    """
+    isLeaf = True
+
+    def __init__(self, indexer):
+        """
+        :param indexer: The ManifestIndexer of the catalog.
+        """
+        resource.Resource.__init__(self)
+        self.indexer = indexer
+        # The requests waiting for the packages in indexing.
+        self._indexing = dict()
+
+    def render_GET(self, request):
+        catalog = self.indexer.catalog
+        filePath = os.path.join(catalog.root_path, *request.postpath)
+        record = catalog.get(filePath)
+        if not record:
+            return renderJson(request, {'error': 'No such package.'}, http.NOT_FOUND)
+        member = request.args.get('member', [None])[-1]
+        if member:
+            if not can_extract(record['file_name']):
+                return renderJson(request, {'error': 'Only the files in a tgz can be pulled.'}, http.BAD_REQUEST)
+            MemberStreamer(request, filePath, member).start()
+            return server.NOT_DONE_YET
+        waiting = self._indexing.get(record['path'])
+        if waiting is None:
+            waiting = self._indexing[record['path']] = []
+            deferToThread(self.indexer.index, filePath).addBoth(self._onIndexed, record)
+        waiting.append(request)
+        return server.NOT_DONE_YET
+
+    def _onIndexed(self, result, record):
+        for request in self._indexing.pop(record['path']):
+            # The channel is gone if the connection is lost.
+            if request.channel is None:
+                continue
+            if isinstance(result, Failure):
+                body = renderJson(request, {'error': result.getErrorMessage()}, http.INTERNAL_SERVER_ERROR)
+            else:
+                body = self._render(request, record, result)
+            request.write(body)
+            request.finish()
+
+    def _render(self, request, record, entries):
+        prefix = request.args.get('prefix', [''])[-1].decode('utf-8', 'replace')
+        files = [dict(zip(FIELDS, entry)) for entry in entries if entry[0].startswith(prefix)]
+        if request.args.get('format', [''])[-1] != 'html':
+            return renderJson(request, {'path': record['path'], 'total': len(files), 'files': files})
+        href = '/api/manifest/' + quote(record['path'].encode('utf-8'))
+        extractable = can_extract(record['file_name'])
+        rows = []
+        for entry, rowClass in zip(files, itertools.cycle(['odd', 'even'])):
+            name = quote(entry['name'].encode('utf-8'))
+            # Only the files of a tgz can be pulled out, the others link to the files under them.
+            if entry['type'] == 'file' and extractable:
+                link = href + '?member=' + name
+            else:
+                link = href + '?format=html&prefix=' + name
+            rows.append({'class': rowClass, 'href': link, 'text': escape(entry['name']), 'size_int': entry['size'],
+                         'size': formatFileSize(entry['size']), 'type': '[%s]' % (entry['type'],),
+                         'ctime': str(datetime.fromtimestamp(entry['mtime'])) if entry['mtime'] else ''})
+        request.setHeader(b"content-type", b"text/html; charset=utf-8")
+        header = "Files in %s" % (escape(record['path']),)
+        tableContent = "".join(CustomiseDirectoryLister.linePattern % row for row in rows)
+        done = CustomiseDirectoryLister.template.generatePage({"header": header, "tableContent": tableContent})
+        return done.encode("utf8")
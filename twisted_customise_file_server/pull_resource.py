@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+"""
+import os
+
+from twisted.internet.threads import deferToThread
+from twisted.python.compat import _PY3
+from twisted.python.failure import Failure
+from twisted.web import http, resource, server
+from twisted.web.util import redirectTo
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+from settings import PULL_CHUNK_SIZE
+
+if _PY3:
+    from urllib.parse import quote
+else:
+    from urllib import quote
+
+
+@implementer(IPushProducer)
+class PullStreamer(object):
+    """
+    Stream a pulled package to the client by following its staging file while
+    it is downloading. The last byte is held back until the md5 check sum is
+    verified, so a broken package is never received completely. The file is
+    read in the thread pool a chunk at a time, so that a slow disk does not
+    block the other requests.
+    """
+
+    def __init__(self, request, pull, rootPath):
+        self.request = request
+        self.pull = pull
+        self.rootPath = rootPath
+        self.fileObject = None
+        self.offset = 0
+        self.paused = False
+        self.stopped = False
+        # Whether the file is being opened or read in a thread.
+        self.reading = False
+        self._unfollow = None
+
+    def start(self):
+        self._unfollow = self.pull.follow(self.update)
+        self.request.notifyFinish().addErrback(lambda _: self.stopProducing())
+        self.update()
+
+    def update(self):
+        # It is called again when the read in flight is done.
+        if self.stopped or self.reading:
+            return
+        pull = self.pull
+        if self.fileObject is None:
+            if pull.finished:
+                self._respond()
+                return
+            if pull.state != 'downloading':
+                return
+            self.reading = True
+            deferToThread(open, pull.tmp_path, 'rb').addBoth(self._opened)
+            return
+        limit = pull.written if pull.file_path else pull.written - 1
+        if not self.paused and self.offset < limit:
+            self.reading = True
+            deferToThread(self.fileObject.read, min(PULL_CHUNK_SIZE, limit - self.offset)).addBoth(self._read)
+            return
+        if pull.finished:
+            if not pull.file_path:
+                self._abort()
+            elif self.offset >= pull.written:
+                self._stop()
+                self.request.finish()
+
+    def _opened(self, result):
+        self.reading = False
+        if isinstance(result, Failure):
+            # The staging file is removed if the pull fails meanwhile.
+            if not self.stopped:
+                self._respond()
+            return
+        if self.stopped:
+            result.close()
+            return
+        self.fileObject = result
+        pull = self.pull
+        self.request.setHeader(b'content-type', b'application/octet-stream')
+        self.request.setHeader(b'content-disposition',
+                               b'attachment; filename="%s"' % (pull.url.split('/')[-1],))
+        if pull.size is not None:
+            self.request.setHeader(b'content-length', str(pull.size))
+        self.request.registerProducer(self, True)
+        self.update()
+
+    def _read(self, result):
+        self.reading = False
+        if self.stopped:
+            # It is not closed by _stop while reading.
+            self.fileObject.close()
+            return
+        if isinstance(result, Failure) or not result:
+            self._abort()
+            return
+        self.offset += len(result)
+        self.request.write(result)
+        self.update()
+
+    def _abort(self):
+        # Break the connection, so that the client knows the package is broken.
+        transport = self.request.transport
+        self._stop()
+        transport.loseConnection()
+
+    def _respond(self):
+        """
+        Answer the clients come after the pull ends.
+        """
+        self._stop()
+        if self.pull.file_path:
+            path = os.path.relpath(self.pull.file_path, self.rootPath)
+            body = redirectTo(b'/' + quote(path.encode('utf-8')), self.request)
+        else:
+            self.request.setResponseCode(http.BAD_GATEWAY)
+            self.request.setHeader(b'content-type', b'text/plain')
+            body = b'Pull the package failed.\n'
+        self.request.write(body)
+        self.request.finish()
+
+    def _stop(self):
+        self.stopped = True
+        self._unfollow()
+        if self.fileObject is not None:
+            # The channel is gone if the connection is lost.
+            if self.request.channel is not None:
+                self.request.unregisterProducer()
+            if not self.reading:
+                self.fileObject.close()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.update()
+
+    def stopProducing(self):
+        if not self.stopped:
+            self._stop()
+
+
+class PullResource(resource.Resource):
+    """
+    Pull any package from the upstream, e.g. /pull/<branch>/<build>/<platform package>?product=splunk
+    where build is a P4CHANGE or 'latest'. The package is streamed to the client
+    while it is downloading, or redirected to if it is downloaded already.
+    """
+    isLeaf = True
+
+    def __init__(self, puller, rootPath):
+        """
+        :param puller: A function(branch, build, platform_package, package_type) returns the Pull of the package.
+        :param rootPath: The dir the packages are served from.
+        """
+        resource.Resource.__init__(self)
+        self.puller = puller
+        self.rootPath = rootPath
+
+    def render_GET(self, request):
+        # The segments are unquoted already, an escaped slash or a '..' could reach the paths of the package.
+        if len(request.postpath) != 3 or not all(request.postpath) or \
+                any(b'/' in segment or b'..' in segment for segment in request.postpath):
+            request.setResponseCode(http.BAD_REQUEST)
+            request.setHeader(b'content-type', b'text/plain')
+            return b'Usage: /pull/<branch>/<build>/<platform package>?product=splunk\n'
+        branch, build, platformPackage = request.postpath
+        product = request.args.get('product', ['splunk'])[-1]
+        PullStreamer(request, self.puller(branch, build, platformPackage, product), self.rootPath).start()
+        return server.NOT_DONE_YET
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@author: Curtis Yu
+@contact: cuyu@splunk.com
+@since: 10/18/26
+"""
+import errno
+import os
+
+from twisted.internet.interfaces import ISSLTransport
+from twisted.python import log
+from twisted.web.static import StaticProducer
+
+from settings import SENDFILE_CHUNK_SIZE
+
+# os.sendfile is only in python 3, fall back to the pysendfile package which has the same signature.
+sendfile = getattr(os, 'sendfile', None)
+if sendfile is None:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+
+def canSendfile(request):
+    """
+    Whether the response body of the request can be sent by sendfile, i.e. the
+    request is written directly to a plain TCP socket.
+    """
+    transport = request.transport
+    return (sendfile is not None and not request.queued and
+            not ISSLTransport.providedBy(transport) and
+            hasattr(transport, 'fileno') and hasattr(transport, 'dataBuffer'))
+
+
+class SendfileProducer(StaticProducer):
+    """
+    A L{StaticProducer} that copies a range of the file to the socket in the
+    kernel by sendfile, without reading the data into the reactor thread.
+
+    It is registered as a pull producer: the transport asks for more data once
+    its own buffer (e.g. the response headers) is drained, and the producer
+    waits for the socket to be writable again by making the transport writing.
+    """
+
+    def __init__(self, request, fileObject, offset, size):
+        StaticProducer.__init__(self, request, fileObject)
+        self.offset = offset
+        self.remaining = size
+
+    def start(self):
+        # Write out the response headers first.
+        self.request.write(b'')
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self.request:
+            return
+        transport = self.request.transport
+        # The data written lately is kept aside (in a private attribute) until it is joined into dataBuffer.
+        if transport.dataBuffer or getattr(transport, '_tempDataLen', 0):
+            # Wait for the buffered data to be sent, resumeProducing will be called again then.
+            transport.startWriting()
+            return
+        if self.remaining <= 0:
+            self._finish()
+            return
+        try:
+            sent = sendfile(transport.fileno(), self.fileObject.fileno(), self.offset,
+                            min(self.remaining, SENDFILE_CHUNK_SIZE))
+        except (OSError, IOError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                transport.startWriting()
+                return
+            log.msg('sendfile failed: %s' % (e,))
+            self._abort()
+            return
+        if sent == 0:
+            log.msg('sendfile stopped at offset %d, the file is truncated.' % (self.offset,))
+            self._abort()
+            return
+        self.offset += sent
+        self.remaining -= sent
+        self.request.sentLength += sent
+        if self.remaining <= 0:
+            self._finish()
+        else:
+            transport.startWriting()
+
+    def _finish(self):
+        self.request.unregisterProducer()
+        self.request.finish()
+        self.stopProducing()
+
+    def _abort(self):
+        transport = self.request.transport
+        self.request.unregisterProducer()
+        self.stopProducing()
+        transport.loseConnection()
@@ -14,3 +14,24 @@ STATIC_RESOURCE_PATH = os.path.join(_CURRENT_DIR, 'static')
 
 # The template file used to render, should be under STATIC_RESOURCE_PATH.
 TEMPLATE_FILE = 'index.html'
+
+# Files larger than this size (bytes) are sent by sendfile if it is available (os.sendfile or the pysendfile package).
+SENDFILE_MIN_SIZE = 1024 * 1024
+
+# Max bytes sent by one sendfile call.
+SENDFILE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Max bytes read from the staging file and written to a client at a time when following a pulled package.
+PULL_CHUNK_SIZE = 256 * 1024
+
+# Max bytes read from a package and written to a client at a time when pulling a single file out of it.
+MEMBER_CHUNK_SIZE = 256 * 1024
+
+# The fraction of the web requests logged, e.g. 0.1 logs one in ten requests (the warnings are always logged).
+REQUEST_LOG_SAMPLE_RATE = 1
+
+# Max seconds a long poll of /api/events waits for an event.
+EVENT_POLL_TIMEOUT = 60
+
+# Seconds between two comments sent to keep the event streams (/api/events/stream) open through the proxies.
+EVENT_KEEPALIVE_INTERVAL = 15